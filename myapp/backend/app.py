@@ -1,24 +1,51 @@
-from fastapi import FastAPI, HTTPException, Request, UploadFile, File
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, HTTPException, Request, UploadFile, File, Form, Depends
+from fastapi.responses import StreamingResponse, Response, FileResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import List, Union, Optional
+from typing import List, Union, Optional, Dict, Any
 import os
 import io
 import time
 import logging
-import asyncio
 import pydicom
 from PIL import Image
 from starlette.concurrency import run_in_threadpool
 from contextlib import asynccontextmanager
-from model_engine import engine
 from context_manager import context_manager
-from detection_service import DetectionService
+import cancellation
+from cancellation import Cancelled, DEADLINE_NOTICE
 import ct_service
+import ct_mapreduce
+import chat_stream
+from stop_reasons import DEGENERATION_REASONS, DEGENERATION_NOTICE, stop_reason
+from metrics import metrics
+from memory_planner import MemoryBudgetExceeded
+from model_registry import UnknownVariant
+from profiler import profiler, ProfilingMiddleware
+from preprocess_pipeline import pipeline as preprocess
+import request_codec
+from session_store import SessionStore
 import uvicorn
 import json
+import sys
+import atexit
+import subprocess
+
+# Optional split deployment: a dedicated model-server process owns the model and
+# this process (one of several uvicorn workers) only handles HTTP / CPU work.
+# (可选拆分部署：独立模型进程持有模型，API 进程仅处理 HTTP 与 CPU 任务。)
+MODEL_SERVER_ADDRESS = os.environ.get("MEDGEMMA_MODEL_SERVER")
+
+if MODEL_SERVER_ADDRESS:
+    from model_client import RemoteEngine, RemoteDetectionService
+    engine = RemoteEngine(MODEL_SERVER_ADDRESS)
+    # CT context must be shared by all API workers, so it lives in the model server.
+    ct_store = engine
+else:
+    # Engine replica pool (a single replica wrapping the model_engine singleton by default)
+    from engine_pool import pool as engine
+    ct_store = ct_service
 
 # Setup Logging Manually (Since config_loader is removed)
 logging.basicConfig(
@@ -36,7 +63,7 @@ LOGGER = logging.getLogger("MedGemma")
 class ContentItem(BaseModel):
     type: str  # "text" or "image" (类型："text" 文本或 "image" 图像)
     text: Optional[str] = None
-    image: Optional[str] = None  # Base64 string (Base64 编码字符串)
+    image: Optional[Union[str, bytes]] = None  # Base64 / data URL / blob URL, or raw bytes (binary requests, see request_codec.py)
 
 class Message(BaseModel):
     role: str
@@ -49,23 +76,39 @@ class Config(BaseModel):
     max_tokens: Optional[int] = None
     context_window: Optional[int] = 8192
     use_ct_context: Optional[bool] = False # New flag to trigger backend injection
+    thinking_budget: Optional[int] = None # Max thought tokens before <unused95> is forced (None: unlimited, 0: off)
+    model_variant: Optional[str] = None # model_registry.py variant (None: the startup one), see GET /api/models
+    ct_mode: Optional[str] = None # CT context: "single" prompt (default) or "map_reduce" over slice chunks (ct_mapreduce.py)
+    deadline_s: Optional[float] = None # Seconds the request may take before it is cancelled (None: server default, 0: none)
 
 class ChatRequest(BaseModel):
     messages: List[Message]
     config: Optional[Config] = None
 
+class SessionUpdate(BaseModel):
+    title: Optional[str] = None
+    messages: Optional[List[Dict[str, Any]]] = None  # Replaces the whole history (import)
+
+class MessagePut(BaseModel):
+    message: Dict[str, Any]
+    title: Optional[str] = None
+
 # App Lifecycle
 # App Lifecycle (应用生命周期)
 detection_service = None
-model_lock = None
+# Opened on startup, so importing app (benchmarks, batch CLI, model server) creates no files
+session_store = None
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global detection_service, model_lock
-    # Initialize global lock for GPU resources
-    model_lock = asyncio.Lock()
-    
-    detection_service = DetectionService(engine)
+    global detection_service, session_store
+    session_store = SessionStore()
+    if MODEL_SERVER_ADDRESS:
+        detection_service = RemoteDetectionService(engine)
+        LOGGER.info(f"Startup Event: Using model server at {MODEL_SERVER_ADDRESS}")
+    else:
+        # The pool routes detection to the least-loaded replica
+        detection_service = engine
     
     # Load model on startup (Pre-load to VRAM)
     LOGGER.info("Startup Event: Pre-loading model into VRAM...")
@@ -78,6 +121,7 @@ async def lifespan(app: FastAPI):
     yield
     # Cleanup
     # Cleanup (清理资源)
+    session_store.close()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -90,6 +134,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Armed request captures (see profiler.py); a flag check while disarmed
+app.add_middleware(ProfilingMiddleware, profiler=profiler)
+
 # Request logging middleware (replaces former Express proxy logging)
 @app.middleware("http")
 async def log_api_requests(request: Request, call_next):
@@ -109,30 +156,116 @@ async def log_api_requests(request: Request, call_next):
 async def get_status():
     return {"status": "running", "model_loaded": engine.model is not None}
 
+# Engine pool administration (副本池管理)
+@app.get("/api/pool")
+async def pool_status():
+    status = await run_in_threadpool(engine.status)
+    return {**status, "preprocess": preprocess.status()}
+
+@app.post("/api/pool/{name}/drain")
+async def pool_drain(name: str, wait: Optional[float] = None, unload: bool = False):
+    try:
+        return await run_in_threadpool(engine.drain, name, wait, unload)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@app.post("/api/pool/{name}/undrain")
+async def pool_undrain(name: str):
+    try:
+        return await run_in_threadpool(engine.undrain, name)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@app.get("/api/models")
+async def model_variants():
+    """Model variants a request may pick with config.model_variant (load state: /api/pool)."""
+    return await run_in_threadpool(engine.variants)
+
+# On-demand profiling (按需性能采样), see profiler.py
+class ProfileArmRequest(BaseModel):
+    route: str = "/api/chat"
+    requests: Optional[int] = None  # next N matching requests (default 1)
+    seconds: Optional[float] = None  # or every matching request within this window
+    torch: bool = True  # torch operator timings as well as Python stacks
+    interval_ms: float = 5
+
+@app.post("/api/admin/profile")
+async def profile_arm(request: ProfileArmRequest):
+    try:
+        return profiler.arm(request.route, request.requests, request.seconds, request.torch, request.interval_ms)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.delete("/api/admin/profile")
+async def profile_disarm():
+    return profiler.disarm()
+
+@app.get("/api/admin/profile")
+async def profile_status():
+    """Armed state and recent captures (newest first) with their trace files."""
+    return profiler.status()
+
+@app.get("/api/admin/profile/files/{name}")
+async def profile_file(name: str):
+    path = profiler.file_path(name)
+    if path is None or not os.path.exists(path):
+        raise HTTPException(status_code=404, detail=f"Unknown capture file: {name}")
+    media_type = "application/json" if name.endswith(".json") else "text/plain"
+    return FileResponse(path, media_type=media_type, filename=name)
+
+# Runtime counters (运行指标)
+@app.get("/api/metrics")
+async def get_metrics():
+    """Process-local counters (generation stop reasons, ...), see metrics.py."""
+    return metrics.snapshot()
+
+
+def memory_busy(e: MemoryBudgetExceeded) -> HTTPException:
+    """503 for requests the memory planner turned away (Retry-After when it was only busy)."""
+    headers = {"Retry-After": str(e.retry_after)} if e.retry_after else None
+    return HTTPException(status_code=503, detail=str(e), headers=headers)
+
+def request_cancelled(e: Cancelled) -> HTTPException:
+    """504 for a request past its deadline; 499 (nginx's "client closed request") when the client left."""
+    if e.reason == "deadline":
+        return HTTPException(status_code=504, detail="Request deadline exceeded.")
+    return HTTPException(status_code=499, detail="Client closed request.")
 
 class DetectRequest(BaseModel):
     messages: List[Message]
     config: Optional[Config] = None
 
 @app.post("/api/detect")
-async def detect(request: DetectRequest):
+async def detect(raw_request: Request, request: DetectRequest = Depends(request_codec.body(DetectRequest))):
+    # Cancelled when the client leaves or the deadline passes, wherever the request is by then
+    cancel_token = cancellation.new_token("detect", request.config.deadline_s if request.config else None)
+    watcher = cancellation.watch_disconnect(raw_request, cancel_token)
     try:
-        # Acquire Lock for GPU
-        async with model_lock:
-            # Convert Pydantic to dict
-            messages_data = [msg.model_dump() for msg in request.messages]
-            
-            # Call specialized detection service
-            # Pass system prompt from config if available
-            custom_system_prompt = request.config.system_prompt if request.config and request.config.system_prompt else None
-            
-            # Use run_in_threadpool to keep event loop responsive while GPU works
-            result = await run_in_threadpool(
-                detection_service.detect_findings, 
-                messages_data, 
-                custom_system_prompt=custom_system_prompt
-            )
+        # GPU serialization is per replica (engine_pool / model server), not a global lock
+        # Convert Pydantic to dict
+        messages_data = [msg.model_dump() for msg in request.messages]
+        # Call specialized detection service
+        # Pass system prompt from config if available
+        custom_system_prompt = request.config.system_prompt if request.config and request.config.system_prompt else None
+        model_variant = request.config.model_variant if request.config else None
+        # Detection prompt, tokens and pixels are made on the preprocessing stage, before the replica's detect lock
+        messages_data, prepared = await preprocess.run(prepare_detection, messages_data, custom_system_prompt,
+                                                       model_variant, cancel_token)
         
+        # Use run_in_threadpool to keep event loop responsive while GPU works
+        result = await run_in_threadpool(
+            detection_service.detect_findings, 
+            messages_data, 
+            custom_system_prompt=custom_system_prompt,
+            thinking_budget=request.config.thinking_budget if request.config else None,
+            model_variant=model_variant,
+            cancel_token=cancel_token,
+            prepared=prepared
+        )
+        
+        usage = result.get("usage") or {}
+        metrics.incr("generation_stops", kind="detect", reason=usage.get("stop_reason", "eos"))
+
         # Try to parse JSON here for safety
         findings_data = []
         try:
@@ -145,24 +278,61 @@ async def detect(request: DetectRequest):
         return {
              "status": "success",
              "thought": result["thought_trace"],
-             "findings": findings_data
+             "findings": findings_data,
+             "usage": usage
         }
+    except MemoryBudgetExceeded as e:
+        raise memory_busy(e)
+    except UnknownVariant as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Cancelled as e:
+        raise request_cancelled(e)
     except Exception as e:
         LOGGER.error(f"Error during detection: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        watcher.cancel()
+
+def prepare_detection(messages_data, custom_system_prompt: Optional[str], model_variant: Optional[str], cancel_token=None):
+    """Preprocessing stage of a detection request: history images, detection prompt, model inputs."""
+    if cancel_token is not None:
+        cancel_token.check("preprocess")
+    # History images arrive as /api/blobs/<sha> URLs
+    messages_data = session_store.resolve_images(messages_data)
+    return messages_data, detection_service.prepare_detection(messages_data, model_variant=model_variant,
+                                                               custom_system_prompt=custom_system_prompt)
+
+def prepare_chat(messages_data, context_limit: int, model_variant: Optional[str], cancel_token=None):
+    """Preprocessing stage of a chat request (preprocess_pipeline.py): roles, context trimming, model inputs."""
+    if cancel_token is not None:
+        # Abandoned while queued for a worker
+        cancel_token.check("preprocess")
+    # Sanitize messages to ensure alternating roles (User <-> Assistant)
+    # Fixes "Conversation roles must alternate" error when history contains consecutive same-role messages
+    messages_data = context_manager.sanitize_history_roles(messages_data)
+
+    # Apply Context Management
+    messages_data = context_manager.manage_context(messages_data, max_limit=context_limit)
+    return messages_data, engine.prepare_inputs(messages_data, model_variant=model_variant)
 
 @app.post("/api/chat")
-async def chat(request: ChatRequest, raw_request: Request):
+async def chat(raw_request: Request, request: ChatRequest = Depends(request_codec.body(ChatRequest))):
+    # Cancelled when the client leaves (queued, prefilling or streaming) or the deadline passes
+    cancel_token = cancellation.new_token("chat", request.config.deadline_s if request.config else None)
+    watcher = cancellation.watch_disconnect(raw_request, cancel_token)
+    streaming = False
     try:
         LOGGER.info("Received chat request")
         
         # Convert Pydantic models to dicts for the engine
         messages_data = [msg.model_dump() for msg in request.messages]
+        # History images arrive as /api/blobs/<sha> URLs
+        messages_data = await preprocess.run(session_store.resolve_images, messages_data)
         
         # [NEW] CT Context Injection from Backend Cache
         if request.config and request.config.use_ct_context:
              LOGGER.info("Injecting CT Context from Server Cache...")
-             cached_images = ct_service.get_global_context()
+             cached_images = ct_store.get_global_context()
              if cached_images:
                 # Reconstruct Prompt
                 user_msg = messages_data[-1] 
@@ -175,22 +345,26 @@ async def chat(request: ChatRequest, raw_request: Request):
                          if item.get('type') == 'text':
                              user_text += item.get('text', '')
                 
-                instruction = ("You are a senior radiologist analyzing a contiguous block of CT slices. "
-                               "Please review the slices provided below carefully. "
-                               "The images use a specific 3-channel windowing:\n"
-                               "- Red (Wide Window): Range -1024 to 1024 HU (Air to Bone)\n"
-                               "- Green (Soft Tissue Window): Range -135 to 215 HU (Fat to Bone)\n"
-                               "- Blue (Brain Window): Range 0 to 80 HU (Water to Brain)\n"
-                               "Each channel provides different diagnostic information.")
-                new_content = [{"type": "text", "text": instruction}]
-                for img_data in cached_images:
-                    new_content.append({"type": "image", "image": img_data['image']})
-                    new_content.append({"type": "text", "text": f"SLICE {img_data['index']}"})
-                new_content.append({"type": "text", "text": f"\n\nBased on the visual evidence in the slices provided above, answer the following query in Simplified Chinese:\n{user_text}\n\nPlease provide your detailed reasoning."})
-                
-                # Replace history for CT analysis turn
-                messages_data = [{"role": "user", "content": new_content}]
-                LOGGER.info(f"Injected {len(cached_images)} slices into prompt.")
+                ct_mode = request.config.ct_mode or "single"
+                if ct_mode not in ct_mapreduce.CT_MODES:
+                    raise HTTPException(status_code=400, detail=f"Unknown ct_mode: {ct_mode}")
+                if ct_mode == "map_reduce":
+                    # Chunk findings first (blocking, batched); the streamed answer is built from them
+                    try:
+                        messages_data = await run_in_threadpool(
+                            ct_mapreduce.analyze, engine, cached_images, user_text,
+                            system_prompt=request.config.system_prompt, model_variant=request.config.model_variant,
+                            cancel_token=cancel_token)
+                    except MemoryBudgetExceeded as e:
+                        raise memory_busy(e)
+                    except UnknownVariant as e:
+                        raise HTTPException(status_code=400, detail=str(e))
+                else:
+                    new_content = ct_service.build_context_content(cached_images, user_text)
+
+                    # Replace history for CT analysis turn
+                    messages_data = [{"role": "user", "content": new_content}]
+                    LOGGER.info(f"Injected {len(cached_images)} slices into prompt.")
 
         system_prompt = request.config.system_prompt if request.config else "You are a helpful medical assistant."
         if messages_data and messages_data[0]['role'] != 'system':
@@ -198,38 +372,50 @@ async def chat(request: ChatRequest, raw_request: Request):
         elif messages_data and messages_data[0]['role'] == 'system' and request.config and request.config.system_prompt:
              messages_data[0]['content'] = request.config.system_prompt
 
-        # Sanitize messages to ensure alternating roles (User <-> Assistant)
-        # Fixes "Conversation roles must alternate" error when history contains consecutive same-role messages
-        messages_data = context_manager.sanitize_history_roles(messages_data)
-
-        # Apply Context Management
         context_limit = request.config.context_window if request.config and request.config.context_window else 8192
-        messages_data = context_manager.manage_context(messages_data, max_limit=context_limit)
+        model_variant = request.config.model_variant if request.config else None
 
-        # NOTE: Moved engine.generate INSIDE the generator to protect with Lock
+        # Generation starts before the response so a request over the memory budget
+        # gets a 503 instead of a 200 stream (it may wait for memory here, off the event loop)
+        try:
+            # Ready-to-run tensors are made on the preprocessing stage, while the model may still be busy
+            messages_data, prepared = await preprocess.run(prepare_chat, messages_data, context_limit, model_variant,
+                                                           cancel_token)
+            streamer, stopper = await run_in_threadpool(
+                engine.generate,
+                messages_data,
+                max_new_tokens=request.config.max_tokens if request.config else None,
+                temperature=request.config.temperature if request.config else None,
+                top_p=request.config.top_p if request.config else None,
+                thinking_budget=request.config.thinking_budget if request.config else None,
+                model_variant=model_variant,
+                prepared=prepared,
+                cancel_token=cancel_token
+            )
+        except MemoryBudgetExceeded as e:
+            raise memory_busy(e)
+        except UnknownVariant as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        # Typed SSE stream (thought / answer / notice / usage events), see chat_stream.py
+        if "text/event-stream" in raw_request.headers.get("accept", ""):
+            async def sse_generator():
+                try:
+                    async for frame in chat_stream.sse_stream(streamer, stopper, cancel_token):
+                        yield frame
+                finally:
+                    watcher.cancel()
+
+            streaming = True
+            return StreamingResponse(sse_generator(), media_type="text/event-stream",
+                                     headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
         async def event_generator():
             full_response = ""
             start_time = time.time()
             first_token_time = None
-            stopper = None
-            
-            # Acquire Lock for duration of streaming
-            # async with model_lock: # Using threadpool now, lock might be handled inside or we skip if single user
-            # Simplification: engine.chat handles generation. We just iterate.
             
             try:
-                # Use engine.chat (new high level method or existing generate)
-                # If engine.chat doesn't exist, we adapt engine.generate
-                # The read_file showed `engine.generate`.
-                
-                streamer, stopper = engine.generate(
-                    messages_data, # Now modified
-                    max_new_tokens=request.config.max_tokens if request.config else None,
-                    temperature=request.config.temperature if request.config else None,
-                    top_p=request.config.top_p if request.config else None
-                )
-
                 for new_text in streamer:
                     if first_token_time is None:
                         first_token_time = time.time()
@@ -239,13 +425,21 @@ async def chat(request: ChatRequest, raw_request: Request):
                     full_response += new_text
                     yield new_text
                     
-                    if await raw_request.is_disconnected():
+                    # Set by the disconnect watcher, which owns receive() (no per-chunk polling)
+                    if cancel_token.cancelled and cancel_token.reason == "client_disconnected":
                         LOGGER.info("Client disconnected. Aborting generation.")
                         stopper.abort()
                         break
                 
                 if not stopper.aborted:
                     LOGGER.info(f"Generated Response: {full_response[:200]}..." if len(full_response) > 200 else f"Generated Response: {full_response}")
+
+                reason = stop_reason(getattr(stopper, "info", None) or {}, stopper.aborted)
+                metrics.incr("generation_stops", kind="chat", reason=reason)
+                if reason in DEGENERATION_REASONS:
+                    yield f"\n\n{DEGENERATION_NOTICE}"
+                elif reason == "deadline":
+                    yield f"\n\n{DEADLINE_NOTICE}"
                     
             except Exception as e:
                 if "Empty" in type(e).__name__:
@@ -255,24 +449,57 @@ async def chat(request: ChatRequest, raw_request: Request):
                     LOGGER.error(f"Error during stream generation: {e}", exc_info=True)
                     yield f"[ERROR: {str(e)}]"
             finally:
-                if stopper:
-                        # cleanup
-                        pass
+                watcher.cancel()
                 # Log generation finish
                 print(f"Backend Stream Finished. Response length: {len(full_response)}")
 
+        streaming = True
         return StreamingResponse(event_generator(), media_type="text/plain")
 
+    except HTTPException:
+        raise
+    except Cancelled as e:
+        raise request_cancelled(e)
     except Exception as e:
         LOGGER.error(f"Error processing chat request: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if not streaming:
+            watcher.cancel()
+
+def prefill_ct_prefix(context_id: str, system_prompt: Optional[str]):
+    """Start the idle-time prefill of CT questions' shared prompt prefix (prefix_cache.py); never fails the upload."""
+    try:
+        engine.prefill_ct_context(context_id, system_prompt or Config().system_prompt)
+    except Exception as e:
+        LOGGER.warning(f"CT prefix prefill not started: {e}")
 
 @app.post("/api/ct/process")
-async def process_ct_scan_endpoint(files: List[UploadFile] = File(...)):
+async def process_ct_scan_endpoint(request: Request,
+                                   files: List[UploadFile] = File(...),
+                                   selection: str = Form(ct_service.DEFAULT_SELECTION),
+                                   image_token_budget: Optional[int] = Form(None),
+                                   projection: Optional[str] = Form(None),
+                                   slab_thickness: Optional[int] = Form(None),
+                                   stream: bool = Form(True),
+                                   system_prompt: Optional[str] = Form(None),
+                                   deadline_s: Optional[float] = Form(None)):
     """
     Process uploaded DICOM or Image files for 3D CT analysis.
-    Returns windowed and sampled images encoded in Base64.
+    Streams NDJSON (one line per slice as soon as it is windowed, then a "done" line);
+    each slice carries a cacheable thumbnail URL. stream=false returns one JSON body instead.
+    selection: "content" (drop air / redundant slices, fill the image-token budget) or "uniform".
+    projection: optional thick-slab mode ("mip", "minip", "mean") with slab_thickness slices per image;
+    a thickness too thin for the image-token budget is widened, reported as slab_thickness
+    {"requested", "used", "widened"} in the "done" line / JSON body.
+    system_prompt: the one CT chat will use, for the speculative prefix prefill (default: Config's).
+    deadline_s: seconds processing may take (default MEDGEMMA_CT_DEADLINE_S); like a client that
+    leaves, it stops the slice processing before its next slice (cancellation.py).
     """
+    if selection not in ("content", "uniform"):
+        raise HTTPException(status_code=400, detail=f"Unknown selection mode: {selection}")
+    if projection and projection not in ct_service.SLAB_REDUCERS:
+        raise HTTPException(status_code=400, detail=f"Unknown projection mode: {projection}")
     LOGGER.info(f"Received {len(files)} files for CT processing.")
     
     mixed_files = []
@@ -318,17 +545,147 @@ async def process_ct_scan_endpoint(files: List[UploadFile] = File(...)):
     if not mixed_files:
         raise HTTPException(status_code=400, detail="No valid DICOM or Image files found in upload.")
         
+    params = (selection, image_token_budget, projection, slab_thickness)
+    cancel_token = cancellation.new_token("ct", deadline_s)
+    if not stream:
+        watcher = cancellation.watch_disconnect(request, cancel_token)
+        try:
+            # Run processing in threadpool to avoid blocking event loop
+            result = await run_in_threadpool(ct_service.process_mixed_files, mixed_files, *params,
+                                             cancel_token=cancel_token)
+            
+            # Cache on Server! (raw pixels; the frontend gets thumbnail URLs)
+            context_id = await run_in_threadpool(ct_store.set_global_context, result,
+                                                 ct_service.upload_context_id(mixed_files, *params))
+            await run_in_threadpool(prefill_ct_prefix, context_id, system_prompt)
+            
+            return {"images": ct_service.public_result(result, context_id), "count": len(result), "context_id": context_id,
+                    "slab_thickness": ct_service.slab_report(slab_thickness, result)}
+        except Cancelled as e:
+            raise request_cancelled(e)
+        except Exception as e:
+            LOGGER.error(f"Error processing CT: {e}", exc_info=True)
+            raise HTTPException(status_code=500, detail=str(e))
+        finally:
+            watcher.cancel()
+
+    def ndjson_stream():
+        # Sync generator, advanced one line at a time in the threadpool (ndjson_body).
+        # Slices land in this upload's own pending context first, so their URLs resolve
+        # while the upload is still streaming; CT chat only sees the context once it is
+        # committed under its content id.
+        upload_id = ct_store.begin_context()
+        committed = False
+        try:
+            count = 0
+            slabs = []
+            for img_data in ct_service.iter_mixed_files(mixed_files, *params, cancel_token=cancel_token):
+                ct_store.append_context(upload_id, img_data)
+                count += 1
+                if img_data.get("slab"):
+                    slabs.append({"slab": img_data["slab"]})
+                yield json.dumps({"type": "slice", **ct_service.public_slice(img_data, upload_id)}, ensure_ascii=False) + "\n"
+            context_id = ct_store.commit_context(upload_id, ct_service.upload_context_id(mixed_files, *params))
+            committed = True
+            prefill_ct_prefix(context_id, system_prompt)
+            yield json.dumps({"type": "done", "count": count, "context_id": context_id,
+                              "slab_thickness": ct_service.slab_report(slab_thickness, slabs)}) + "\n"
+        except Cancelled as e:
+            LOGGER.info(f"CT processing cancelled after {count} slices ({e.reason}).")
+            yield json.dumps({"type": "error", "detail": str(e), "reason": e.reason}) + "\n"
+        except Exception as e:
+            LOGGER.error(f"Error processing CT: {e}", exc_info=True)
+            yield json.dumps({"type": "error", "detail": str(e)}, ensure_ascii=False) + "\n"
+        finally:
+            if not committed:
+                ct_store.discard_context(upload_id)
+
+    async def ndjson_body():
+        # Slice processing keeps running in its worker thread between lines, so the
+        # connection is watched independently and a departed client stops it at the next slice
+        lines = ndjson_stream()
+        watcher = cancellation.watch_disconnect(request, cancel_token)
+        finished = False
+        try:
+            while True:
+                line = await run_in_threadpool(next, lines, None)
+                if line is None:
+                    finished = True
+                    break
+                yield line
+        finally:
+            watcher.cancel()
+            if not finished:
+                cancel_token.cancel("client_disconnected")
+            # The worker has returned by now (threadpool calls finish before a cancellation lands)
+            lines.close()
+
+    return StreamingResponse(ndjson_body(), media_type="application/x-ndjson")
+
+@app.get("/api/ct/slices/{context_id}/{index}")
+async def get_ct_slice(context_id: str, index: int, request: Request):
+    """
+    JPEG thumbnail of one slice of a CT context, rendered on demand.
+    A (context_id, index) pair never changes content, so the response is immutable.
+    """
+    headers = {
+        "ETag": f'"{context_id}-{index}-{ct_service.THUMBNAIL_SIZE}"',
+        "Cache-Control": "public, max-age=31536000, immutable",
+    }
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
     try:
-        # Run processing in threadpool to avoid blocking event loop
-        result = await run_in_threadpool(ct_service.process_mixed_files, mixed_files)
-        
-        # Cache on Server!
-        ct_service.set_global_context(result)
-        
-        return {"images": result, "count": len(result)}
-    except Exception as e:
-        LOGGER.error(f"Error processing CT: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=str(e))
+        pixels = await run_in_threadpool(ct_store.get_slice_pixels, context_id, index)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    data = await run_in_threadpool(ct_service.render_thumbnail, pixels)
+    return Response(content=data, media_type="image/jpeg", headers=headers)
+
+# Session history (会话历史)
+@app.get("/api/sessions")
+async def list_sessions(limit: int = 50, before: Optional[str] = None):
+    try:
+        return await run_in_threadpool(session_store.list_sessions, min(limit, 200), before)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.put("/api/sessions/{session_id}")
+async def update_session(session_id: str, update: SessionUpdate):
+    if update.messages is not None:
+        await run_in_threadpool(session_store.replace_messages, session_id, update.messages, update.title)
+        return await run_in_threadpool(session_store.upsert_session, session_id)
+    return await run_in_threadpool(session_store.upsert_session, session_id, update.title)
+
+@app.delete("/api/sessions/{session_id}")
+async def delete_session(session_id: str):
+    await run_in_threadpool(session_store.delete_session, session_id)
+    return {"status": "deleted"}
+
+@app.get("/api/sessions/{session_id}/messages")
+async def get_session_messages(session_id: str, limit: int = 20, before: Optional[int] = None):
+    return await run_in_threadpool(session_store.get_messages, session_id, min(limit, 200), before)
+
+@app.put("/api/sessions/{session_id}/messages/{seq}")
+async def put_session_message(session_id: str, seq: int, body: MessagePut):
+    """Upsert one message; embedded data-URL images come back as blob URLs."""
+    return await run_in_threadpool(session_store.put_message, session_id, seq, body.message, body.title)
+
+@app.delete("/api/sessions/{session_id}/messages")
+async def truncate_session_messages(session_id: str, keep: int):
+    await run_in_threadpool(session_store.truncate_messages, session_id, keep)
+    return {"status": "truncated", "keep": keep}
+
+@app.get("/api/blobs/{sha}")
+async def get_blob(sha: str):
+    try:
+        path, mime = session_store.get_blob(sha)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    # Content-addressed: the URL pins the bytes. mime is an image type or an opaque download,
+    # and nosniff keeps browsers from guessing anything else (e.g. HTML) out of the bytes
+    return FileResponse(path, media_type=mime, headers={
+        "ETag": f'"{sha}"', "Cache-Control": "public, max-age=31536000, immutable",
+        "X-Content-Type-Options": "nosniff"})
 
 # Serve frontend static files (single-port deployment)
 frontend_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "frontend")
@@ -338,5 +695,21 @@ if os.path.exists(frontend_path):
 else:
     LOGGER.warning(f"Frontend directory not found at {frontend_path}. Serving API only.")
 
+def _spawn_model_server():
+    """Start model_server.py as a child process and point the API workers at it."""
+    address = os.environ.setdefault("MEDGEMMA_MODEL_SERVER", "127.0.0.1:8765")
+    server_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_server.py")
+    proc = subprocess.Popen([sys.executable, server_script, "--address", address])
+    atexit.register(proc.terminate)
+    LOGGER.info(f"Spawned model server (pid {proc.pid}) on {address}")
+    return proc
+
 if __name__ == "__main__":
-    uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True)
+    # MEDGEMMA_WORKERS > 1: one model-server process + N API worker processes.
+    workers = int(os.environ.get("MEDGEMMA_WORKERS", "1"))
+    if workers > 1:
+        if not MODEL_SERVER_ADDRESS:
+            _spawn_model_server()
+        uvicorn.run("app:app", host="0.0.0.0", port=8000, workers=workers)
+    else:
+        uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True)
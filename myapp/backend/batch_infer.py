@@ -0,0 +1,308 @@
+"""
+Offline batch inference over a directory of studies (离线批量推理).
+
+Walks ROOT and runs every study through the model without the web server:
+
+    ct      a directory holding a DICOM series or several images -> CT analysis
+            (same slice selection / context prompt as /api/ct/process + CT chat)
+    detect  a directory holding a single image -> lesion detection (DetectionService prompt)
+
+--task auto (default) picks per directory as above; --task detect treats every image
+file as its own study, --task ct every directory.
+
+Throughput: reading / windowing / slice selection runs in a thread pool up to
+--prefetch studies ahead of the model, and prompts of the same task are generated
+together in left-padded batches (engine.generate_batch). A batch that does not fit
+the memory budget is split in halves and retried.
+
+Results are appended to --output as JSON lines (one per study, flushed and fsynced),
+which is also the checkpoint: a rerun skips every study already in the file
+(failed ones too, unless --retry-errors).
+
+Usage (from myapp/backend):
+    python batch_infer.py /data/studies --output results.jsonl
+    python batch_infer.py /data/studies --output results.jsonl --task detect --detect-batch 16
+    MEDGEMMA_ENGINE=benchmarks.stub_engine:StubEngine python batch_infer.py /tmp/studies --output /tmp/out.jsonl
+"""
+import io
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import pydicom
+from PIL import Image
+
+import ct_service
+from chat_stream import ThoughtClassifier
+from detection_service import DetectionService, DETECTION_GENERATION_ARGS
+from engine_pool import resolve_engine_factory
+
+LOGGER = logging.getLogger("MedGemma")
+
+CT_SYSTEM_PROMPT = "You are a helpful medical assistant."
+CT_QUERY = "请描述该CT检查的主要影像学表现，并给出诊断印象。"
+# Sampling of the chat endpoint (model_engine.generate defaults)
+CT_GENERATION_ARGS = {"max_new_tokens": 1024, "temperature": 0.7, "top_p": 0.9, "do_sample": True}
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+
+
+def discover_studies(root, task="auto"):
+    """(study id, [file paths], task) in path order; ids are paths relative to root."""
+    studies = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        files = sorted(os.path.join(dirpath, name) for name in filenames if not name.startswith("."))
+        if not files:
+            continue
+        study_id = os.path.relpath(dirpath, root)
+        if task == "detect":
+            for path in files:
+                if path.lower().endswith(IMAGE_EXTENSIONS):
+                    studies.append((os.path.relpath(path, root), [path], "detect"))
+        elif task == "ct" or len(files) > 1:
+            studies.append((study_id, files, "ct"))
+        else:
+            studies.append((study_id, files, "detect"))
+    return studies
+
+
+def read_study_file(path):
+    """{'type', 'data', 'name'} like an /api/ct/process upload, or None if neither DICOM nor image."""
+    name = os.path.basename(path)
+    with open(path, "rb") as f:
+        contents = f.read()
+    try:
+        ds = pydicom.dcmread(io.BytesIO(contents))
+        if hasattr(ds, "PixelData"):
+            return {"type": "dicom", "data": ds, "name": name}
+    except Exception:
+        pass
+    try:
+        img = Image.open(io.BytesIO(contents))
+        img.load()
+        return {"type": "image", "data": img, "name": name}
+    except Exception:
+        return None
+
+
+def prepare_study(study, args, detector):
+    """Worker-side preprocessing: files -> processed slices -> one conversation."""
+    study_id, paths, task = study
+    start = time.perf_counter()
+    files = [item for item in (read_study_file(path) for path in paths) if item is not None]
+    if not files:
+        raise ValueError("No valid DICOM or image files.")
+    images = ct_service.process_mixed_files(files, args.selection, args.image_token_budget, args.projection)
+    if not images:
+        raise ValueError("No usable slices.")
+    if task == "detect":
+        conversation = detector.build_prompt(
+            [{"role": "user", "content": [{"type": "image", "image": images[0]["pixels"]},
+                                          {"type": "text", "text": args.detect_prompt}]}],
+            args.system_prompt)
+    else:
+        conversation = [
+            {"role": "system", "content": [{"type": "text", "text": args.system_prompt or CT_SYSTEM_PROMPT}]},
+            {"role": "user", "content": ct_service.build_context_content(images, args.ct_query)},
+        ]
+    return {"study": study_id, "task": task, "files": len(files), "images": len(images),
+            "conversation": conversation, "prepare_s": round(time.perf_counter() - start, 2)}
+
+
+def parse_output(task, text):
+    if task == "detect":
+        return DetectionService.parse_response(text)
+    classifier = ThoughtClassifier()
+    parts = {"thought": "", "answer": ""}
+    for kind, piece in classifier.feed(text) + classifier.finish():
+        parts[kind] += piece
+    return {"raw_response": text, "thought_trace": parts["thought"].strip(), "answer": parts["answer"].strip()}
+
+
+class ResultWriter:
+    """Append-only JSONL results; the studies already in the file are the resume checkpoint."""
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # line cut short by an interrupted run
+                    self.done[record["study"]] = record.get("status")
+        self._file = open(path, "a", encoding="utf-8")
+        if self._file.tell() > 0:
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self._file.write("\n")
+
+    def pending(self, study_id, retry_errors=False):
+        status = self.done.get(study_id)
+        return status is None or (retry_errors and status != "ok")
+
+    def write(self, record):
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.done[record["study"]] = record["status"]
+
+    def close(self):
+        self._file.close()
+
+
+class BatchRunner:
+    def __init__(self, engine, writer, args):
+        self.engine = engine
+        self.writer = writer
+        self.generation_args = {
+            "detect": {**DETECTION_GENERATION_ARGS, "eos_token_id": engine.model.config.eos_token_id},
+            "ct": dict(CT_GENERATION_ARGS),
+        }
+        if args.max_new_tokens:
+            for gen_args in self.generation_args.values():
+                gen_args["max_new_tokens"] = args.max_new_tokens
+        self.batch_size = {"detect": args.detect_batch, "ct": args.ct_batch}
+        self.pending = {"detect": [], "ct": []}
+        self.studies = 0
+        self.errors = 0
+        self.completion_tokens = 0
+        self.generate_s = 0.0
+
+    def add(self, item):
+        batch = self.pending[item["task"]]
+        batch.append(item)
+        if len(batch) >= self.batch_size[item["task"]]:
+            self.flush(item["task"])
+
+    def flush(self, task=None):
+        for name in ([task] if task else list(self.pending)):
+            batch, self.pending[name] = self.pending[name], []
+            if batch:
+                self.run(name, batch)
+
+    def run(self, task, batch):
+        gen_args = dict(self.generation_args[task])
+        max_new_tokens = gen_args.pop("max_new_tokens")
+        start = time.perf_counter()
+        try:
+            outputs = self.engine.generate_batch([item["conversation"] for item in batch], max_new_tokens, **gen_args)
+        except Exception as e:
+            if len(batch) > 1:
+                # Too large for the budget (or one bad study): retry in halves
+                LOGGER.warning(f"Batch of {len(batch)} {task} studies failed ({e}); splitting.")
+                half = len(batch) // 2
+                self.run(task, batch[:half])
+                self.run(task, batch[half:])
+                return
+            self.record_error(batch[0], e)
+            return
+        elapsed = time.perf_counter() - start
+        self.generate_s += elapsed
+        for item, output in zip(batch, outputs):
+            self.completion_tokens += output["completion_tokens"]
+            self.record(item, status="ok", batch_size=len(batch), generate_s=round(elapsed, 2),
+                        usage={"prompt_tokens": output["prompt_tokens"], "completion_tokens": output["completion_tokens"]},
+                        **parse_output(task, output["text"]))
+
+    def record(self, item, status, **fields):
+        self.studies += 1
+        self.writer.write({"study": item["study"], "task": item.get("task"), "status": status,
+                           "files": item.get("files"), "images": item.get("images"),
+                           "prepare_s": item.get("prepare_s"), **fields})
+
+    def record_error(self, item, error):
+        self.errors += 1
+        LOGGER.error(f"Study {item['study']} failed: {error}")
+        self.record(item, status="error", error=f"{type(error).__name__}: {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("root", help="Directory tree of studies.")
+    parser.add_argument("--output", required=True, help="JSONL results file (appended; also the resume checkpoint).")
+    parser.add_argument("--task", choices=("auto", "detect", "ct"), default="auto")
+    parser.add_argument("--detect-batch", type=int, default=8, help="Detection prompts per generate call.")
+    parser.add_argument("--ct-batch", type=int, default=1, help="CT prompts per generate call (each holds many images).")
+    parser.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1), help="Preprocessing threads.")
+    parser.add_argument("--prefetch", type=int, default=16, help="Studies preprocessed ahead of the model.")
+    parser.add_argument("--max-new-tokens", type=int, help="Override the per-task default (detect 8192, ct 1024).")
+    parser.add_argument("--system-prompt", help="Replace the detection / CT system prompt.")
+    parser.add_argument("--detect-prompt", default="Analyze this image.")
+    parser.add_argument("--ct-query", default=CT_QUERY)
+    parser.add_argument("--selection", choices=("content", "uniform"), default=ct_service.DEFAULT_SELECTION)
+    parser.add_argument("--image-token-budget", type=int)
+    parser.add_argument("--projection", choices=sorted(ct_service.SLAB_REDUCERS))
+    parser.add_argument("--retry-errors", action="store_true", help="Rerun studies recorded with status 'error'.")
+    parser.add_argument("--device", help="Device for the engine (e.g. cuda:0, cpu).")
+    parser.add_argument("--no-quantization", action="store_true")
+    parser.add_argument("--limit", type=int, help="Stop after this many studies (smoke runs).")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    writer = ResultWriter(args.output)
+    studies = discover_studies(args.root, args.task)
+    todo = [s for s in studies if writer.pending(s[0], args.retry_errors)]
+    if args.limit:
+        todo = todo[:args.limit]
+    print(f"[batch_infer] {len(studies)} studies, {len(studies) - len(todo)} already done, {len(todo)} to run",
+          file=sys.stderr)
+    if not todo:
+        writer.close()
+        return
+
+    engine = resolve_engine_factory()(use_quantization=False if args.no_quantization else None, device=args.device)
+    engine.load_model()
+    runner = BatchRunner(engine, writer, args)
+    detector = DetectionService(engine)
+
+    start = time.perf_counter()
+    executor = ThreadPoolExecutor(max_workers=max(1, args.workers), thread_name_prefix="batch-prep")
+    queue = deque()
+    remaining = iter(todo)
+    try:
+        while True:
+            # Keep the pool up to --prefetch studies ahead of generation
+            while len(queue) < max(1, args.prefetch):
+                study = next(remaining, None)
+                if study is None:
+                    break
+                queue.append((study, executor.submit(prepare_study, study, args, detector)))
+            if not queue:
+                break
+            study, future = queue.popleft()
+            try:
+                item = future.result()
+            except Exception as e:
+                runner.record_error({"study": study[0], "task": study[2], "files": len(study[1])}, e)
+                continue
+            done_before = runner.studies
+            runner.add(item)
+            if runner.studies != done_before:
+                elapsed = time.perf_counter() - start
+                print(f"[batch_infer] {runner.studies}/{len(todo)} studies ({runner.errors} errors), "
+                      f"{runner.studies / elapsed * 60:.1f} studies/min", file=sys.stderr)
+        runner.flush()
+    except KeyboardInterrupt:
+        print("[batch_infer] Interrupted; finished studies are saved, rerun to resume.", file=sys.stderr)
+        sys.exit(130)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        writer.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"[batch_infer] Done: {runner.studies} studies ({runner.errors} errors) in {elapsed:.1f}s, "
+          f"{runner.studies / elapsed * 60:.1f} studies/min, "
+          f"{runner.completion_tokens / max(runner.generate_s, 1e-9):.1f} generated tokens/s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+ct_service micro-benchmarks over a synthetic DICOM corpus (CT 处理分阶段基准).
+
+Generates CT series for every combination of slice count, matrix size, pixel
+dtype, rescale slope/intercept and transfer syntax, then times each stage of the
+process_mixed_files DICOM path separately and tracks peak Python/numpy memory
+per stage with tracemalloc:
+
+    header_parse  pydicom.dcmread of every uploaded file (done in app.py)
+    sort          sorted(..., key=dicom_sort_key)
+    sample        choose_slices (--selection content|uniform), run on a separate
+                  parse of the series so its own decodes do not warm the next stage
+    pixel_decode  ds.pixel_array for the sampled slices (first decode of each)
+    rescale       to_hounsfield
+    windowing     apply_windowing
+    context       to_context_pixels (uint8 RGB kept in the CT context)
+    end_to_end    process_mixed_files on freshly parsed datasets (series result
+                  cache disabled unless --result-cache is given)
+
+Run from myapp/backend:
+    python -m benchmarks.ct_bench --output ct_bench.json
+    python -m benchmarks.ct_bench --slices 50,1000 --matrix 512 --syntaxes explicit,rle,j2k
+    python -m benchmarks.ct_bench --corpus-dir /tmp/ct_corpus   # write/read the corpus on disk
+"""
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import statistics
+import tracemalloc
+
+import pydicom
+
+import ct_service
+from benchmarks.synthetic import make_ct_series, write_ct_series, encoder_available
+
+STAGES = ("header_parse", "sort", "sample", "pixel_decode", "rescale", "windowing", "context")
+
+
+def parse_files(blobs):
+    """Stage 1: what /api/ct/process does with each uploaded file."""
+    return [{'type': 'dicom', 'data': pydicom.dcmread(io.BytesIO(data)), 'name': name} for name, data in blobs]
+
+
+def run_stages(blobs, selection, image_token_budget):
+    """Run the DICOM path stage by stage. Yields (stage, callable) so callers can wrap each one."""
+    # Content selection decodes pixel_array, which pydicom caches on the dataset; selecting on
+    # a copy parsed up front (untimed) keeps that cost in sample and a cold decode in pixel_decode
+    state = {"probe": sorted(parse_files(blobs), key=ct_service.dicom_sort_key)}
+
+    def header_parse():
+        state["items"] = parse_files(blobs)
+
+    def sort():
+        state["sorted"] = sorted(state["items"], key=ct_service.dicom_sort_key)
+
+    def sample():
+        chosen = ct_service.choose_slices(state["probe"], selection, image_token_budget)
+        position = {id(item): i for i, item in enumerate(state["probe"])}
+        state["sampled"] = [state["sorted"][position[id(item)]] for item in chosen]
+
+    def pixel_decode():
+        state["pixels"] = [item['data'].pixel_array for item in state["sampled"]]
+
+    def rescale():
+        state["hu"] = [ct_service.to_hounsfield(px, item['data']) for px, item in zip(state["pixels"], state["sampled"])]
+
+    def windowing():
+        state["rgb"] = [ct_service.apply_windowing(hu) for hu in state["hu"]]
+
+    def context():
+        state["pixels_rgb"] = [ct_service.to_context_pixels(rgb) for rgb in state["rgb"]]
+
+    return list(zip(STAGES, (header_parse, sort, sample, pixel_decode, rescale, windowing, context))), state
+
+
+def time_stages(blobs, selection, image_token_budget, repeats):
+    timings = {stage: [] for stage in STAGES}
+    timings["end_to_end"] = []
+    for _ in range(repeats):
+        stages, _state = run_stages(blobs, selection, image_token_budget)
+        for stage, fn in stages:
+            t0 = time.perf_counter()
+            fn()
+            timings[stage].append(time.perf_counter() - t0)
+        items = parse_files(blobs)
+        t0 = time.perf_counter()
+        ct_service.process_mixed_files(items, selection, image_token_budget)
+        timings["end_to_end"].append(time.perf_counter() - t0)
+    return {stage: round(statistics.median(values) * 1000, 3) for stage, values in timings.items()}
+
+
+def memory_stages(blobs, selection, image_token_budget):
+    """Peak traced allocation (MB) while each stage runs; results of earlier stages stay alive, as in production."""
+    peaks = {}
+    tracemalloc.start()
+    try:
+        stages, _state = run_stages(blobs, selection, image_token_budget)
+        for stage, fn in stages:
+            tracemalloc.reset_peak()
+            base, _ = tracemalloc.get_traced_memory()
+            fn()
+            _, peak = tracemalloc.get_traced_memory()
+            peaks[stage] = round((peak - base) / 2**20, 2)
+        _, overall = tracemalloc.get_traced_memory()
+        peaks["overall"] = round(overall / 2**20, 2)
+    finally:
+        tracemalloc.stop()
+    return peaks
+
+
+def load_corpus(config, corpus_dir):
+    kwargs = dict(
+        n_slices=config["slices"], rows=config["matrix"], cols=config["matrix"],
+        slope=config["slope"], intercept=config["intercept"],
+        signed=config["dtype"] == "int16", transfer_syntax=config["syntax"],
+    )
+    if not corpus_dir:
+        return make_ct_series(**kwargs)
+    series_dir = os.path.join(corpus_dir, "{slices}x{matrix}_{dtype}_{syntax}_s{slope}_i{intercept}".format(**config))
+    if not os.path.isdir(series_dir):
+        write_ct_series(series_dir, **kwargs)
+    blobs = []
+    for name in sorted(os.listdir(series_dir)):
+        with open(os.path.join(series_dir, name), "rb") as f:
+            blobs.append((name, f.read()))
+    return blobs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--slices", default="50,200,1000")
+    parser.add_argument("--matrix", default="512")
+    parser.add_argument("--dtypes", default="int16,uint16")
+    parser.add_argument("--syntaxes", default="explicit,rle", help="explicit,implicit,deflate,rle,j2k,jpegls")
+    parser.add_argument("--rescale", default="1:-1024", help="Comma separated slope:intercept pairs.")
+    parser.add_argument("--selection", default=ct_service.DEFAULT_SELECTION, choices=("content", "uniform"))
+    parser.add_argument("--image-token-budget", type=int, default=None)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--result-cache", action="store_true", help="Leave the series result cache on (end_to_end hits it).")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the tracemalloc pass.")
+    parser.add_argument("--corpus-dir", help="Persist the corpus here and read it back from disk.")
+    parser.add_argument("--output", help="Write the JSON report here (default: stdout).")
+    args = parser.parse_args()
+
+    if not args.result_cache:
+        ct_service.CT_RESULT_CACHE_MAX_ENTRIES = 0
+
+    rescales = [tuple(float(v) for v in pair.split(":")) for pair in args.rescale.split(",")]
+    syntaxes = []
+    for syntax in args.syntaxes.split(","):
+        if encoder_available(syntax):
+            syntaxes.append(syntax)
+        else:
+            print(f"[ct_bench] skipping {syntax}: no encoder plugin installed", file=sys.stderr)
+
+    results = []
+    grid = itertools.product(
+        [int(v) for v in args.slices.split(",")],
+        [int(v) for v in args.matrix.split(",")],
+        args.dtypes.split(","),
+        rescales,
+        syntaxes,
+    )
+    for slices, matrix, dtype, (slope, intercept), syntax in grid:
+        config = {"slices": slices, "matrix": matrix, "dtype": dtype, "slope": slope, "intercept": intercept, "syntax": syntax}
+        blobs = load_corpus(config, args.corpus_dir)
+        entry = {
+            "config": config,
+            "upload_mb": round(sum(len(b) for _, b in blobs) / 2**20, 2),
+            "time_ms": time_stages(blobs, args.selection, args.image_token_budget, args.repeats),
+        }
+        if not args.no_memory:
+            entry["peak_mb"] = memory_stages(blobs, args.selection, args.image_token_budget)
+        results.append(entry)
+        t = entry["time_ms"]
+        print(f"[ct_bench] {slices:5d}x{matrix} {dtype:6s} {syntax:8s} " +
+              " ".join(f"{s}={t[s]:.1f}" for s in STAGES) + f" | e2e={t['end_to_end']:.1f} ms", file=sys.stderr)
+
+    report = {
+        "meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "pydicom": pydicom.__version__, "args": vars(args)},
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Dynamic vs compiled static-cache decoding (解码步基准, see compiled_decode.py).
+
+Times greedy generation with the default DynamicCache and with StaticDecoder
+(bucketed StaticCache + torch.compile'd decode step) on the same model and
+prompts. Per-token latency is taken from timestamps recorded by a stopping
+criterion (called once per generated token); the steady state is the median
+interval after the first few tokens, so prefill and warmup are excluded.
+
+Without --model a small randomly initialised Gemma 3 with MedGemma's layer
+layout (5 sliding-window layers per global layer) is built, which is enough to
+measure per-step overhead on CPU.
+
+Run from myapp/backend:
+    python -m benchmarks.decode_bench --prompts 100,700 --tokens 64
+    python -m benchmarks.decode_bench --model /path/to/medgemma-1.5-4b-it --buckets 4096 --output decode.json
+"""
+import sys
+import json
+import time
+import argparse
+import statistics
+
+import torch
+from transformers import AutoModelForImageTextToText, Gemma3Config, Gemma3ForConditionalGeneration, StoppingCriteria
+
+import compiled_decode
+
+SKIP_TOKENS = 4  # leading intervals left out of the steady state
+
+
+class TokenClock(StoppingCriteria):
+    def __init__(self):
+        self.stamps = []
+
+    def __call__(self, input_ids, scores, **kwargs):
+        self.stamps.append(time.perf_counter())
+        return False
+
+    def steady_ms(self):
+        intervals = [(b - a) * 1000 for a, b in zip(self.stamps, self.stamps[1:])][SKIP_TOKENS:]
+        return statistics.median(intervals) if intervals else None
+
+
+def tiny_model(layers, hidden, sliding_window, vocab):
+    config = Gemma3Config(
+        text_config=dict(hidden_size=hidden, num_hidden_layers=layers, num_attention_heads=4, num_key_value_heads=1,
+                         head_dim=hidden // 4, intermediate_size=hidden * 4, sliding_window=sliding_window,
+                         vocab_size=vocab),
+        vision_config=dict(hidden_size=64, num_hidden_layers=1, num_attention_heads=2, intermediate_size=128,
+                           image_size=56, patch_size=14),
+    )
+    torch.manual_seed(0)
+    return Gemma3ForConditionalGeneration(config).eval()
+
+
+def run(model, prompt_len, tokens, **kwargs):
+    input_ids = torch.randint(10, 1000, (1, prompt_len), generator=torch.Generator().manual_seed(prompt_len)).to(model.device)
+    clock = TokenClock()
+    start = time.perf_counter()
+    with torch.no_grad():
+        output = model.generate(input_ids=input_ids, attention_mask=torch.ones_like(input_ids), max_new_tokens=tokens,
+                                min_new_tokens=tokens, do_sample=False, stopping_criteria=[clock], **kwargs)
+    return {"total_ms": round((time.perf_counter() - start) * 1000, 1), "ms_per_token": clock.steady_ms()}, output
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", help="Checkpoint to load (default: tiny random Gemma 3).")
+    parser.add_argument("--layers", type=int, default=6)
+    parser.add_argument("--hidden", type=int, default=256)
+    parser.add_argument("--sliding-window", type=int, default=512)
+    parser.add_argument("--vocab", type=int, default=32000,
+                        help="Tiny model vocabulary; MedGemma's 262k makes the LM head dominate a tiny model.")
+    parser.add_argument("--prompts", default="100,700", help="Prompt lengths in tokens.")
+    parser.add_argument("--tokens", type=int, default=64, help="New tokens per run.")
+    parser.add_argument("--buckets", default="1024", help="Static cache buckets.")
+    parser.add_argument("--repeats", type=int, default=2)
+    parser.add_argument("--output", help="Write the JSON report here (default: stdout).")
+    args = parser.parse_args()
+
+    if args.model:
+        model = AutoModelForImageTextToText.from_pretrained(args.model, torch_dtype="auto").eval()
+    else:
+        model = tiny_model(args.layers, args.hidden, args.sliding_window, args.vocab)
+    decoder = compiled_decode.StaticDecoder(model, [int(v) for v in args.buckets.split(",")])
+    decoder.warmup()
+
+    results = []
+    for prompt_len in [int(v) for v in args.prompts.split(",")]:
+        entry = {"prompt_tokens": prompt_len, "new_tokens": args.tokens}
+        for _ in range(args.repeats):  # keep the best run of each mode
+            dynamic, dynamic_out = run(model, prompt_len, args.tokens)
+            slot = decoder.acquire(prompt_len + args.tokens)
+            if slot is None:
+                raise SystemExit(f"No bucket holds {prompt_len + args.tokens} tokens: {decoder.buckets}")
+            try:
+                static, static_out = run(model, prompt_len, args.tokens, **decoder.generate_kwargs(slot))
+            finally:
+                decoder.release(slot)
+            for name, result in (("dynamic", dynamic), ("static", static)):
+                if name not in entry or result["ms_per_token"] < entry[name]["ms_per_token"]:
+                    entry[name] = result
+            entry["bucket"] = slot.bucket
+            entry["outputs_equal"] = bool(torch.equal(dynamic_out, static_out))
+        entry["speedup"] = round(entry["dynamic"]["ms_per_token"] / entry["static"]["ms_per_token"], 2)
+        results.append(entry)
+        print(f"[decode_bench] prompt={prompt_len} dynamic={entry['dynamic']['ms_per_token']:.2f} ms/token "
+              f"static={entry['static']['ms_per_token']:.2f} ms/token x{entry['speedup']}", file=sys.stderr)
+
+    report = {
+        "meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "torch": torch.__version__,
+                 "torch_threads": torch.get_num_threads(), "device": str(model.device), "args": vars(args),
+                 "static_decode": decoder.status()},
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
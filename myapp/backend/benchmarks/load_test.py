@@ -0,0 +1,373 @@
+"""
+End-to-end load test for the MedGemma API (端到端压测).
+
+Starts app.py under uvicorn with a pluggable engine (the fixed-latency stub by
+default), drives concurrent /api/chat, /api/detect, /api/ct/process and CT-chat
+load with realistic payloads, and writes a JSON report (TTFT, inter-chunk
+latency, throughput, p50/p95/p99, status codes) that can be diffed across commits.
+
+A request only counts as successful when it returned 200 and, for streams, its
+last NDJSON line / SSE event is not an error: errors inside a 200 stream are
+counted like HTTP errors. The exit status is 1 when any scenario had errors.
+
+Run from myapp/backend:
+    python -m benchmarks.load_test --requests 40 --concurrency 4 --output bench.json
+    python -m benchmarks.load_test --baseline bench_old.json       # print deltas
+    python -m benchmarks.load_test --engine real                  # MEDGEMMA_MODEL_ID=<tiny model>
+    python -m benchmarks.load_test --url http://127.0.0.1:8000    # existing server
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import argparse
+import subprocess
+import threading
+import statistics
+import http.client
+from collections import Counter
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.synthetic import make_ct_series, make_radiograph
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUB_ENGINE = "benchmarks.stub_engine:StubEngine"
+SCENARIOS = ("chat", "detect", "ct_process", "ct_chat")
+
+
+# --- Payloads ---
+
+def chat_payload(n_images, n_turns, max_tokens, image):
+    """Multi-turn history: images in the earlier user turns, text question last."""
+    messages = []
+    for turn in range(n_turns):
+        content = []
+        if turn < n_images:
+            content.append({"type": "image", "image": image})
+        content.append({"type": "text", "text": f"第 {turn + 1} 轮：请描述这张胸片的主要发现，并给出鉴别诊断。"})
+        messages.append({"role": "user", "content": content})
+        if turn < n_turns - 1:
+            messages.append({"role": "model", "content": [{"type": "text", "text": "双肺纹理清晰，心影大小正常。" * 8}]})
+    return {"messages": messages, "config": {"max_tokens": max_tokens, "temperature": 0.7, "context_window": 8192}}
+
+
+def detect_payload(image):
+    return {"messages": [{"role": "user", "content": [
+        {"type": "image", "image": image},
+        {"type": "text", "text": "Analyze this image for lesions."},
+    ]}]}
+
+
+def ct_chat_payload(max_tokens):
+    return {"messages": [{"role": "user", "content": [{"type": "text", "text": "详细分析这组 CT 影像。"}]}],
+            "config": {"max_tokens": max_tokens, "temperature": 0.2, "use_ct_context": True}}
+
+
+def multipart_body(files):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, data in files:
+        parts.append(
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"files\"; filename=\"{name}\"\r\n"
+            f"Content-Type: application/dicom\r\n\r\n".encode("utf-8") + data + b"\r\n"
+        )
+    parts.append(f"--{boundary}--\r\n".encode("utf-8"))
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+# --- HTTP driver ---
+
+def stream_error(body: bytes, framing: str):
+    """Why a 200 streaming response still failed (None: it did not), from its last line / event."""
+    text = body.decode("utf-8", errors="replace").strip()
+    if framing == "ndjson":
+        lines = text.splitlines()
+        if not lines:
+            return "empty_stream"
+        try:
+            last = json.loads(lines[-1])
+        except ValueError:
+            return "truncated_stream"
+        if last.get("type") == "error":
+            return f"stream_error:{last.get('reason') or 'error'}"
+        return None if last.get("type") == "done" else "truncated_stream"
+    if framing == "sse":
+        events = [frame for frame in text.split("\n\n") if frame.strip()]
+        if not events:
+            return "empty_stream"
+        fields = dict(line.split(": ", 1) for line in events[-1].splitlines() if ": " in line)
+        if fields.get("event") != "usage":
+            return "truncated_stream"
+        reason = json.loads(fields.get("data", "{}")).get("stop_reason")
+        return f"stream_error:{reason}" if reason in ("error", "timeout") else None
+    return None
+
+
+class Target:
+    def __init__(self, url):
+        parsed = urlparse(url)
+        self.host, self.port = parsed.hostname, parsed.port or 80
+
+    def request(self, path, body, content_type, stream=None, timeout=600):
+        """
+        POST and time the response. Returns a per-request sample dict.
+        stream: None (one JSON body), "sse" or "ndjson"; streams are read chunk by chunk
+        and checked for an in-band error at the end.
+        """
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+        start = time.perf_counter()
+        sample = {"ok": False, "status": None, "latency": None, "ttft": None, "gaps": [], "chunks": 0, "bytes": 0}
+        headers = {"Content-Type": content_type}
+        if stream == "sse":
+            headers["Accept"] = "text/event-stream"
+        try:
+            conn.request("POST", path, body=body, headers=headers)
+            resp = conn.getresponse()
+            sample["status"] = resp.status
+            last = None
+            received = []
+            while True:
+                chunk = resp.read1(65536) if stream else resp.read()
+                if not chunk:
+                    break
+                now = time.perf_counter()
+                if sample["ttft"] is None:
+                    sample["ttft"] = now - start
+                elif last is not None:
+                    sample["gaps"].append(now - last)
+                last = now
+                received.append(chunk)
+                sample["chunks"] += 1
+                sample["bytes"] += len(chunk)
+                if not stream:
+                    break
+            error = stream_error(b"".join(received), stream) if resp.status == 200 else None
+            if error:
+                sample["error"] = error
+            sample["ok"] = resp.status == 200 and error is None
+        except Exception as e:
+            sample["error"] = str(e)
+        finally:
+            sample["latency"] = time.perf_counter() - start
+            conn.close()
+        return sample
+
+    def get_json(self, path, timeout=5):
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+        try:
+            conn.request("GET", path)
+            return json.loads(conn.getresponse().read())
+        finally:
+            conn.close()
+
+
+def percentiles(values):
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def pct(p):
+        k = (len(ordered) - 1) * p
+        lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+        return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+    return {
+        "mean": round(statistics.fmean(ordered) * 1000, 3),
+        "p50": round(pct(0.50) * 1000, 3),
+        "p95": round(pct(0.95) * 1000, 3),
+        "p99": round(pct(0.99) * 1000, 3),
+        "max": round(ordered[-1] * 1000, 3),
+    }
+
+
+def outcome(sample) -> str:
+    """HTTP status, the in-band error of a 200 stream, or connection_error."""
+    if sample["status"] is None:
+        return "connection_error"
+    if sample["status"] == 200 and not sample["ok"]:
+        return sample["error"]
+    return str(sample["status"])
+
+
+def run_scenario(name, make_request, n_requests, concurrency):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        samples = list(pool.map(lambda _: make_request(), range(n_requests)))
+    wall = time.perf_counter() - started
+    ok = [s for s in samples if s["ok"]]
+    chunks = sum(s["chunks"] for s in ok)
+    outcomes = Counter(outcome(s) for s in samples)
+    return {
+        "requests": n_requests,
+        "concurrency": concurrency,
+        "errors": n_requests - len(ok),
+        "error_rate": round((n_requests - len(ok)) / n_requests, 4) if n_requests else 0.0,
+        "status_codes": dict(sorted(outcomes.items())),
+        "wall_s": round(wall, 3),
+        "throughput_rps": round(len(ok) / wall, 3) if wall else None,
+        "chunks_per_s": round(chunks / wall, 3) if wall else None,
+        "latency_ms": percentiles([s["latency"] for s in ok]),
+        "ttft_ms": percentiles([s["ttft"] for s in ok if s["ttft"] is not None]),
+        "inter_chunk_ms": percentiles([g for s in ok for g in s["gaps"]]),
+        "response_bytes_mean": round(statistics.fmean([s["bytes"] for s in ok]), 1) if ok else None,
+    }
+
+
+# --- Server management ---
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(engine, workers, replicas):
+    env = dict(os.environ)
+    if engine == "stub":
+        env["MEDGEMMA_ENGINE"] = STUB_ENGINE
+    if replicas:
+        env["MEDGEMMA_REPLICAS"] = replicas
+    procs = []
+    if workers > 1:
+        model_port = free_port()
+        env["MEDGEMMA_MODEL_SERVER"] = f"127.0.0.1:{model_port}"
+        procs.append(subprocess.Popen([sys.executable, "model_server.py", "--address", env["MEDGEMMA_MODEL_SERVER"]],
+                                      cwd=BACKEND_DIR, env=env))
+    port = free_port()
+    procs.append(subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env))
+    url = f"http://127.0.0.1:{port}"
+    target = Target(url)
+    deadline = time.time() + 600
+    while time.time() < deadline:
+        try:
+            if target.get_json("/api/status").get("model_loaded"):
+                return url, procs
+        except Exception:
+            pass
+        time.sleep(0.5)
+    stop_server(procs)
+    raise RuntimeError("Server did not become ready.")
+
+
+def stop_server(procs):
+    for proc in procs:
+        proc.terminate()
+    for proc in procs:
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, text=True).strip()
+    except Exception:
+        return None
+
+
+def compare(report, baseline):
+    """Print relative change of the headline metrics against a previous report."""
+    for name, cur in report["scenarios"].items():
+        old = baseline.get("scenarios", {}).get(name)
+        if not old:
+            continue
+        for metric in ("latency_ms", "ttft_ms", "inter_chunk_ms"):
+            for key in ("p50", "p95", "p99"):
+                a = (old.get(metric) or {}).get(key)
+                b = (cur.get(metric) or {}).get(key)
+                if a and b:
+                    print(f"{name:11s} {metric:15s} {key}: {a:10.2f} -> {b:10.2f} ms ({(b - a) / a * 100:+.1f}%)")
+        a, b = old.get("throughput_rps"), cur.get("throughput_rps")
+        if a and b:
+            print(f"{name:11s} throughput_rps     : {a:10.3f} -> {b:10.3f}    ({(b - a) / a * 100:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="Benchmark an already running server instead of starting one.")
+    parser.add_argument("--engine", choices=("stub", "real"), default="stub")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers (>1 starts a model server).")
+    parser.add_argument("--replicas", default="", help="MEDGEMMA_REPLICAS for the started server.")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=20, help="Requests per scenario.")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--max-tokens", type=int, default=128)
+    parser.add_argument("--history-images", type=int, default=3)
+    parser.add_argument("--history-turns", type=int, default=4)
+    parser.add_argument("--ct-slices", type=int, default=150)
+    parser.add_argument("--ct-size", type=int, default=512)
+    parser.add_argument("--output", help="Write the JSON report here (default: stdout).")
+    parser.add_argument("--baseline", help="Previous JSON report to compare against.")
+    args = parser.parse_args()
+
+    scenarios = [s for s in args.scenarios.split(",") if s]
+    image = make_radiograph()
+    chat_body = json.dumps(chat_payload(args.history_images, args.history_turns, args.max_tokens, image)).encode("utf-8")
+    detect_body = json.dumps(detect_payload(image)).encode("utf-8")
+    ct_chat_body = json.dumps(ct_chat_payload(args.max_tokens)).encode("utf-8")
+    ct_body, ct_type = (None, None)
+    if "ct_process" in scenarios or "ct_chat" in scenarios:
+        ct_body, ct_type = multipart_body(make_ct_series(args.ct_slices, args.ct_size, args.ct_size))
+
+    procs = []
+    url = args.url
+    if not url:
+        url, procs = start_server(args.engine, args.workers, args.replicas)
+    target = Target(url)
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "engine": args.engine if not args.url else "external",
+            "workers": args.workers,
+            "replicas": args.replicas or None,
+            "args": vars(args),
+        },
+        "scenarios": {},
+    }
+    try:
+        requests = {
+            "chat": lambda: target.request("/api/chat", chat_body, "application/json", stream="sse"),
+            "detect": lambda: target.request("/api/detect", detect_body, "application/json"),
+            "ct_process": lambda: target.request("/api/ct/process", ct_body, ct_type, stream="ndjson"),
+            "ct_chat": lambda: target.request("/api/chat", ct_chat_body, "application/json", stream="sse"),
+        }
+        for name in scenarios:
+            if name == "ct_chat":
+                # CT chat needs a cached series on the server
+                setup = target.request("/api/ct/process", ct_body, ct_type, stream="ndjson")
+                if not setup["ok"]:
+                    print(f"[bench] ct_chat setup failed: {setup['status']} {setup.get('error', '')}", file=sys.stderr)
+            result = report["scenarios"][name] = run_scenario(name, requests[name], args.requests, args.concurrency)
+            flag = f"  ERRORS {result['errors']}/{result['requests']} {result['status_codes']}" if result["errors"] else ""
+            print(f"[bench] {name}: {json.dumps(result['latency_ms'])}{flag}", file=sys.stderr)
+    finally:
+        stop_server(procs)
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            compare(report, json.load(f))
+
+    failed = [name for name, result in report["scenarios"].items() if result["errors"]]
+    if failed:
+        print(f"[bench] FAILED: errors in {', '.join(failed)}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Slow vs batched image preprocessing (图像预处理基准, see image_preprocess.py).
+
+Builds CT-context stacks from the chest phantom (windowed exactly like
+ct_service does) and runs both the slow Gemma 3 image processor and
+BatchedImageProcessor on them, reporting time and the largest per-pixel
+difference. The image processor comes from MEDGEMMA_MODEL_ID / --model when
+given, otherwise the MedGemma defaults (896x896, mean = std = 0.5) are used.
+
+Run from myapp/backend:
+    python -m benchmarks.preprocess_bench --slices 1,16,85 --matrix 512
+    python -m benchmarks.preprocess_bench --model google/medgemma-1.5-4b-it --output preprocess.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+import torch
+from transformers import AutoImageProcessor, Gemma3ImageProcessor
+
+import ct_service
+import image_preprocess
+from benchmarks.synthetic import phantom_slices
+
+
+def load_slow_processor(model_id):
+    if model_id:
+        return AutoImageProcessor.from_pretrained(model_id, use_fast=False)
+    return Gemma3ImageProcessor(size={"height": 896, "width": 896}, image_mean=[0.5] * 3, image_std=[0.5] * 3)
+
+
+def ct_stack(n_slices, matrix):
+    return [ct_service.to_context_pixels(ct_service.apply_windowing(hu))
+            for hu in phantom_slices(n_slices, matrix, matrix)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--slices", default="1,16,85")
+    parser.add_argument("--matrix", default="512")
+    parser.add_argument("--model", default=os.environ.get("MEDGEMMA_MODEL_ID"))
+    parser.add_argument("--output", help="Write the JSON report here (default: stdout).")
+    args = parser.parse_args()
+
+    batched = image_preprocess.BatchedImageProcessor(load_slow_processor(args.model))
+    results = []
+    for matrix in [int(v) for v in args.matrix.split(",")]:
+        for n_slices in [int(v) for v in args.slices.split(",")]:
+            entry = {"slices": n_slices, "matrix": matrix,
+                     **image_preprocess.compare_with_slow(batched, ct_stack(n_slices, matrix))}
+            results.append(entry)
+            print(f"[preprocess_bench] {n_slices:4d}x{matrix} slow={entry['slow_ms']:.1f} ms "
+                  f"fast={entry['fast_ms']:.1f} ms max_diff={entry['max_level_diff']} levels", file=sys.stderr)
+
+    report = {
+        "meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "torch_threads": torch.get_num_threads(),
+                 "processor": type(batched.slow).__name__, "args": vars(args)},
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
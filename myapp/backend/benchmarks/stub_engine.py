@@ -0,0 +1,174 @@
+"""
+Fixed-latency stand-in for the MedGemma model, used by the benchmark harness.
+
+StubEngine is a MedGemmaEngine whose load_model() installs a fake processor and
+model instead of downloading weights, so every code path above the model
+(request parsing, context management, streaming thread, TextIteratorStreamer,
+detection JSON parsing, CT injection) runs unchanged. Latencies are configurable:
+
+    MEDGEMMA_STUB_TOKEN_MS          per decoded token (default 20)
+    MEDGEMMA_STUB_PREFILL_MS_PER_1K per 1000 prompt tokens (default 40)
+    MEDGEMMA_STUB_IMAGE_TOKENS      prompt tokens per image (default 256)
+
+For a "tiny real model" run, leave MEDGEMMA_ENGINE unset and point
+MEDGEMMA_MODEL_ID at a small random checkpoint instead.
+"""
+import os
+import re
+import time
+from types import SimpleNamespace
+
+import torch
+from transformers import BatchFeature
+
+import memory_planner
+from model_engine import MedGemmaEngine
+
+CHAT_RESPONSE = (
+    "<unused94>thought\nThe image shows the chest in a standard projection. "
+    "Lung fields, mediastinum and bony structures are reviewed in turn.<unused95>"
+    "**Findings**: 双肺纹理清晰，未见明确实变影。 The cardiomediastinal silhouette is within normal limits. "
+    "No pleural effusion or pneumothorax is seen.\n\n**Impression**: No acute cardiopulmonary abnormality.\n"
+)
+
+DETECTION_RESPONSE = (
+    "<unused94>thought\nScan the lung fields for focal opacities, then localize them.<unused95>"
+    "```json\n[{\"label\": \"肺结节\", \"box_2d\": [420, 310, 480, 370], "
+    "\"description\": \"右上肺见一类圆形结节影，边界清楚，直径约 8mm。\"}]\n```"
+)
+
+
+def _split_pieces(text):
+    # Word-ish pieces (leading whitespace attached) and single CJK characters / special tokens.
+    return re.findall(r"<unused9[45]>|\s*[一-鿿，。]|\s*[^\s一-鿿，。<]+|\s+|<", text)
+
+
+class StubTokenizer:
+    def __init__(self, texts):
+        self.special = ["<pad>", "<eos>", "<bos>", "<end_of_turn>"]
+        pieces = []
+        for text in texts:
+            pieces.extend(_split_pieces(text))
+        self.vocab = self.special + sorted(set(pieces))
+        self.index = {p: i for i, p in enumerate(self.vocab)}
+        self.pad_token_id, self.eos_token_id, self.bos_token_id = 0, 1, 2
+
+    def encode(self, text):
+        return [self.index[p] for p in _split_pieces(text)]
+
+    def convert_tokens_to_ids(self, token):
+        return self.index.get(token, 0)
+
+    def decode(self, ids, skip_special_tokens=False, **kwargs):
+        if hasattr(ids, "tolist"):
+            ids = ids.tolist()
+        pieces = [self.vocab[i] for i in ids if not (skip_special_tokens and i < len(self.special))]
+        return "".join(pieces)
+
+
+class StubProcessor:
+    def __init__(self, tokenizer, image_tokens):
+        self.tokenizer = tokenizer
+        self.image_tokens = image_tokens
+
+    def apply_chat_template(self, messages, add_generation_prompt=True, tokenize=True, return_dict=True,
+                            return_tensors="pt", **kwargs):
+        # Prompt length: ~1 token per 3 characters of text, fixed cost per image.
+        conversations = messages if messages and isinstance(messages[0], list) else [messages]
+        lengths = []
+        for conv in conversations:
+            n = 1
+            for msg in conv:
+                content = msg["content"]
+                if isinstance(content, str):
+                    n += len(content) // 3
+                    continue
+                for item in content:
+                    if item.get("type") == "image":
+                        n += self.image_tokens
+                    else:
+                        n += len(item.get("text", "")) // 3
+            lengths.append(n)
+        width = max(lengths)
+        input_ids = torch.full((len(lengths), width), self.tokenizer.bos_token_id, dtype=torch.long)
+        attention_mask = torch.zeros_like(input_ids)
+        for row, n in enumerate(lengths):
+            attention_mask[row, width - n:] = 1
+        return BatchFeature({"input_ids": input_ids, "attention_mask": attention_mask})
+
+    def decode(self, ids, skip_special_tokens=False, **kwargs):
+        return self.tokenizer.decode(ids, skip_special_tokens=skip_special_tokens)
+
+    def batch_decode(self, ids, skip_special_tokens=False, **kwargs):
+        return [self.tokenizer.decode(row, skip_special_tokens=skip_special_tokens) for row in ids]
+
+
+class StubModel:
+    """Replays a canned response token by token with fixed prefill / decode latency."""
+    def __init__(self, tokenizer, token_ms, prefill_ms_per_1k):
+        self.tokenizer = tokenizer
+        self.token_ms = token_ms
+        self.prefill_ms_per_1k = prefill_ms_per_1k
+        self.device = torch.device("cpu")
+        self.dtype = torch.float32
+        # Shape of a model this small, so the memory planner budgets what the stub could plausibly hold
+        text_config = SimpleNamespace(num_hidden_layers=2, num_attention_heads=2, num_key_value_heads=1, head_dim=32,
+                                      hidden_size=64, intermediate_size=256, vocab_size=len(tokenizer.vocab),
+                                      sliding_window=None)
+        vision_config = SimpleNamespace(hidden_size=32, intermediate_size=128, image_size=224, patch_size=14)
+        self.config = SimpleNamespace(eos_token_id=tokenizer.eos_token_id, vocab_size=len(tokenizer.vocab),
+                                      text_config=text_config, vision_config=vision_config)
+        self.chat_ids = tokenizer.encode(CHAT_RESPONSE)
+        self.detection_ids = tokenizer.encode(DETECTION_RESPONSE)
+
+    def __call__(self, input_ids=None, **kwargs):
+        # Health-check / prefill probe: one forward pass worth of latency.
+        time.sleep(self.prefill_ms_per_1k * input_ids.shape[-1] / 1e6)
+        return SimpleNamespace(logits=torch.zeros(input_ids.shape[0], input_ids.shape[-1], len(self.tokenizer.vocab)))
+
+    def generate(self, input_ids=None, attention_mask=None, max_new_tokens=1024, streamer=None,
+                 stopping_criteria=None, logits_processor=None, repetition_penalty=None, **kwargs):
+        # Detection requests run with a repetition penalty; chat requests do not.
+        script = self.detection_ids if repetition_penalty else self.chat_ids
+        if streamer is not None:
+            streamer.put(input_ids.cpu())
+
+        time.sleep(self.prefill_ms_per_1k * input_ids.shape[-1] / 1e6)
+
+        output = input_ids
+        vocab_size = len(self.tokenizer.vocab)
+        for step in range(max_new_tokens):
+            time.sleep(self.token_ms / 1000.0)
+            # Scores favour the scripted token, so logits processors still apply.
+            scores = torch.zeros(output.shape[0], vocab_size)
+            scores[:, script[step % len(script)]] = 10.0
+            if logits_processor is not None:
+                scores = logits_processor(output, scores)
+            next_tokens = scores.argmax(dim=-1, keepdim=True)
+            output = torch.cat([output, next_tokens], dim=-1)
+            if streamer is not None:
+                streamer.put(next_tokens[0].cpu())
+            if stopping_criteria is not None and any(bool(torch.as_tensor(c(output, scores)).any()) for c in stopping_criteria):
+                break
+            if step + 1 == len(script) and repetition_penalty:
+                break
+        if streamer is not None:
+            streamer.end()
+        return output
+
+
+class StubEngine(MedGemmaEngine):
+    """MedGemmaEngine with the stub model/processor; accepts the pool's constructor arguments."""
+    def __init__(self, use_quantization=None, device=None, cpu_affinity=None, model_id=None, quantization=None):
+        super().__init__(use_quantization=False, device=device, cpu_affinity=cpu_affinity, model_id=model_id or "stub",
+                         quantization=quantization)
+        self.token_ms = float(os.environ.get("MEDGEMMA_STUB_TOKEN_MS", "20"))
+        self.prefill_ms_per_1k = float(os.environ.get("MEDGEMMA_STUB_PREFILL_MS_PER_1K", "40"))
+        self.image_tokens = int(os.environ.get("MEDGEMMA_STUB_IMAGE_TOKENS", "256"))
+
+    def load_model(self):
+        tokenizer = StubTokenizer([CHAT_RESPONSE, DETECTION_RESPONSE])
+        self.processor = StubProcessor(tokenizer, self.image_tokens)
+        self.model = StubModel(tokenizer, self.token_ms, self.prefill_ms_per_1k)
+        # Budgeted from the stub's own tiny shape; MEDGEMMA_MEMORY_BUDGET_MB still applies
+        self.memory = memory_planner.for_model(self.model)
@@ -0,0 +1,166 @@
+"""
+Synthetic payloads for benchmarks: chest-like CT phantoms as DICOM files and
+small radiograph-like PNG/JPEG images encoded the way the frontend sends them.
+"""
+import io
+import os
+import base64
+
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import (
+    ExplicitVRLittleEndian, ImplicitVRLittleEndian, DeflatedExplicitVRLittleEndian,
+    RLELossless, JPEG2000Lossless, JPEGLSLossless, generate_uid,
+)
+from PIL import Image
+
+CT_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.2"
+
+# Short names for the transfer syntaxes the corpus can be written with.
+# Pixel-compressed syntaxes beyond RLE need optional encoder plugins
+# (pylibjpeg-openjpeg for JPEG 2000, pyjpegls for JPEG-LS).
+TRANSFER_SYNTAXES = {
+    "explicit": ExplicitVRLittleEndian,
+    "implicit": ImplicitVRLittleEndian,
+    "deflate": DeflatedExplicitVRLittleEndian,
+    "rle": RLELossless,
+    "j2k": JPEG2000Lossless,
+    "jpegls": JPEGLSLossless,
+}
+
+
+def phantom_slices(n_slices, rows=512, cols=512, seed=0):
+    """
+    Yield HU slices (rows, cols) of a chest-like phantom: air outside an elliptical
+    body of soft tissue, two lungs whose size varies along z, a bony ring and mild noise.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[-1:1:rows * 1j, -1:1:cols * 1j]
+    body = (x / 0.85) ** 2 + (y / 0.65) ** 2 <= 1.0
+    ring = body & ((x / 0.78) ** 2 + (y / 0.58) ** 2 > 1.0)
+    for z in range(n_slices):
+        # Lungs grow then shrink along the series (apex -> base)
+        r = 0.05 + 0.3 * np.sin(np.pi * (z + 0.5) / n_slices)
+        lungs = (((x - 0.35) / r) ** 2 + (y / (r * 1.3)) ** 2 <= 1.0) | (((x + 0.35) / r) ** 2 + (y / (r * 1.3)) ** 2 <= 1.0)
+        hu = np.full((rows, cols), -1000.0, dtype=np.float32)
+        hu[body] = 40.0
+        hu[lungs & body] = -820.0
+        hu[ring] = 700.0
+        hu += rng.normal(0, 12, size=(rows, cols)).astype(np.float32)
+        yield hu
+
+
+def phantom_volume(n_slices, rows=512, cols=512, seed=0):
+    """Whole phantom as one (n_slices, rows, cols) float32 HU volume."""
+    return np.stack(list(phantom_slices(n_slices, rows, cols, seed=seed)))
+
+
+def make_ct_slice(hu, index, study_uid, series_uid, slope=1.0, intercept=-1024.0, signed=True,
+                  thickness=1.25, transfer_syntax="explicit"):
+    """
+    Build one CT DICOM dataset from an HU slice using the given rescale, pixel
+    representation (int16 / uint16) and transfer syntax (a TRANSFER_SYNTAXES key).
+    """
+    stored = np.round((hu - intercept) / slope)
+    if signed:
+        stored = np.clip(stored, -32768, 32767).astype(np.int16)
+    else:
+        stored = np.clip(stored, 0, 65535).astype(np.uint16)
+
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = CT_IMAGE_STORAGE
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = Dataset()
+    ds.file_meta = file_meta
+    ds.SOPClassUID = CT_IMAGE_STORAGE
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = series_uid
+    ds.Modality = "CT"
+    ds.PatientName = "Synthetic^Phantom"
+    ds.PatientID = "BENCH0001"
+    ds.InstanceNumber = index + 1
+    ds.SliceLocation = float(-index * thickness)
+    ds.ImagePositionPatient = [0.0, 0.0, float(-index * thickness)]
+    ds.SliceThickness = thickness
+    ds.Rows, ds.Columns = stored.shape
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 1 if signed else 0
+    ds.RescaleSlope = slope
+    ds.RescaleIntercept = intercept
+    ds.PixelData = stored.tobytes()
+
+    uid = TRANSFER_SYNTAXES[transfer_syntax]
+    if uid.is_compressed:
+        ds.compress(uid, generate_instance_uid=False)
+    else:
+        ds.file_meta.TransferSyntaxUID = uid
+    return ds
+
+
+def encoder_available(transfer_syntax):
+    """Whether this environment can write the given transfer syntax."""
+    uid = TRANSFER_SYNTAXES[transfer_syntax]
+    if not uid.is_compressed:
+        return True
+    try:
+        make_ct_slice(np.zeros((8, 8), dtype=np.float32), 0, generate_uid(), generate_uid(), transfer_syntax=transfer_syntax)
+        return True
+    except Exception:
+        return False
+
+
+def dataset_to_bytes(ds):
+    buf = io.BytesIO()
+    try:
+        pydicom.dcmwrite(buf, ds, enforce_file_format=True)
+    except TypeError:
+        # pydicom < 3.0
+        pydicom.dcmwrite(buf, ds, write_like_original=False)
+    return buf.getvalue()
+
+
+def make_ct_series(n_slices=120, rows=512, cols=512, seed=0, **slice_kwargs):
+    """
+    List of (filename, DICOM bytes) for one synthetic CT series, shuffled like a folder upload.
+    slice_kwargs go to make_ct_slice (slope, intercept, signed, transfer_syntax, ...).
+    """
+    study_uid, series_uid = generate_uid(), generate_uid()
+    files = [
+        (f"IM{z + 1:04d}.dcm", dataset_to_bytes(make_ct_slice(hu, z, study_uid, series_uid, **slice_kwargs)))
+        for z, hu in enumerate(phantom_slices(n_slices, rows, cols, seed=seed))
+    ]
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(n_slices)
+    return [files[i] for i in order]
+
+
+def write_ct_series(out_dir, n_slices=120, rows=512, cols=512, seed=0, **slice_kwargs):
+    """Write a synthetic series to out_dir (one .dcm per slice). Returns the file paths."""
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    for name, data in make_ct_series(n_slices, rows, cols, seed=seed, **slice_kwargs):
+        path = os.path.join(out_dir, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        paths.append(path)
+    return paths
+
+
+def make_radiograph(size=768, seed=0, format="PNG"):
+    """Radiograph-like grayscale RGB image encoded as a data URL (what the frontend sends)."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[-1:1:size * 1j, -1:1:size * 1j]
+    img = 60 + 120 * np.exp(-((np.abs(x) - 0.4) ** 2 / 0.05 + y ** 2 / 0.4))
+    img += rng.normal(0, 8, size=img.shape)
+    arr = np.clip(img, 0, 255).astype(np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(arr).convert("RGB").save(buf, format=format)
+    return f"data:image/{format.lower()};base64,{base64.b64encode(buf.getvalue()).decode('utf-8')}"
@@ -0,0 +1,188 @@
+"""
+Request cancellation and deadlines (请求取消与截止时间).
+
+Every chat, detection and CT-processing request carries a CancelToken. It is
+cancelled when the client goes away (the API listens for the disconnect while
+the request waits, runs or streams, see watch_disconnect) or when the request's
+deadline passes, and the work it belongs to stops at its next step:
+
+    memory / detection-lock wait   polled every CANCEL_POLL_S
+    preprocessing stage            before it starts
+    prefill and decode             before every decoder / vision-encoder layer
+                                   (forward pre-hooks, install_hooks) and after
+                                   every decoded token (stopping criteria)
+    CT slice processing            before every slice / slab batch
+    CT map-reduce                  before every batch of chunks
+
+Stopped work is counted once per request in the "cancelled" metric
+(kind, reason = client_disconnected | deadline, stage where it stopped).
+
+    MEDGEMMA_CHAT_DEADLINE_S    default chat deadline in seconds (default 0: none)
+    MEDGEMMA_DETECT_DEADLINE_S  default detection deadline (default 0: none)
+    MEDGEMMA_CT_DEADLINE_S      default CT-processing deadline (default 0: none)
+
+A request's own deadline_s (Config / form field) overrides the default.
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+from metrics import metrics
+
+LOGGER = logging.getLogger("MedGemma")
+
+DEFAULT_DEADLINES = {
+    "chat": float(os.environ.get("MEDGEMMA_CHAT_DEADLINE_S", "0")),
+    "detect": float(os.environ.get("MEDGEMMA_DETECT_DEADLINE_S", "0")),
+    "ct": float(os.environ.get("MEDGEMMA_CT_DEADLINE_S", "0")),
+}
+# How often waits re-check their token
+CANCEL_POLL_S = 0.1
+DEADLINE_NOTICE = "[系统提示: 已超过请求时限，生成已终止。]"
+# Modules whose forward starts with a cancellation check (Gemma 3 text layers, SigLIP layers)
+HOOKED_LAYER_SUFFIXES = ("DecoderLayer", "EncoderLayer")
+
+
+class Cancelled(RuntimeError):
+    """The request was cancelled (client gone) or ran past its deadline."""
+    def __init__(self, reason: str):
+        super().__init__(f"Request cancelled: {reason}")
+        self.reason = reason
+
+
+class CancelToken:
+    """
+    Cancellation state shared by every stage of one request. The deadline is wall-clock
+    (time.time()), so it can be handed to the model-server process as is.
+    """
+    def __init__(self, kind: str = "request", deadline: Optional[float] = None):
+        self.kind = kind
+        self.deadline = deadline
+        self.reason: Optional[str] = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._reclaimed = False
+
+    def cancel(self, reason: str = "client_disconnected") -> bool:
+        """Cancel (the first reason wins); False if it already was."""
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self.reason = reason
+            self._event.set()
+        return True
+
+    @property
+    def cancelled(self) -> bool:
+        if self._event.is_set():
+            return True
+        if self.deadline is not None and time.time() >= self.deadline:
+            self.cancel("deadline")
+            return True
+        return False
+
+    def remaining(self) -> Optional[float]:
+        """Seconds until the deadline (None: no deadline)."""
+        return None if self.deadline is None else max(0.0, self.deadline - time.time())
+
+    def check(self, stage: Optional[str] = None):
+        """Raise Cancelled if cancelled; stage names where the work stopped, for the metric."""
+        if self.cancelled:
+            if stage:
+                self.reclaimed(stage)
+            raise Cancelled(self.reason)
+
+    def reclaimed(self, stage: str):
+        """Count this request's abandoned work as stopped at `stage` (once per request)."""
+        with self._lock:
+            if self._reclaimed:
+                return
+            self._reclaimed = True
+        metrics.incr("cancelled", kind=self.kind, reason=self.reason, stage=stage)
+        LOGGER.info(f"Cancelled {self.kind} request stopped at {stage} ({self.reason}).")
+
+
+def new_token(kind: str, deadline_s: Optional[float] = None) -> CancelToken:
+    """Token for a new request; deadline_s (or the kind's default) <= 0 means no deadline."""
+    if deadline_s is None:
+        deadline_s = DEFAULT_DEADLINES.get(kind, 0)
+    return CancelToken(kind, time.time() + deadline_s if deadline_s and deadline_s > 0 else None)
+
+
+@contextmanager
+def acquire(lock, token: Optional[CancelToken]):
+    """`with lock:` that gives up (Cancelled) once the token is cancelled."""
+    if token is None:
+        with lock:
+            yield
+        return
+    while not lock.acquire(timeout=CANCEL_POLL_S):
+        token.check("queue")
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+# --- Model forward hooks ---
+
+_local = threading.local()
+
+
+@contextmanager
+def active(token: Optional[CancelToken]):
+    """Make `token` the one the calling thread's model forwards check."""
+    previous = getattr(_local, "token", None)
+    _local.token = token
+    try:
+        yield
+    finally:
+        _local.token = previous
+
+
+def _layer_hook(module, args):
+    import torch
+    if torch.compiler.is_compiling():
+        # The compiled decode step is covered by the stopping criteria after each token
+        return
+    token = getattr(_local, "token", None)
+    if token is not None and token.cancelled:
+        raise Cancelled(token.reason)
+
+
+def install_hooks(model) -> int:
+    """Check the active token before every transformer layer of `model`; returns the hooked layer count."""
+    import torch
+    if not isinstance(model, torch.nn.Module) or getattr(model, "_cancellation_hooks", False):
+        return 0
+    count = 0
+    for module in model.modules():
+        if type(module).__name__.endswith(HOOKED_LAYER_SUFFIXES):
+            module.register_forward_pre_hook(_layer_hook)
+            count += 1
+    model._cancellation_hooks = True
+    return count
+
+
+# --- Client connection ---
+
+def watch_disconnect(request, token: CancelToken) -> asyncio.Task:
+    """
+    Cancel `token` as soon as the client disconnects; returns the listening task, which
+    the request cancels once it is done. Start it after the body was read: with the body
+    consumed, the next ASGI message can only be the disconnect. (Request.is_disconnected()
+    peeks without waiting, which the logging middleware's receive wrapper never satisfies.)
+    """
+    async def listen():
+        while True:
+            message = await request.receive()
+            if message["type"] == "http.disconnect":
+                if token.cancel("client_disconnected"):
+                    LOGGER.info(f"Client disconnected; cancelling {token.kind} request.")
+                return
+
+    return asyncio.create_task(listen())
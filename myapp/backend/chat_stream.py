@@ -0,0 +1,240 @@
+"""
+Typed server-sent-events stream for /api/chat (SSE 分类流式输出).
+
+The legacy endpoint writes every decoded fragment straight to the socket as
+text/plain, and the browser re-splits the whole accumulated string on the
+Gemma thought markers after each chunk. Here the split happens once, on the
+server, and fragments are coalesced before they are written:
+
+    event: thought   {"text": ...}   reasoning between <unused94> and <unused95>
+    event: answer    {"text": ...}   visible answer
+    event: notice    {"text": ..., "level": "warning" | "error"}   timeouts / errors / early stops
+    event: usage     {...}           final timing, token counts and stop_reason (always last)
+
+A flush happens when FLUSH_INTERVAL seconds have passed since the first pending
+fragment, when FLUSH_CHARS characters are pending, or when the event type
+changes. The blocking streamer is drained by a helper thread, so waiting for the
+next token no longer blocks the event loop.
+"""
+import json
+import time
+import queue
+import asyncio
+import logging
+import threading
+from typing import List, Tuple, Optional
+
+from cancellation import CancelToken, DEADLINE_NOTICE
+from stop_reasons import DEGENERATION_REASONS, DEGENERATION_NOTICE, stop_reason
+from metrics import metrics
+
+LOGGER = logging.getLogger("MedGemma")
+
+THOUGHT_START = "<unused94>"
+THOUGHT_END = "<unused95>"
+# The model opens its reasoning with "<unused94>thought\n"
+THOUGHT_LABEL = "thought\n"
+# Special tokens that leak through skip_special_tokens=False and are never shown
+DROPPED_TOKENS = ("<eos>", "<end_of_turn>", "<start_of_turn>", "<pad>", "<bos>", "</s>")
+MARKERS = (THOUGHT_START, THOUGHT_END) + DROPPED_TOKENS
+
+FLUSH_INTERVAL = 0.05  # seconds
+FLUSH_CHARS = 256
+
+TIMEOUT_NOTICE = "[系统提示: 模型响应超时，生成已终止。]"
+
+
+class ThoughtClassifier:
+    """
+    Splits decoded fragments into ("thought" | "answer", text) pieces.
+    Markers may be cut across fragments, so a tail that could still become a
+    marker is held back until the next fragment (or finish()).
+    """
+    def __init__(self):
+        self.kind = "answer"
+        self._buffer = ""
+        self._strip_label = False
+
+    def _held_suffix(self, text: str) -> int:
+        """Length of the longest suffix of text that is a proper prefix of a marker."""
+        start = text.rfind("<", max(0, len(text) - max(len(m) for m in MARKERS)))
+        if start < 0:
+            return 0
+        tail = text[start:]
+        return len(tail) if any(m.startswith(tail) and m != tail for m in MARKERS) else 0
+
+    def feed(self, text: str) -> List[Tuple[str, str]]:
+        self._buffer += text
+        pieces = []
+        while self._buffer:
+            if self._strip_label:
+                if self._buffer.startswith(THOUGHT_LABEL):
+                    self._buffer = self._buffer[len(THOUGHT_LABEL):]
+                elif THOUGHT_LABEL.startswith(self._buffer):
+                    break  # wait for the rest of the label
+                self._strip_label = False
+                continue
+            found = [(self._buffer.find(m), m) for m in MARKERS]
+            found = [(i, m) for i, m in found if i >= 0]
+            if found:
+                index, marker = min(found)
+                if index:
+                    pieces.append((self.kind, self._buffer[:index]))
+                self._buffer = self._buffer[index + len(marker):]
+                if marker == THOUGHT_START:
+                    self.kind = "thought"
+                    self._strip_label = True
+                elif marker == THOUGHT_END:
+                    self.kind = "answer"
+                continue
+            held = self._held_suffix(self._buffer)
+            if len(self._buffer) > held:
+                pieces.append((self.kind, self._buffer[:len(self._buffer) - held]))
+                self._buffer = self._buffer[len(self._buffer) - held:]
+            break
+        return pieces
+
+    def finish(self) -> List[Tuple[str, str]]:
+        """Whatever is still held back once the stream has ended."""
+        rest, self._buffer = self._buffer, ""
+        if self._strip_label and THOUGHT_LABEL.startswith(rest):
+            rest = ""
+        return [(self.kind, rest)] if rest else []
+
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _pump(streamer, loop, q: asyncio.Queue):
+    """Drain the blocking streamer on a helper thread into the event loop's queue."""
+    try:
+        for text in streamer:
+            loop.call_soon_threadsafe(q.put_nowait, ("text", text))
+        loop.call_soon_threadsafe(q.put_nowait, ("end", None))
+    except Exception as e:
+        loop.call_soon_threadsafe(q.put_nowait, ("error", e))
+
+
+async def sse_stream(streamer, stopper, cancel_token: Optional[CancelToken] = None,
+                     flush_interval: float = FLUSH_INTERVAL, flush_chars: int = FLUSH_CHARS):
+    """
+    Async generator of SSE frames for one generation (streamer, stopper) pair.
+    cancel_token: the request's token, cancelled by its disconnect watcher (cancellation.watch_disconnect).
+    """
+    loop = asyncio.get_running_loop()
+    q: asyncio.Queue = asyncio.Queue()
+    threading.Thread(target=_pump, args=(streamer, loop, q), daemon=True, name="sse-pump").start()
+
+    classifier = ThoughtClassifier()
+    start_time = time.perf_counter()
+    first_token_time = None
+    chars = {"thought": 0, "answer": 0}
+    fragments = flushes = 0
+    pending_kind, pending, pending_len, deadline = None, [], 0, None
+    finished = False
+    notice = failure = None
+
+    def take(text):
+        """Classify one fragment; returns the frames that became due."""
+        nonlocal pending_kind, pending_len, deadline, first_token_time
+        frames = []
+        if first_token_time is None:
+            first_token_time = time.perf_counter()
+            LOGGER.info(f"Time to First Token (TTFT): {first_token_time - start_time:.4f}s")
+        for piece_kind, piece in classifier.feed(text):
+            if pending_kind is not None and piece_kind != pending_kind:
+                frames.append(flush())
+            pending_kind = piece_kind
+            pending.append(piece)
+            pending_len += len(piece)
+            chars[piece_kind] += len(piece)
+            if deadline is None:
+                deadline = loop.time() + flush_interval
+            if pending_len >= flush_chars:
+                frames.append(flush())
+        return frames
+
+    def flush():
+        nonlocal pending_kind, pending, pending_len, deadline, flushes
+        frame = sse_event(pending_kind, {"text": "".join(pending)})
+        flushes += 1
+        pending_kind, pending, pending_len, deadline = None, [], 0, None
+        return frame
+
+    try:
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - loop.time())
+            try:
+                kind, payload = await asyncio.wait_for(q.get(), timeout)
+            except asyncio.TimeoutError:
+                kind, payload = "flush", None
+
+            if kind == "end":
+                finished = True
+                break
+            if kind == "error":
+                finished = True
+                if isinstance(payload, queue.Empty):
+                    LOGGER.warning("Stream generation timed out.")
+                    notice, failure = {"text": TIMEOUT_NOTICE, "level": "warning"}, "timeout"
+                else:
+                    LOGGER.error(f"Error during stream generation: {payload}", exc_info=payload)
+                    notice, failure = {"text": f"[ERROR: {payload}]", "level": "error"}, "error"
+                break
+
+            if kind == "flush":
+                yield flush()
+            else:
+                fragments += 1
+                for frame in take(payload):
+                    yield frame
+
+            # The watcher owns receive(); a deadline ends the generation itself (stop_reason "deadline")
+            if cancel_token is not None and cancel_token.cancelled and cancel_token.reason == "client_disconnected":
+                LOGGER.info("Client disconnected. Aborting generation.")
+                stopper.abort()
+                break
+
+        for piece_kind, text in classifier.finish():
+            if pending_kind is not None and piece_kind != pending_kind:
+                yield flush()
+            pending_kind = piece_kind
+            pending.append(text)
+            chars[piece_kind] += len(text)
+        if pending:
+            yield flush()
+        info = getattr(stopper, "info", None) or {}
+        reason = failure or stop_reason(info, stopper.aborted)
+        if reason in DEGENERATION_REASONS:
+            notice = {"text": DEGENERATION_NOTICE, "level": "warning"}
+        elif reason == "deadline":
+            notice = {"text": DEADLINE_NOTICE, "level": "warning"}
+        if notice:
+            yield sse_event("notice", notice)
+
+        total = time.perf_counter() - start_time
+        completion_tokens = info.get("completion_tokens", fragments)
+        decode_time = total - (first_token_time - start_time) if first_token_time else 0.0
+        usage = {
+            "ttft_ms": round((first_token_time - start_time) * 1000, 1) if first_token_time else None,
+            "total_ms": round(total * 1000, 1),
+            "prompt_tokens": info.get("prompt_tokens"),
+            "completion_tokens": completion_tokens,
+            "tokens_per_s": round(completion_tokens / decode_time, 2) if decode_time > 0 else None,
+            "thought_chars": chars["thought"],
+            "answer_chars": chars["answer"],
+            "fragments": fragments,
+            "flushes": flushes,
+            "aborted": bool(stopper.aborted),
+            "stop_reason": reason,
+        }
+        # Thinking-budget accounting (model_engine.ThoughtTracker)
+        usage.update({k: info[k] for k in ("thought_tokens", "answer_tokens", "thinking_budget_hit") if k in info})
+        metrics.incr("generation_stops", kind="chat", reason=reason)
+        yield sse_event("usage", usage)
+        LOGGER.info(f"SSE stream finished: {usage}")
+    finally:
+        # Generator closed early (client went away): stop the model as well
+        if not finished and not stopper.aborted:
+            stopper.abort()
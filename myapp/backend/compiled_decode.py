@@ -0,0 +1,140 @@
+"""
+Static KV cache + compiled decode step (静态缓存与编译解码, opt-in).
+
+With the default DynamicCache every decode step runs the model eagerly, so the
+Python / dispatch overhead of ~34 decoder layers is paid per token. In this mode
+generate() gets a pre-allocated StaticCache and a CompileConfig, and transformers
+runs the decode step through torch.compile (the prefill stays eager).
+
+Cache shapes are what the compiled graph specializes on, so requests are bucketed:
+prompt + max_new_tokens picks the smallest bucket that fits, and there is one
+pre-allocated cache per bucket. The graphs are compiled during warmup() at
+startup (a short and a past-the-sliding-window prompt per bucket), so users never
+pay for compilation. A request goes back to the dynamic cache when it is longer
+than the largest bucket or its bucket's cache is in use by another generation.
+
+transformers only compiles on accelerators (CUDA / XPU / ...), and skips
+bitsandbytes-quantized weights and CPU offload; the static cache is still used then
+(eager decode against pre-allocated buffers). The raised dynamo recompile limit
+applies only while warmup() compiles, the process-wide default is left alone.
+
+    MEDGEMMA_STATIC_CACHE          1 enables this mode (default 0)
+    MEDGEMMA_STATIC_CACHE_BUCKETS  cache lengths in tokens (default "4096,16384")
+    MEDGEMMA_COMPILE_MODE          torch.compile mode (default: "reduce-overhead" on
+                                   CUDA, "default" elsewhere)
+"""
+import os
+import time
+import logging
+import threading
+from typing import List, Optional
+
+import torch
+import torch._dynamo
+from transformers import StaticCache, CompileConfig
+
+LOGGER = logging.getLogger("MedGemma")
+
+ENABLED = os.environ.get("MEDGEMMA_STATIC_CACHE", "0") == "1"
+BUCKETS = sorted(int(v) for v in os.environ.get("MEDGEMMA_STATIC_CACHE_BUCKETS", "4096,16384").split(",") if v.strip())
+COMPILE_MODE = os.environ.get("MEDGEMMA_COMPILE_MODE")
+# Decode steps per warmup run: the first compiles, the second recompiles with the cache position symbolic
+WARMUP_TOKENS = 4
+# Devices transformers auto-compiles the decode step on (generation/utils.py _valid_auto_compile_criteria)
+COMPILE_DEVICES = ("cuda", "xpu", "neuron", "tpu")
+
+
+class StaticSlot:
+    """One bucket's pre-allocated cache, checked out by a single generation at a time."""
+    def __init__(self, bucket: int, cache: StaticCache):
+        self.bucket = bucket
+        self.cache = cache
+        self.busy = False
+
+
+class StaticDecoder:
+    """Per-engine pool of bucketed static caches plus the shared compile config."""
+    def __init__(self, model, buckets: List[int] = None, mode: Optional[str] = None):
+        self.model = model
+        self.buckets = sorted(buckets or BUCKETS)
+        limit = getattr(model.config, "text_config", model.config).max_position_embeddings
+        self.buckets = [b for b in self.buckets if b <= limit] or [limit]
+        device = getattr(model, "device", torch.device("cpu"))
+        mode = mode or COMPILE_MODE or ("reduce-overhead" if device.type == "cuda" else "default")
+        # dynamic=None lets dynamo turn the cache position into a symbol after one recompile
+        # instead of specializing (and recompiling) on every step
+        self.compile_config = CompileConfig(fullgraph=False, dynamic=None, mode=mode)
+        self.compiled = device.type in COMPILE_DEVICES
+        self.slots = [StaticSlot(b, StaticCache(config=model.config, max_cache_len=b)) for b in self.buckets]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.warmup_s = None
+        # Each bucket compiles a few variants (see warmup); keep dynamo from giving up on them
+        self.recompile_limit = max(torch._dynamo.config.recompile_limit, 4 * len(self.slots) + 8)
+
+    def acquire(self, total_tokens: int) -> Optional[StaticSlot]:
+        """Smallest free bucket holding total_tokens (None: use the dynamic cache)."""
+        with self._lock:
+            for slot in self.slots:
+                if slot.bucket >= total_tokens and not slot.busy:
+                    slot.busy = True
+                    self.hits += 1
+                    return slot
+            self.misses += 1
+            return None
+
+    def release(self, slot: Optional[StaticSlot]):
+        if slot is None:
+            return
+        slot.cache.reset()
+        with self._lock:
+            slot.busy = False
+
+    def generate_kwargs(self, slot: StaticSlot) -> dict:
+        if not self.compiled:
+            return {"past_key_values": slot.cache}
+        return {"past_key_values": slot.cache, "compile_config": self.compile_config}
+
+    def warmup(self, bos_token_id: int = 2):
+        """Compile the decode step for every bucket before the first request."""
+        start = time.perf_counter()
+        window = getattr(getattr(self.model.config, "text_config", self.model.config), "sliding_window", None)
+        device = self.model.device
+        if self.compiled:
+            LOGGER.info(f"Compiling decode step (dynamo recompile_limit {torch._dynamo.config.recompile_limit} -> "
+                        f"{self.recompile_limit} during warmup).")
+        else:
+            LOGGER.info(f"No decode compilation on {device.type}; static caches run eagerly.")
+        with torch._dynamo.config.patch(recompile_limit=self.recompile_limit):
+            self._warmup_slots(bos_token_id, window, device)
+        self.warmup_s = round(time.perf_counter() - start, 1)
+        LOGGER.info(f"{'Compiled' if self.compiled else 'Static-cache'} decode ready for buckets {self.buckets} ({self.warmup_s}s).")
+
+    def _warmup_slots(self, bos_token_id: int, window: Optional[int], device):
+        for slot in self.slots:
+            # Sliding-window layers take a different path once the window is full
+            prompt_lengths = [8]
+            if window and window + WARMUP_TOKENS + 8 < slot.bucket:
+                prompt_lengths.append(window + 8)
+            for length in prompt_lengths:
+                input_ids = torch.full((1, length), bos_token_id, dtype=torch.long, device=device)
+                t0 = time.perf_counter()
+                with torch.no_grad():
+                    self.model.generate(input_ids=input_ids, attention_mask=torch.ones_like(input_ids),
+                                        max_new_tokens=WARMUP_TOKENS, min_new_tokens=WARMUP_TOKENS,
+                                        do_sample=False, **self.generate_kwargs(slot))
+                slot.cache.reset()
+                LOGGER.info(f"Static cache warmup: bucket {slot.bucket}, prompt {length}: {time.perf_counter() - t0:.1f}s")
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "buckets": self.buckets,
+                "busy": [s.bucket for s in self.slots if s.busy],
+                "hits": self.hits,
+                "misses": self.misses,
+                "warmup_s": self.warmup_s,
+                "compiled": self.compiled,
+                "compile_mode": self.compile_config.mode,
+            }
@@ -4,6 +4,9 @@ import logging
 
 LOGGER = logging.getLogger("MedGemma")
 
+# Estimated prompt tokens per image (Gemma 3 SigLIP encoder emits 256 soft tokens per image)
+IMAGE_TOKEN_COST = 256
+
 class ContextManager:
     def __init__(self, max_token_limit=8192):
         self.max_token_limit = max_token_limit
@@ -105,7 +108,7 @@ class ContextManager:
         # (1 Token ~= 3 字符（保守估计）。)
         
         # We will assign a 'weight' to images. e.g. 256 tokens per image (Gemmas typically treat image tokens differently).
-        IMAGE_TOKEN_COST = 256 
+        # See module-level IMAGE_TOKEN_COST.
 
         total_estimated_tokens = 0
         
@@ -0,0 +1,174 @@
+"""
+Map-reduce CT analysis (分块汇总 CT 分析).
+
+A single CT prompt holds every cached slice (256 image tokens each), so its
+prefill memory and length grow with the series. With config.ct_mode="map_reduce"
+a CT question is answered in passes instead:
+
+    map      the slices are split into overlapping chunks of MEDGEMMA_CT_CHUNK_SLICES;
+             each chunk is its own short generation (at most MEDGEMMA_CT_MAP_TOKENS)
+             listing the findings relevant to the question, MEDGEMMA_CT_MAP_BATCH
+             chunks per batched generation
+    merge    while the chunk findings exceed MEDGEMMA_CT_REDUCE_TOKENS, groups of
+             them are condensed by text-only generations (a tree, for very long series)
+    reduce   one streamed text-only generation answers the question from the findings
+             (the normal /api/chat generation)
+
+Every prompt is bounded by the chunk size or the reduce budget, so peak memory
+does not depend on the number of slices.
+
+    MEDGEMMA_CT_CHUNK_SLICES   slices per chunk (default 8)
+    MEDGEMMA_CT_CHUNK_OVERLAP  slices shared by neighbouring chunks (default 2)
+    MEDGEMMA_CT_MAP_TOKENS     max new tokens per chunk / merge generation (default 384)
+    MEDGEMMA_CT_MAP_BATCH      chunks per batched generation (default 4)
+    MEDGEMMA_CT_REDUCE_TOKENS  findings tokens the final prompt may hold (default 4096)
+"""
+import os
+import time
+import logging
+from typing import List, Optional
+
+import ct_service
+from chat_stream import ThoughtClassifier
+from memory_planner import MemoryBudgetExceeded
+from metrics import metrics
+
+LOGGER = logging.getLogger("MedGemma")
+
+CHUNK_SLICES = int(os.environ.get("MEDGEMMA_CT_CHUNK_SLICES", "8"))
+CHUNK_OVERLAP = int(os.environ.get("MEDGEMMA_CT_CHUNK_OVERLAP", "2"))
+MAP_TOKENS = int(os.environ.get("MEDGEMMA_CT_MAP_TOKENS", "384"))
+MAP_BATCH = int(os.environ.get("MEDGEMMA_CT_MAP_BATCH", "4"))
+REDUCE_TOKENS = int(os.environ.get("MEDGEMMA_CT_REDUCE_TOKENS", "4096"))
+
+CT_MODES = ("single", "map_reduce")
+# Findings are notes for the final pass: greedy, no sampling noise
+MAP_GENERATION_ARGS = {"do_sample": False, "repetition_penalty": 1.05}
+NO_FINDINGS = "No significant findings."
+
+MAP_QUERY = ("\n\nThese are {label} of the study. List concisely, in English, the findings in these slices "
+             "that are relevant to the question below, naming the slice numbers. If there are none, "
+             "reply exactly \"" + NO_FINDINGS + "\"\nQuestion: {question}")
+MERGE_PROMPT = ("Below are findings noted on consecutive, overlapping blocks of one CT study. Merge them "
+                "into one concise list in English: keep slice numbers, combine duplicates from the "
+                "overlapping slices, drop blocks without findings.\nQuestion: {question}\n\n{findings}")
+REDUCE_PROMPT = ("You are a senior radiologist. The CT study was reviewed block by block; these are the "
+                 "findings noted for each block of slices:\n\n{findings}\n\nBased on these findings, answer "
+                 "the following query in Simplified Chinese:\n{question}\n\nPlease provide your detailed reasoning.")
+
+
+def split_chunks(images: List[dict], size: int = CHUNK_SLICES, overlap: int = CHUNK_OVERLAP) -> List[List[dict]]:
+    """Consecutive chunks of `size` slices, neighbours sharing `overlap`; the last one may be shorter."""
+    size = max(1, size)
+    step = max(1, size - max(0, overlap))
+    chunks = []
+    for start in range(0, len(images), step):
+        chunks.append(images[start:start + size])
+        if start + size >= len(images):
+            break
+    return chunks
+
+
+def span_label(kind: str, first: int, last: int) -> str:
+    return f"{kind} {first}-{last}"
+
+
+def build_map_content(chunk: List[dict], question: str) -> List[dict]:
+    kind = "slabs" if chunk[0].get("slab") else "slices"
+    content = ct_service.build_slice_content(chunk)
+    content.append({"type": "text", "text": MAP_QUERY.format(
+        label=span_label(kind, chunk[0]["index"], chunk[-1]["index"]), question=question)})
+    return content
+
+
+def format_findings(notes: List[dict]) -> str:
+    return "\n\n".join(f"[{span_label(note['kind'], note['first'], note['last'])}]\n{note['text']}" for note in notes)
+
+
+def answer_text(raw: str) -> str:
+    """Visible answer of one generation (the thought, if that is all there is)."""
+    classifier = ThoughtClassifier()
+    parts = {"thought": [], "answer": []}
+    for kind, text in classifier.feed(raw) + classifier.finish():
+        parts[kind].append(text)
+    text = "".join(parts["answer"]).strip() or "".join(parts["thought"]).strip()
+    return text or NO_FINDINGS
+
+
+def run_batches(engine, conversations: List[list], batch_size: int, model_variant: Optional[str],
+                cancel_token=None) -> List[dict]:
+    """
+    engine.generate_batch over `conversations`; a batch over the memory budget is retried in halves.
+    A cancelled cancel_token (cancellation.py) stops the running batch and skips the rest.
+    """
+    results = []
+    for start in range(0, len(conversations), batch_size):
+        if cancel_token is not None:
+            cancel_token.check("map")
+        results.extend(_run_batch(engine, conversations[start:start + batch_size], model_variant, cancel_token))
+    return results
+
+
+def _run_batch(engine, batch: List[list], model_variant: Optional[str], cancel_token=None) -> List[dict]:
+    try:
+        return engine.generate_batch(batch, max_new_tokens=MAP_TOKENS, model_variant=model_variant,
+                                     cancel_token=cancel_token, **MAP_GENERATION_ARGS)
+    except MemoryBudgetExceeded:
+        if len(batch) == 1:
+            raise
+        half = len(batch) // 2
+        LOGGER.info(f"CT map batch of {len(batch)} over the memory budget; retrying as {half} + {len(batch) - half}.")
+        return (_run_batch(engine, batch[:half], model_variant, cancel_token)
+                + _run_batch(engine, batch[half:], model_variant, cancel_token))
+
+
+def _system(system_prompt: Optional[str]) -> list:
+    return [{"role": "system", "content": system_prompt}] if system_prompt else []
+
+
+def merge_notes(engine, notes: List[dict], question: str, system_prompt: Optional[str],
+                model_variant: Optional[str], cancel_token=None) -> List[dict]:
+    """Condense neighbouring findings with text-only passes until they fit REDUCE_TOKENS."""
+    while len(notes) > 1 and sum(note["tokens"] for note in notes) > REDUCE_TOKENS:
+        # Each group's findings must fit one merge prompt
+        groups, current, tokens = [], [], 0
+        for note in notes:
+            if current and tokens + note["tokens"] > REDUCE_TOKENS:
+                groups.append(current)
+                current, tokens = [], 0
+            current.append(note)
+            tokens += note["tokens"]
+        groups.append(current)
+        if len(groups) == len(notes):
+            # Every note alone fills the budget: pair them so the tree still shrinks
+            groups = [notes[i:i + 2] for i in range(0, len(notes), 2)]
+        conversations = [_system(system_prompt) + [{"role": "user", "content": MERGE_PROMPT.format(
+            question=question, findings=format_findings(group))}] for group in groups]
+        outputs = run_batches(engine, conversations, MAP_BATCH, model_variant, cancel_token)
+        notes = [{"kind": group[0]["kind"], "first": group[0]["first"], "last": group[-1]["last"],
+                  "text": answer_text(output["text"]), "tokens": output["completion_tokens"]}
+                 for group, output in zip(groups, outputs)]
+        metrics.incr("ct_map_reduce", phase="merge", value=len(groups))
+    return notes
+
+
+def analyze(engine, images: List[dict], question: str, system_prompt: Optional[str] = None,
+            model_variant: Optional[str] = None, cancel_token=None) -> List[dict]:
+    """
+    Map (and merge) phase for one CT question; returns the reduce turn's messages
+    (user content only, the caller adds the system prompt and streams the answer).
+    """
+    start = time.perf_counter()
+    chunks = split_chunks(images)
+    conversations = [_system(system_prompt) + [{"role": "user", "content": build_map_content(chunk, question)}]
+                     for chunk in chunks]
+    outputs = run_batches(engine, conversations, MAP_BATCH, model_variant, cancel_token)
+    notes = [{"kind": "slabs" if chunk[0].get("slab") else "slices", "first": chunk[0]["index"],
+              "last": chunk[-1]["index"], "text": answer_text(output["text"]), "tokens": output["completion_tokens"]}
+             for chunk, output in zip(chunks, outputs)]
+    metrics.incr("ct_map_reduce", phase="map", value=len(chunks))
+    notes = merge_notes(engine, notes, question, system_prompt, model_variant, cancel_token)
+    LOGGER.info(f"CT map-reduce: {len(images)} slices in {len(chunks)} chunks -> {len(notes)} findings blocks "
+                f"in {time.perf_counter() - start:.1f}s.")
+    return [{"role": "user", "content": [{"type": "text", "text": REDUCE_PROMPT.format(
+        findings=format_findings(notes), question=question)}]}]
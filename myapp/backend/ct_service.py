@@ -1,11 +1,17 @@
 import pydicom
 import numpy as np
 import io
-import base64
+import os
+import json
+import hashlib
 import re
+import uuid
+import threading
 from PIL import Image
-from typing import Union, List
+from typing import Union, List, Optional, Iterator
 import logging
+from context_manager import IMAGE_TOKEN_COST
+from cancellation import Cancelled
 
 try:
     from pydicom.pixels import apply_modality_lut
@@ -20,23 +26,158 @@ except ImportError:
 
 LOGGER = logging.getLogger("MedGemma")
 
+# --- Slice selection (切片选择) ---
+# "uniform": evenly spaced, at most MAX_SLICES (legacy behaviour).
+# "content": drop air-only / near-duplicate slices using cheap previews, then fill
+#            the image-token budget with the most informative slices in z order.
+DEFAULT_SELECTION = "content"
+MAX_SLICES = 85
+DEFAULT_IMAGE_TOKEN_BUDGET = MAX_SLICES * IMAGE_TOKEN_COST
+PREVIEW_SIZE = 64
+# Previews are normalized to 0..1 over -1024..1024 HU; below AIR_LEVEL (~ -900 HU) is air.
+AIR_LEVEL = 0.06
+# A slice needs at least this fraction of non-air pixels to be considered at all.
+MIN_TISSUE_FRACTION = 0.02
+# Mean absolute preview difference below which a slice duplicates the last kept one.
+REDUNDANCY_THRESHOLD = 0.004
+
+# --- Thick-slab projection (厚层投影) ---
+# Adjacent slices are collapsed in HU space before windowing, so the whole volume is
+# covered by ceil(N / thickness) images instead of a sparse sample of thin slices.
+SLAB_REDUCERS = {
+    "mip": np.max,    # maximum-intensity: vessels, nodules, bone
+    "minip": np.min,  # minimum-intensity: airways, emphysema
+    "mean": np.mean,  # average: noise-reduced thick slab
+}
+SLAB_LABELS = {"mip": "MIP", "minip": "MinIP", "mean": "average"}
+# Slices decoded at once while projecting (bounds memory for long series)
+SLAB_BATCH_SLICES = 64
+
+CT_INSTRUCTION = ("You are a senior radiologist analyzing a contiguous block of CT slices. "
+                  "Please review the slices provided below carefully. "
+                  "The images use a specific 3-channel windowing:\n"
+                  "- Red (Wide Window): Range -1024 to 1024 HU (Air to Bone)\n"
+                  "- Green (Soft Tissue Window): Range -135 to 215 HU (Fat to Bone)\n"
+                  "- Blue (Brain Window): Range 0 to 80 HU (Water to Brain)\n"
+                  "Each channel provides different diagnostic information.")
+SLAB_INSTRUCTION = ("\nEach image is a thick-slab {label} projection of several adjacent slices, "
+                    "together covering the whole scanned volume in order.")
+
+# --- Series result cache (序列级去重缓存) ---
+# Processed series are keyed by their DICOM identity (Study/Series/SOP Instance UIDs)
+# plus the processing parameters and persisted as .npz, so a repeat upload of the
+# same study is answered from disk without decoding a single pixel.
+CT_RESULT_CACHE_DIR = os.environ.get(
+    "MEDGEMMA_CT_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "ct_cache"))
+# 0 disables the cache
+CT_RESULT_CACHE_MAX_ENTRIES = int(os.environ.get("MEDGEMMA_CT_CACHE_ENTRIES", "16"))
+# Bump when the processing pipeline changes output for the same input.
+CT_RESULT_CACHE_VERSION = 2
+
+# --- Context pixels (上下文像素) ---
+# The CT context keeps windowed uint8 RGB arrays and hands them to the processor
+# as-is; no JPEG/base64 round trip on the chat path. Slices larger than the vision
+# encoder input are downscaled once. JPEG thumbnails exist only for the frontend
+# and are rendered on demand (/api/ct/slices/{context_id}/{index}).
+CONTEXT_MAX_SIZE = 896
+THUMBNAIL_SIZE = 512
+
 # --- Server-Side Context Cache ---
 # For a single-user local deployment, a simple global variable suffices.
 # In a multi-user environment, this would be a keyed dictionary or Redis.
+# Every upload streams into its own pending context (a random upload id), so two
+# uploads of the same series never share one; only commit_context publishes it
+# under the deterministic content id (upload_context_id). Slice URLs handed out
+# while streaming keep resolving after the commit through the upload-id aliases.
 GLOBAL_CT_CACHE = {
-    "images": [], # List of base64 strings or PIL objects
+    "id": None, # Context id handed to the frontend (slice URLs)
+    "images": [], # List of dicts with uint8 RGB "pixels"
+    "aliases": set(), # Upload ids whose slice URLs point at the active context
+    "pending": {}, # upload id -> images of uploads still streaming in
     "prompt_structure": [] # Pre-calculated prompt parts
 }
+_CT_CACHE_LOCK = threading.Lock()
 
-def set_global_context(processed_result):
-    """Store the processed CT sequence in global cache for chat retrieval."""
-    GLOBAL_CT_CACHE["images"] = processed_result
-    LOGGER.info(f"CT Context cached on server. Count: {len(processed_result)}")
+def begin_context() -> str:
+    """Open a pending context that slices are appended to while an upload is processed; returns its upload id."""
+    upload_id = uuid.uuid4().hex
+    with _CT_CACHE_LOCK:
+        GLOBAL_CT_CACHE["pending"][upload_id] = []
+    return upload_id
+
+def append_context(upload_id: str, img_data: dict):
+    with _CT_CACHE_LOCK:
+        GLOBAL_CT_CACHE["pending"][upload_id].append(img_data)
+
+def commit_context(upload_id: str, context_id: Optional[str] = None) -> str:
+    """Make a finished pending context the one CT chat uses, under context_id (default: the upload id)."""
+    context_id = context_id or upload_id
+    with _CT_CACHE_LOCK:
+        images = GLOBAL_CT_CACHE["pending"].pop(upload_id)
+        if context_id != GLOBAL_CT_CACHE["id"]:
+            GLOBAL_CT_CACHE["aliases"] = set()
+        # The same context id always means the same pixels, so URLs of an earlier identical upload stay valid
+        GLOBAL_CT_CACHE["aliases"].add(upload_id)
+        GLOBAL_CT_CACHE["images"] = images
+        GLOBAL_CT_CACHE["id"] = context_id
+    LOGGER.info(f"CT Context cached on server. Count: {len(images)}")
+    return context_id
+
+def discard_context(upload_id: str):
+    with _CT_CACHE_LOCK:
+        GLOBAL_CT_CACHE["pending"].pop(upload_id, None)
+
+def set_global_context(processed_result, context_id: Optional[str] = None) -> str:
+    """Store the processed CT sequence in global cache for chat retrieval. Returns its context id."""
+    upload_id = uuid.uuid4().hex
+    with _CT_CACHE_LOCK:
+        GLOBAL_CT_CACHE["pending"][upload_id] = list(processed_result)
+    return commit_context(upload_id, context_id)
 
 def get_global_context():
     """Retrieve cached images for prompt injection."""
     return GLOBAL_CT_CACHE["images"]
 
+def get_context_id() -> Optional[str]:
+    return GLOBAL_CT_CACHE["id"]
+
+def get_context():
+    """(context id, images) of the active context, read together."""
+    with _CT_CACHE_LOCK:
+        return GLOBAL_CT_CACHE["id"], GLOBAL_CT_CACHE["images"]
+
+def get_slice_pixels(context_id: str, index: int) -> np.ndarray:
+    """RGB pixels of slice `index` (1-based) of the given (active or pending) context; KeyError if it is gone."""
+    with _CT_CACHE_LOCK:
+        if context_id == GLOBAL_CT_CACHE["id"] or context_id in GLOBAL_CT_CACHE["aliases"]:
+            images = GLOBAL_CT_CACHE["images"]
+        elif context_id in GLOBAL_CT_CACHE["pending"]:
+            images = GLOBAL_CT_CACHE["pending"][context_id]
+        else:
+            raise KeyError(f"Unknown CT context: {context_id}")
+        if not 1 <= index <= len(images):
+            raise KeyError(f"No slice {index} in CT context {context_id}")
+        return images[index - 1]["pixels"]
+
+def public_slice(img_data: dict, context_id: str) -> dict:
+    """Frontend view of one processed slice: metadata plus its on-demand thumbnail URL."""
+    return {**{k: v for k, v in img_data.items() if k != "pixels"},
+            "image": f"/api/ct/slices/{context_id}/{img_data['index']}"}
+
+def public_result(processed_result: List[dict], context_id: str) -> List[dict]:
+    return [public_slice(img_data, context_id) for img_data in processed_result]
+
+def slab_report(slab_thickness: Optional[int], processed_result: List[dict]) -> Optional[dict]:
+    """
+    Slab thickness requested vs. actually used (per series), for the response; widened is True
+    when a requested thickness was raised to fit the image-token budget. None without slabs.
+    """
+    used = sorted({img_data["slab"]["thickness"] for img_data in processed_result if img_data.get("slab")})
+    if not used:
+        return None
+    return {"requested": slab_thickness, "used": used,
+            "widened": bool(slab_thickness) and any(t != slab_thickness for t in used)}
+
 def norm(ct_vol: np.ndarray, min_val: float, max_val: float) -> np.ndarray:
     """Window and normalize CT imaging Hounsfield values to values 0 - 255."""
     ct_vol = np.clip(ct_vol, min_val, max_val)
@@ -65,35 +206,440 @@ def apply_windowing(ct_slice_pixel_array: np.ndarray) -> np.ndarray:
     rgb_slice = np.stack([red, green, blue], axis=-1)
     return np.round(rgb_slice, 0).astype(np.uint8)
 
-def encode_image(image: Union[np.ndarray, Image.Image], format="JPEG") -> str:
-    """Encode numpy array or PIL Image to base64 string with resize."""
+def to_context_pixels(image: Union[np.ndarray, Image.Image]) -> np.ndarray:
+    """uint8 RGB array for the CT context, downscaled if larger than CONTEXT_MAX_SIZE."""
+    if isinstance(image, np.ndarray) and max(image.shape[:2]) <= CONTEXT_MAX_SIZE:
+        return np.ascontiguousarray(image, dtype=np.uint8)
     if isinstance(image, np.ndarray):
-        img = Image.fromarray(image)
-    else:
-        img = image
-        if img.mode != "RGB":
-            img = img.convert("RGB")
-    with io.BytesIO() as img_bytes:
-        img.thumbnail((512, 512))
-        img.save(img_bytes, format=format, quality=85)
-        img_bytes.seek(0)
-        encoded_string = base64.b64encode(img_bytes.getbuffer()).decode("utf-8")
-    return f"data:image/{format.lower()};base64,{encoded_string}"
-
-def _sample_items(items: List, max_slices: int = 85) -> List:
+        image = Image.fromarray(image)
+    image = image.convert("RGB")
+    image.thumbnail((CONTEXT_MAX_SIZE, CONTEXT_MAX_SIZE))
+    return np.asarray(image, dtype=np.uint8)
+
+def render_thumbnail(pixels: np.ndarray, size: int = THUMBNAIL_SIZE, format="JPEG") -> bytes:
+    """Encode context pixels for display (frontend only)."""
+    img = Image.fromarray(pixels)
+    img.thumbnail((size, size))
+    buf = io.BytesIO()
+    img.save(buf, format=format, quality=85)
+    return buf.getvalue()
+
+def dicom_sort_key(item):
+    """Anatomical ordering key: InstanceNumber, else SliceLocation."""
+    ds = item['data']
+    if hasattr(ds, 'InstanceNumber') and ds.InstanceNumber:
+        return int(ds.InstanceNumber)
+    if hasattr(ds, 'SliceLocation'):
+        return float(ds.SliceLocation)
+    return 0
+
+def to_hounsfield(pixel_array: np.ndarray, ds) -> np.ndarray:
+    """Convert stored pixel values to Hounsfield Units (HU) using the modality LUT / rescale tags."""
+    # Try using apply_modality_lut or manual calculation
+    if apply_modality_lut:
+        try:
+            return apply_modality_lut(pixel_array, ds)
+        except Exception:
+            # Fallback if function fails on specific data
+            pass
+    # Manual Rescale Slope/Intercept
+    slope = float(getattr(ds, 'RescaleSlope', 1))
+    intercept = float(getattr(ds, 'RescaleIntercept', 0))
+    return (pixel_array * slope) + intercept
+
+def _sample_items(items: List, max_slices: int = MAX_SLICES) -> List:
     """Sample items evenly if count exceeds max_slices."""
     if len(items) > max_slices:
         indices = [int(round(i / max_slices * (len(items) - 1))) for i in range(1, max_slices + 1)]
         return [items[i] for i in indices]
     return items
 
-def process_mixed_files(files_data):
+def _stored_values(raw: np.ndarray, bits_stored: int, pixel_representation: int) -> np.ndarray:
+    """Raw 16-bit words -> stored values: unused high bits masked off, two's complement sign-extended."""
+    if bits_stored == 16:
+        return raw.view(np.int16) if pixel_representation == 1 else raw
+    values = (raw & ((1 << bits_stored) - 1)).astype(np.int32)
+    if pixel_representation == 1:
+        sign = 1 << (bits_stored - 1)
+        values = (values ^ sign) - sign
+    return values
+
+def slice_preview(item, size: int = PREVIEW_SIZE) -> np.ndarray:
+    """
+    Cheap (size x size)-ish preview of a slice, normalized to 0..1 over -1024..1024 HU.
+    Block-averaged so scanner noise does not dominate slice differences.
+    Uncompressed DICOM with 16 bits allocated (any BitsStored, e.g. the usual 12) is read
+    straight out of PixelData without a full decode.
+    """
+    data = item['data']
+    if item['type'] == 'image':
+        img = data.convert("L")
+        img.thumbnail((size, size))
+        return np.asarray(img, dtype=np.float32) / 255.0
+
+    rows, cols = int(data.Rows), int(data.Columns)
+    ts = getattr(getattr(data, 'file_meta', None), 'TransferSyntaxUID', None)
+    if (ts is not None and not ts.is_compressed and ts.is_little_endian
+            and int(getattr(data, 'SamplesPerPixel', 1)) == 1
+            and int(data.BitsAllocated) == 16 and int(getattr(data, 'BitsStored', 16)) <= 16):
+        stored = _stored_values(np.frombuffer(data.PixelData, dtype=np.uint16, count=rows * cols),
+                                int(getattr(data, 'BitsStored', 16)), int(data.PixelRepresentation))
+        stored = stored.reshape(rows, cols)
+    else:
+        stored = data.pixel_array
+    step = max(1, max(rows, cols) // size)
+    r, c = rows // step, cols // step
+    blocks = stored[:r * step, :c * step].reshape(r, step, c, step).mean(axis=(1, 3), dtype=np.float32)
+    hu = np.asarray(to_hounsfield(blocks, data), dtype=np.float32)
+    return (np.clip(hu, -1024, 1024) + 1024) / 2048
+
+def select_informative_items(items: List, image_token_budget: int = DEFAULT_IMAGE_TOKEN_BUDGET,
+                             min_tissue: float = MIN_TISSUE_FRACTION,
+                             redundancy: float = REDUNDANCY_THRESHOLD, cancel_token=None) -> List:
+    """
+    Content-aware replacement for _sample_items (items must already be in anatomical order).
+    1. Score each slice preview by tissue fraction and difference from its predecessor.
+    2. Drop air-only slices and slices nearly identical to the last kept one.
+    3. If more remain than the budget allows, split them into equal z-ranges and keep
+       the highest-scoring slice of each range, so coverage stays anatomical.
+    """
+    max_images = max(1, image_token_budget // IMAGE_TOKEN_COST)
+    if not items:
+        return items
+
+    previews = []
+    for item in items:
+        if cancel_token is not None:
+            cancel_token.check("ct_process")
+        try:
+            previews.append(slice_preview(item))
+        except Exception as e:
+            LOGGER.warning(f"Preview failed for {item.get('name')}: {e}")
+            previews.append(None)
+
+    candidates = []  # (position, score)
+    last_kept = None
+    for pos, preview in enumerate(previews):
+        if preview is None:
+            continue
+        tissue = float(np.mean(preview > AIR_LEVEL))
+        if tissue < min_tissue:
+            continue
+        if last_kept is not None and last_kept.shape == preview.shape:
+            change = float(np.mean(np.abs(preview - last_kept)))
+            if change < redundancy:
+                continue
+        else:
+            change = 1.0
+        candidates.append((pos, tissue + min(change * 10, 1.0)))
+        last_kept = preview
+
+    if not candidates:
+        # Nothing passed the filters (e.g. unusual intensities); fall back to uniform sampling
+        return _sample_items(items, max_images)
+
+    if len(candidates) > max_images:
+        bins = np.array_split(np.arange(len(candidates)), max_images)
+        candidates = [max((candidates[i] for i in b), key=lambda c: c[1]) for b in bins if len(b)]
+
+    LOGGER.info(f"Slice selection: {len(items)} slices -> {len(candidates)} (budget {max_images} images)")
+    return [items[pos] for pos, _ in candidates]
+
+def choose_slices(sorted_items: List, selection: str = DEFAULT_SELECTION,
+                  image_token_budget: Optional[int] = None, cancel_token=None) -> List:
+    """Pick the slices that go into the CT context, using the requested selection strategy."""
+    budget = image_token_budget or DEFAULT_IMAGE_TOKEN_BUDGET
+    if selection == "uniform":
+        return _sample_items(sorted_items, min(MAX_SLICES, max(1, budget // IMAGE_TOKEN_COST)))
+    if selection == "content":
+        return select_informative_items(sorted_items, budget, cancel_token=cancel_token)
+    raise ValueError(f"Unknown slice selection mode: {selection}")
+
+def project_slabs(volume: np.ndarray, thickness: int, mode: str) -> np.ndarray:
+    """Collapse an (N, H, W) HU volume into (ceil(N / thickness), H, W) slab projections."""
+    reducer = SLAB_REDUCERS[mode]
+    n = volume.shape[0]
+    full = (n // thickness) * thickness
+    parts = []
+    if full:
+        parts.append(reducer(volume[:full].reshape(full // thickness, thickness, *volume.shape[1:]), axis=1))
+    if full < n:
+        parts.append(reducer(volume[full:], axis=0, keepdims=True))
+    return np.concatenate(parts).astype(np.float32, copy=False)
+
+def _slab_thickness(n_slices: int, slab_thickness: Optional[int], image_token_budget: Optional[int]) -> int:
+    """Requested thickness, widened if needed so the slab count fits the image-token budget."""
+    max_images = max(1, (image_token_budget or DEFAULT_IMAGE_TOKEN_BUDGET) // IMAGE_TOKEN_COST)
+    minimum = -(-n_slices // max_images)  # ceil
+    if slab_thickness and slab_thickness >= minimum:
+        return slab_thickness
+    if slab_thickness:
+        LOGGER.info(f"Slab thickness {slab_thickness} exceeds the image budget; using {minimum}.")
+    return max(1, minimum)
+
+def iter_slabs(sorted_items: List, mode: str, slab_thickness: Optional[int] = None,
+               image_token_budget: Optional[int] = None, cancel_token=None) -> Iterator[dict]:
+    """
+    Thick-slab projection path for a sorted DICOM series.
+    The HU volume is decoded in batches of whole slabs, projected and windowed
+    vectorized per batch; each slab becomes one context image, yielded in z order.
     """
-    Process a list of file data which can be pydicom Datasets or PIL Images.
+    if mode not in SLAB_REDUCERS:
+        raise ValueError(f"Unknown projection mode: {mode}")
+
+    # Slabs need a consistent matrix; keep the dominant (Rows, Columns)
+    shapes = [(int(item['data'].Rows), int(item['data'].Columns)) for item in sorted_items]
+    dominant = max(set(shapes), key=shapes.count)
+    items = [item for item, shape in zip(sorted_items, shapes) if shape == dominant]
+    if len(items) < len(sorted_items):
+        LOGGER.warning(f"Skipped {len(sorted_items) - len(items)} slices with a different matrix than {dominant}.")
+
+    thickness = _slab_thickness(len(items), slab_thickness, image_token_budget)
+    batch = max(1, SLAB_BATCH_SLICES // thickness) * thickness
+
+    count = 0
+    for start in range(0, len(items), batch):
+        if cancel_token is not None:
+            cancel_token.check("ct_process")
+        group = items[start:start + batch]
+        volume = np.stack([to_hounsfield(item['data'].pixel_array, item['data']).astype(np.float32) for item in group])
+        rgb_slabs = apply_windowing(project_slabs(volume, thickness, mode))
+        for i, rgb in enumerate(rgb_slabs):
+            first = start + i * thickness
+            last = min(first + thickness, len(items)) - 1
+            count += 1
+            yield {
+                "index": count,
+                "original_index": f"{dicom_sort_key(items[first])}-{dicom_sort_key(items[last])}",
+                "pixels": to_context_pixels(rgb),
+                "slab": {"mode": mode, "thickness": thickness, "start": first + 1, "end": last + 1},
+            }
+    LOGGER.info(f"Slab projection ({mode}): {len(items)} slices -> {count} slabs of {thickness}")
+
+def build_context_content(cached_images: List[dict], user_text: str) -> List[dict]:
+    """User-turn content for a CT question: instruction, labelled slices/slabs, then the query."""
+    content = build_slice_content(cached_images)
+    content.append({"type": "text", "text": f"\n\nBased on the visual evidence in the slices provided above, answer the following query in Simplified Chinese:\n{user_text}\n\nPlease provide your detailed reasoning."})
+    return content
+
+def build_slice_content(cached_images: List[dict]) -> List[dict]:
+    """Instruction followed by the labelled slices/slabs (series headers when several series are cached)."""
+    instruction = CT_INSTRUCTION
+    slab = cached_images[0].get("slab") if cached_images else None
+    if slab:
+        instruction += SLAB_INSTRUCTION.format(label=SLAB_LABELS[slab["mode"]])
+    content = [{"type": "text", "text": instruction}]
+    multi_series = len({img_data['series']['uid'] for img_data in cached_images if img_data.get('series')}) > 1
+    current_series = None
+    for img_data in cached_images:
+        series = img_data.get('series')
+        if multi_series and series and series['uid'] != current_series:
+            current_series = series['uid']
+            description = series['description'] or series['modality'] or "CT"
+            content.append({"type": "text", "text": f"SERIES {series['number'] or '?'}: {description}"})
+        content.append({"type": "image", "image": img_data['pixels']})
+        if img_data.get("slab"):
+            s = img_data["slab"]
+            label = f"SLAB {img_data['index']} (slices {s['start']}-{s['end']}, {SLAB_LABELS[s['mode']]})"
+        else:
+            label = f"SLICE {img_data['index']}"
+        content.append({"type": "text", "text": label})
+    return content
+
+def series_uid(item) -> str:
+    ds = item['data']
+    return str(getattr(ds, 'SeriesInstanceUID', '') or '')
+
+def group_series(dicom_items: List) -> dict:
+    """Split DICOM items by SeriesInstanceUID, keeping upload order of first appearance."""
+    groups = {}
+    for item in dicom_items:
+        groups.setdefault(series_uid(item), []).append(item)
+    return groups
+
+def series_info(items: List) -> dict:
+    ds = items[0]['data']
+    return {
+        "uid": series_uid(items[0]),
+        "study_uid": str(getattr(ds, 'StudyInstanceUID', '') or ''),
+        "number": str(getattr(ds, 'SeriesNumber', '') or ''),
+        "description": str(getattr(ds, 'SeriesDescription', '') or ''),
+        "modality": str(getattr(ds, 'Modality', '') or ''),
+        "slices": len(items),
+    }
+
+def series_cache_key(items: List, params: dict) -> Optional[str]:
+    """
+    Content key of one series: Study/Series UID, the sorted SOPInstanceUID set and
+    the processing parameters. None if any slice lacks a SOPInstanceUID.
+    """
+    sop_uids = [str(getattr(item['data'], 'SOPInstanceUID', '') or '') for item in items]
+    if not all(sop_uids):
+        return None
+    info = series_info(items)
+    identity = {
+        "version": CT_RESULT_CACHE_VERSION,
+        "study": info["study_uid"],
+        "series": info["uid"],
+        "instances": sorted(sop_uids),
+        "params": params,
+    }
+    return hashlib.sha256(json.dumps(identity, sort_keys=True).encode("utf-8")).hexdigest()
+
+def load_cached_result(key: str) -> Optional[List[dict]]:
+    path = os.path.join(CT_RESULT_CACHE_DIR, f"{key}.npz")
+    try:
+        with np.load(path) as entry:
+            images = json.loads(str(entry["meta"]))["images"]
+            for i, img_data in enumerate(images):
+                img_data["pixels"] = entry[f"pixels_{i}"]
+        os.utime(path)  # LRU: mark as recently used
+        return images
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        LOGGER.warning(f"Ignoring unreadable CT cache entry {key}: {e}")
+        return None
+
+def store_cached_result(key: str, images: List[dict], info: dict, params: dict):
+    try:
+        os.makedirs(CT_RESULT_CACHE_DIR, exist_ok=True)
+        path = os.path.join(CT_RESULT_CACHE_DIR, f"{key}.npz")
+        tmp = f"{path}.{os.getpid()}.tmp"
+        meta = {"series": info, "params": params,
+                "images": [{k: v for k, v in img_data.items() if k != "pixels"} for img_data in images]}
+        # Uncompressed: a cache hit is a straight read, no inflate
+        with open(tmp, "wb") as f:
+            np.savez(f, meta=json.dumps(meta), **{f"pixels_{i}": img_data["pixels"] for i, img_data in enumerate(images)})
+        os.replace(tmp, path)
+        _prune_result_cache()
+    except Exception as e:
+        LOGGER.warning(f"Failed to persist CT result {key}: {e}")
+
+def _prune_result_cache():
+    entries = [os.path.join(CT_RESULT_CACHE_DIR, name) for name in os.listdir(CT_RESULT_CACHE_DIR)
+               if name.endswith(".npz")]
+    if len(entries) <= CT_RESULT_CACHE_MAX_ENTRIES:
+        return
+    entries.sort(key=os.path.getmtime)
+    for path in entries[:len(entries) - CT_RESULT_CACHE_MAX_ENTRIES]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def iter_dicom_series(sorted_items: List, selection: str = DEFAULT_SELECTION,
+                      image_token_budget: Optional[int] = None, projection: Optional[str] = None,
+                      slab_thickness: Optional[int] = None, cancel_token=None) -> Iterator[dict]:
+    """
+    Select (or project) and window one sorted DICOM series, yielding slices as they finish.
+    A cancelled cancel_token (cancellation.py) stops it before the next slice with Cancelled.
+    """
+    if projection:
+        yield from iter_slabs(sorted_items, projection, slab_thickness, image_token_budget, cancel_token)
+        return
+    sampled_items = choose_slices(sorted_items, selection, image_token_budget, cancel_token)
+
+    count = 0
+    for idx, item in enumerate(sampled_items):
+        if cancel_token is not None:
+            cancel_token.check("ct_process")
+        try:
+            ds = item['data']
+            pixel_array = ds.pixel_array
+
+            # Convert to Hounsfield Units (HU)
+            hu_array = to_hounsfield(pixel_array, ds)
+
+            rgb_array = apply_windowing(hu_array)
+            pixels = to_context_pixels(rgb_array)
+        except Exception as e:
+            LOGGER.error(f"Error processing DICOM slice {idx}: {e}")
+            continue
+        count += 1
+        yield {
+            "index": count,
+            "original_index": dicom_sort_key(item),
+            "pixels": pixels
+        }
+
+def plan_dicom_series(dicom_items: List, selection: str = DEFAULT_SELECTION,
+                      image_token_budget: Optional[int] = None, projection: Optional[str] = None,
+                      slab_thickness: Optional[int] = None) -> List[dict]:
+    """
+    Header-only plan of an upload: one job per series with its items, info, the
+    per-series parameters (the image-token budget is shared evenly) and cache key.
+    """
+    groups = group_series(dicom_items)
+    if len(groups) > 1:
+        image_token_budget = max(IMAGE_TOKEN_COST, (image_token_budget or DEFAULT_IMAGE_TOKEN_BUDGET) // len(groups))
+        LOGGER.info(f"Upload contains {len(groups)} series; {image_token_budget} image tokens each.")
+    params = {"selection": selection, "image_token_budget": image_token_budget,
+              "projection": projection, "slab_thickness": slab_thickness}
+    return [
+        {"items": items, "info": series_info(items), "params": params, "key": series_cache_key(items, params)}
+        for items in groups.values()
+    ]
+
+def upload_context_id(files_data, selection: str = DEFAULT_SELECTION, image_token_budget: Optional[int] = None,
+                      projection: Optional[str] = None, slab_thickness: Optional[int] = None) -> str:
+    """
+    Context id for an upload. Deterministic for DICOM series with full UIDs, so a
+    repeat upload gets the same slice URLs and the browser serves them from cache.
+    """
+    dicom_items = [x for x in files_data if x['type'] == 'dicom']
+    jobs = plan_dicom_series(dicom_items, selection, image_token_budget, projection, slab_thickness) if dicom_items else []
+    if not jobs or not all(job["key"] for job in jobs):
+        return uuid.uuid4().hex
+    return hashlib.sha256("".join(job["key"] for job in jobs).encode("utf-8")).hexdigest()[:32]
+
+def iter_dicom_items(dicom_items: List, selection: str = DEFAULT_SELECTION,
+                     image_token_budget: Optional[int] = None, projection: Optional[str] = None,
+                     slab_thickness: Optional[int] = None, cancel_token=None) -> Iterator[dict]:
+    """
+    Process an upload series by series, yielding slices numbered across series.
+    Each series result is served from / stored in the result cache.
+    """
+    count = 0
+    for job in plan_dicom_series(dicom_items, selection, image_token_budget, projection, slab_thickness):
+        info, params = job["info"], job["params"]
+        key = job["key"] if CT_RESULT_CACHE_MAX_ENTRIES > 0 else None
+        result = load_cached_result(key) if key else None
+        if result is not None:
+            LOGGER.info(f"CT cache hit for series {info['uid'] or '<unknown>'} ({len(job['items'])} slices).")
+        else:
+            result = []
+            series_iter = iter_dicom_series(sorted(job["items"], key=dicom_sort_key), params["selection"],
+                                            params["image_token_budget"], projection, slab_thickness,
+                                            cancel_token)
+            for img_data in series_iter:
+                result.append(img_data)
+                count += 1
+                yield dict(img_data, index=count, series=info)
+            if key and result:
+                store_cached_result(key, result, info, params)
+            continue
+        for img_data in result:
+            if cancel_token is not None:
+                cancel_token.check("ct_process")
+            count += 1
+            yield dict(img_data, index=count, series=info)
+
+def iter_mixed_files(files_data, selection: str = DEFAULT_SELECTION, image_token_budget: Optional[int] = None,
+                     projection: Optional[str] = None, slab_thickness: Optional[int] = None,
+                     cancel_token=None) -> Iterator[dict]:
+    """
+    Process a list of file data which can be pydicom Datasets or PIL Images,
+    yielding processed slices as soon as each one is ready.
     files_data: List of objects, each object has:
       - type: 'dicom' or 'image'
       - data: pydicom dataset or PIL Image
       - name: filename (for sorting images)
+    selection: "content" (default) or "uniform", see choose_slices.
+    image_token_budget: prompt tokens the selected slices may use (IMAGE_TOKEN_COST each).
+    projection: None for individual slices, or "mip" / "minip" / "mean" thick slabs (DICOM only).
+    slab_thickness: slices per slab (default: the thinnest slab that fits the budget).
+    cancel_token: the upload's cancellation (cancellation.py), checked before every slice.
     """
     try:
         # Separate
@@ -105,55 +651,10 @@ def process_mixed_files(files_data):
         # For flexibility, if DICOMs > 0, we process DICOMs.
         # If no DICOMs, we process Images.
         
-        processed_images = []
-        
         if len(dicom_items) > 0:
-            # Process DICOMs
-            # 1. Sort
-            def get_dicom_sort_key(item):
-                ds = item['data']
-                if hasattr(ds, 'InstanceNumber') and ds.InstanceNumber:
-                    return int(ds.InstanceNumber)
-                if hasattr(ds, 'SliceLocation'):
-                    return float(ds.SliceLocation)
-                return 0
-            
-            sorted_items = sorted(dicom_items, key=get_dicom_sort_key)
-            sampled_items = _sample_items(sorted_items)
-
-            # 3. Window & Encode
-            for idx, item in enumerate(sampled_items):
-                try:
-                    ds = item['data']
-                    pixel_array = ds.pixel_array
-                    
-                    # Convert to Hounsfield Units (HU)
-                    # Try using apply_modality_lut or manual calculation
-                    if apply_modality_lut:
-                        try:
-                            hu_array = apply_modality_lut(pixel_array, ds)
-                        except Exception:
-                            # Fallback if function fails on specific data
-                            slope = float(getattr(ds, 'RescaleSlope', 1))
-                            intercept = float(getattr(ds, 'RescaleIntercept', 0))
-                            hu_array = (pixel_array * slope) + intercept
-                    else:
-                        # Manual Rescale Slope/Intercept
-                        slope = float(getattr(ds, 'RescaleSlope', 1))
-                        intercept = float(getattr(ds, 'RescaleIntercept', 0))
-                        hu_array = (pixel_array * slope) + intercept
-
-                    rgb_array = apply_windowing(hu_array)
-                    b64_img = encode_image(rgb_array)
-                    
-                    processed_images.append({
-                        "index": idx + 1,
-                        "original_index": get_dicom_sort_key(item),
-                        "image": b64_img
-                    })
-                except Exception as e:
-                    LOGGER.error(f"Error processing DICOM slice {idx}: {e}")
-                    continue
+            # Process DICOMs (per series, cached)
+            yield from iter_dicom_items(dicom_items, selection, image_token_budget, projection, slab_thickness,
+                                        cancel_token)
                     
         elif len(image_items) > 0:
             # Process Images (PNG/JPG)
@@ -161,27 +662,33 @@ def process_mixed_files(files_data):
                 return [int(c) if c.isdigit() else c.lower() for c in re.split(r'(\d+)', text)]
 
             sorted_items = sorted(image_items, key=lambda x: natural_keys(x['name']))
-            sampled_items = _sample_items(sorted_items)
+            sampled_items = choose_slices(sorted_items, selection, image_token_budget, cancel_token)
 
-            # 3. Encode (No Windowing possible)
+            # 3. Convert to RGB pixels (No Windowing possible)
+            count = 0
             for idx, item in enumerate(sampled_items):
+                if cancel_token is not None:
+                    cancel_token.check("ct_process")
                 try:
-                    img = item['data']
-                    b64_img = encode_image(img)
-                    
-                    processed_images.append({
-                        "index": idx + 1,
-                        "original_index": item['name'],
-                        "image": b64_img
-                    })
+                    pixels = to_context_pixels(item['data'])
                 except Exception as e:
                      LOGGER.error(f"Error processing Image slice {idx}: {e}")
                      continue
-        
-        return processed_images
+                count += 1
+                yield {
+                    "index": count,
+                    "original_index": item['name'],
+                    "pixels": pixels
+                }
 
+    except Cancelled:
+        raise
     except Exception as e:
         LOGGER.error(f"Error in process_mixed_files: {str(e)}")
         raise e
 
-
+def process_mixed_files(files_data, selection: str = DEFAULT_SELECTION, image_token_budget: Optional[int] = None,
+                        projection: Optional[str] = None, slab_thickness: Optional[int] = None,
+                        cancel_token=None) -> List[dict]:
+    """All processed slices of an upload as a list (see iter_mixed_files)."""
+    return list(iter_mixed_files(files_data, selection, image_token_budget, projection, slab_thickness, cancel_token))
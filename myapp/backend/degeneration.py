@@ -0,0 +1,152 @@
+"""
+Degenerate-output guard (重复输出检测与提前终止).
+
+A StoppingCriteria that ends a generation as soon as the output stops making
+progress, instead of letting it run into max_new_tokens:
+
+    repetition_loop   the last tokens are one n-gram repeated over and over
+                      (period <= LOOP_MAX_PERIOD, at least LOOP_MIN_REPEATS
+                      times and LOOP_MIN_TOKENS tokens)
+    repeated_json     a closed JSON block identical to an earlier one, or (with
+                      max_json_blocks) one block more than the caller needs
+
+JSON blocks are only tracked in the answer, not in the hidden reasoning. The
+reason is written to info["stop_reason"] (the generation's usage dict); the
+reasons and stop_reason() live in stop_reasons.py, which the API side imports.
+"""
+import json
+import logging
+from typing import Optional
+
+import numpy as np
+from transformers import StoppingCriteria
+
+LOGGER = logging.getLogger("MedGemma")
+
+LOOP_MAX_PERIOD = 200
+LOOP_MIN_REPEATS = 3
+LOOP_MIN_TOKENS = 64
+LOOP_CHECK_INTERVAL = 8   # tokens between loop checks
+MIN_JSON_BLOCK_CHARS = 32 # ignore "[1]"-style brackets in prose
+
+def find_loop(ids, max_period: int = LOOP_MAX_PERIOD, min_repeats: int = LOOP_MIN_REPEATS,
+              min_tokens: int = LOOP_MIN_TOKENS) -> Optional[int]:
+    """Smallest period p such that the tail of ids is p-periodic over max(min_tokens, p * min_repeats) tokens."""
+    arr = np.asarray(ids[-max(min_tokens, max_period * min_repeats):])
+    if len(arr) < min_tokens:
+        return None
+    # Only periods whose token p back equals the last token can match
+    candidates = np.flatnonzero(arr[-2::-1][:max_period] == arr[-1]) + 1
+    for period in candidates.tolist():
+        span = max(min_tokens, period * min_repeats)
+        if span > len(arr):
+            break
+        tail = arr[-span:]
+        if np.array_equal(tail[period:], tail[:-period]):
+            return period
+    return None
+
+
+class JsonBlockScanner:
+    """Incrementally finds closed top-level JSON arrays / objects in streamed text."""
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.current = []
+        self.blocks = []  # normalized (whitespace-free) text of each closed block
+
+    def feed(self, text: str):
+        """Returns the newly closed blocks (normalized) in this text."""
+        closed = []
+        for ch in text:
+            if self.depth == 0:
+                if ch in "[{":
+                    self.depth, self.current = 1, [ch]
+                continue
+            self.current.append(ch)
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch in "[{":
+                self.depth += 1
+            elif ch in "]}":
+                self.depth -= 1
+                if self.depth == 0:
+                    block = "".join(self.current)
+                    self.current = []
+                    if self._is_json(block):
+                        normalized = "".join(block.split())
+                        self.blocks.append(normalized)
+                        closed.append(normalized)
+        return closed
+
+    @staticmethod
+    def _is_json(block: str) -> bool:
+        if len(block) < MIN_JSON_BLOCK_CHARS:
+            return False
+        try:
+            json.loads(block)
+            return True
+        except ValueError:
+            return False
+
+    @property
+    def opening(self) -> bool:
+        return self.depth > 0
+
+
+class DegenerationStoppingCriteria(StoppingCriteria):
+    """
+    Stops on repetition loops / repeated JSON blocks (batch row 0).
+    tracker: model_engine.ThoughtTracker, so JSON in the reasoning is ignored.
+    max_json_blocks: stop once a block beyond this many starts (detection only needs the first).
+    """
+    def __init__(self, tokenizer, prompt_tokens: int, info: dict, tracker=None, max_json_blocks: Optional[int] = None):
+        self.tokenizer = tokenizer
+        self.seen = prompt_tokens
+        self.info = info
+        self.tracker = tracker
+        self.max_json_blocks = max_json_blocks
+        self.ids = []
+        self.scanner = JsonBlockScanner()
+        self._since_check = 0
+
+    def _stop(self, reason: str, detail: str) -> bool:
+        self.info["stop_reason"] = reason
+        LOGGER.warning(f"Degenerate output ({reason}: {detail}) after {len(self.ids)} tokens; stopping early.")
+        return True
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if "stop_reason" in self.info:
+            return True
+        new_ids = input_ids[0, self.seen:].tolist()
+        self.seen = input_ids.shape[-1]
+        self.ids.extend(new_ids)
+        self._since_check += len(new_ids)
+
+        if self.tracker is not None:
+            self.tracker.observe(input_ids)
+        if self.tracker is None or not self.tracker.in_thought:
+            known = set(self.scanner.blocks)
+            text = self.tokenizer.decode(new_ids, skip_special_tokens=True)
+            for block in self.scanner.feed(text):
+                if block in known:
+                    return self._stop("repeated_json", f"{len(block)} chars")
+                known.add(block)
+            if (self.max_json_blocks is not None and len(self.scanner.blocks) >= self.max_json_blocks
+                    and self.scanner.opening):
+                return self._stop("repeated_json", f"block {len(self.scanner.blocks) + 1}")
+
+        if self._since_check >= LOOP_CHECK_INTERVAL:
+            self._since_check = 0
+            period = find_loop(self.ids)
+            if period is not None:
+                return self._stop("repetition_loop", f"period {period}")
+        return False
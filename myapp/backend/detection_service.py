@@ -2,9 +2,30 @@ import torch
 import json
 import logging
 import re
+from transformers import LogitsProcessorList, StoppingCriteriaList
+
+import cancellation
+from cancellation import Cancelled
+from model_engine import ThinkingBudgetProcessor, AbortStoppingCriteria
+from degeneration import DegenerationStoppingCriteria
+from stop_reasons import stop_reason
+from profiler import profiler
 
 LOGGER = logging.getLogger("MedGemma")
 
+# Generation Params
+# Optimized balance: 
+# - do_sample=True + eos_token_id: Prevents infinite loops (Major fix)
+# - repetition_penalty=1.05: Mild penalty to avoid local stuttering without killing detailed descriptions
+DETECTION_GENERATION_ARGS = {
+     "max_new_tokens": 8192,
+     "temperature": 0.4, # Slightly higher temp to encourage descriptive language and thinking
+     "do_sample": True,
+     "top_p": 0.90,
+     "top_k": 40,
+     "repetition_penalty": 1.05, 
+}
+
 class DetectionService:
     def __init__(self, engine):
         """
@@ -12,14 +33,8 @@ class DetectionService:
         """
         self.engine = engine
 
-    def detect_findings(self, messages, temperature=0.2, custom_system_prompt=None):
-        """
-        Specialized generation for lesion detection and localization.
-        Uses a specific prompt strategy to extract bounding boxes.
-        """
-        if not self.engine.model:
-            self.engine.load_model()
-            
+    def build_prompt(self, messages, custom_system_prompt=None):
+        """Detection conversation (system instructions + the last image in messages) for the processor."""
         # We need to construct a specific prompt for detection
         # The user's message usually contains the image.
         # We will inject the detection instruction.
@@ -32,7 +47,8 @@ class DetectionService:
              if isinstance(msg["content"], list):
                   for item in msg["content"]:
                        if item["type"] == "image":
-                            target_image = self.engine.process_image(item["image"])
+                            with profiler.section("medgemma.decode_image"):
+                                 target_image = self.engine.process_image(item["image"])
                        if item["type"] == "text":
                             user_prompt_text = item["text"]
         
@@ -65,38 +81,64 @@ class DetectionService:
              {"type": "text", "text": f"{user_prompt_text}\n\n请分析图像并标注病灶。Ensure 'description' is detailed. Provide output in JSON format."}
         ]
         
-        formatted_messages = [
+        return [
              {"role": "system", "content": [{"type": "text", "text": detection_system_prompt}]},
              {"role": "user", "content": detection_prompt_content}
         ]
 
-        # Use the processor from the engine
-        inputs = self.engine.processor.apply_chat_template(
-            formatted_messages,
-            add_generation_prompt=True,
-            tokenize=True,
-            return_dict=True,
-            return_tensors="pt"
-        )
-        inputs = inputs.to(self.engine.model.device)
+    def prepare_inputs(self, messages, custom_system_prompt=None):
+        """
+        CPU side of detect_findings(): detection prompt, chat template and image processing
+        (MedGemmaEngine.prepare_inputs). Runs on the preprocessing stage, outside the detect lock.
+        """
+        return self.engine.prepare_inputs(self.build_prompt(messages, custom_system_prompt))
+
+    def detect_findings(self, messages, temperature=0.2, custom_system_prompt=None, thinking_budget=None,
+                        cancel_token=None, prepared=None):
+        """
+        Specialized generation for lesion detection and localization.
+        Uses a specific prompt strategy to extract bounding boxes.
+        thinking_budget caps the hidden reasoning before the JSON (None: unlimited).
+        cancel_token (cancellation.py): a cancelled request stops at its next layer / token with Cancelled.
+        prepared: prepare_inputs() output for these messages, made ahead on the preprocessing stage.
+        """
+        if not self.engine.model:
+            self.engine.load_model()
+
+        if prepared is None or prepared.model_id != self.engine.model_id:
+            prepared = self.prepare_inputs(messages, custom_system_prompt)
+        inputs = prepared.inputs
         
-        # Generation Params
-        # Optimized balance: 
-        # - do_sample=True + eos_token_id: Prevents infinite loops (Major fix)
-        # - repetition_penalty=1.05: Mild penalty to avoid local stuttering without killing detailed descriptions
-        gen_args = {
-             "max_new_tokens": 8192,
-             "temperature": 0.4, # Slightly higher temp to encourage descriptive language and thinking
-             "do_sample": True,
-             "top_p": 0.90,
-             "top_k": 40,
-             "repetition_penalty": 1.05, 
-             "eos_token_id": self.engine.model.config.eos_token_id
-        }
+        gen_args = {**DETECTION_GENERATION_ARGS, "eos_token_id": self.engine.model.config.eos_token_id}
+
+        # One image; the 8192-token budget is clamped if its KV cache does not fit (memory_planner.py)
+        planner = self.engine.memory
+        reservation = planner.reserve(inputs.input_ids.shape[1], 1, gen_args["max_new_tokens"], cancel_token=cancel_token)
+        gen_args["max_new_tokens"] = reservation.max_new_tokens
+
+        # Up to 8192 new tokens, most of which can go to hidden reasoning: cap it per request
+        tracker = self.engine.thought_tracker(inputs.input_ids.shape[1])
+        gen_args["logits_processor"] = LogitsProcessorList([ThinkingBudgetProcessor(tracker, thinking_budget)])
+        # Only the first JSON block is parsed, so a second one (usually a repeat) ends the generation
+        info = {"max_new_tokens": gen_args["max_new_tokens"]}
+        gen_args["stopping_criteria"] = StoppingCriteriaList([DegenerationStoppingCriteria(
+            self.engine.processor.tokenizer, inputs.input_ids.shape[1], info, tracker=tracker, max_json_blocks=1)])
+        stopper = None
+        if cancel_token is not None:
+             stopper = AbortStoppingCriteria(cancel_token=cancel_token)
+             gen_args["stopping_criteria"].append(stopper)
         
         try:
-             with torch.no_grad():
+             inputs = inputs.to(self.engine.model.device, non_blocking=prepared.pinned)
+             with torch.no_grad(), cancellation.active(cancel_token), profiler.section("medgemma.generate"):
                   generated_ids = self.engine.model.generate(**inputs, **gen_args)
+             if stopper is not None and stopper.cancelled:
+                  # Partial JSON is of no use to anyone
+                  raise Cancelled(cancel_token.reason)
+             tracker.observe(generated_ids)
+             info["completion_tokens"] = generated_ids.shape[1] - inputs.input_ids.shape[1]
+             usage = {**tracker.usage(), "completion_tokens": info["completion_tokens"], "stop_reason": stop_reason(info)}
+             LOGGER.info(f"Detection tokens: {usage}")
                   
              # Decode
              generated_text = self.engine.processor.batch_decode(generated_ids, skip_special_tokens=True)[0]
@@ -108,96 +150,105 @@ class DetectionService:
              response_text = self.engine.processor.decode(new_tokens, skip_special_tokens=False) 
              
              LOGGER.info(f"DEBUG: Raw Model Output for Detection:\n{response_text}")
-
-             # Parse Thinking vs JSON
-             # If <thought> tags exist, separate them
-             thought_content = ""
-             json_content = response_text
-             
-             if "<unused94>" in response_text: # <thought> start
-                  parts = response_text.split("<unused95>") # <thought> end
-                  if len(parts) > 1:
-                       thought_content = parts[0].replace("<unused94>", "").strip()
-                       json_content = parts[1].strip()
-                  else:
-                       # Maybe thought didn't close?
-                       json_content = response_text
-             
-             # Clean JSON string (remove markdown code blocks if any)
-             # Optimized extraction: Try to find the first valid markdown JSON block first
-             # This prevents issues where the model repeats the JSON block multiple times
-             json_block_match = re.search(r"```(?:json)?\s*(\[[\s\S]*?\])\s*```", json_content)
-             
-             if json_block_match:
-                 json_content = json_block_match.group(1)
-             else:
-                 # Fallback: Clean manually
-                 json_content = json_content.replace("```json", "").replace("```", "")
-                 # Also strip common special tokens that might persist
-                 for token in ["<end_of_turn>", "<eos>", "</s>"]:
-                     json_content = json_content.replace(token, "")
-                 
-                 json_content = json_content.strip()
-                 
-                 # Robust extraction: find outer brackets of the FIRST valid structure
-                 start_idx = json_content.find('[')
-                 if start_idx != -1:
-                     balance = 0
-                     end_idx = -1
-                     for i in range(start_idx, len(json_content)):
-                         if json_content[i] == '[':
-                             balance += 1
-                         elif json_content[i] == ']':
-                             balance -= 1
-                             if balance == 0:
-                                 end_idx = i
-                                 break
-                     
-                     if end_idx != -1:
-                         json_content = json_content[start_idx:end_idx+1]
-                     else:
-                          # Fallback to last bracket if structure is broken
-                          end_idx = json_content.rfind(']')
-                          if end_idx > start_idx:
-                              json_content = json_content[start_idx:end_idx+1]
-             
-             # Post-process validation logic
-             parsed_findings = []
-             try:
-                 temp_findings = json.loads(json_content)
-                 if isinstance(temp_findings, list):
-                     for item in temp_findings:
-                         box = item.get("box_2d", [])
-                         if len(box) == 4:
-                             # Parse coordinates (Model outputs 0-1000 integers or float strings)
-                             try:
-                                 ymin, xmin, ymax, xmax = [float(c) for c in box]
-                             except (ValueError, TypeError):
-                                 continue
-
-                             # Fix Geometry (Zero width/height) and Clamp to 0-1000
-                             if ymax <= ymin: ymax = min(ymin + 10, 1000)
-                             if xmax <= xmin: xmax = min(xmin + 10, 1000)
-                             ymin = max(0, min(ymin, 1000))
-                             xmin = max(0, min(xmin, 1000))
-                             ymax = max(0, min(ymax, 1000))
-                             xmax = max(0, min(xmax, 1000))
-
-                             item["box_2d"] = [ymin, xmin, ymax, xmax]
-                             parsed_findings.append(item)
-                 
-                 # Re-serialize to strict JSON string for frontend to parse safely
-                 json_content = json.dumps(parsed_findings, ensure_ascii=False)
-                 
-             except json.JSONDecodeError:
-                 pass # Let the caller handle the error or return raw
-
-             return {
-                  "raw_response": response_text,
-                  "thought_trace": thought_content,
-                  "findings": json_content # Caller will attempt json.loads
-             }
+             return {**self.parse_response(response_text), "usage": usage}
              
+        except Cancelled:
+             cancel_token.reclaimed("generate")
+             raise
         except Exception as e:
              LOGGER.error(f"Detection failed: {e}")
              raise e
+        finally:
+             planner.release(reservation)
+
+    @staticmethod
+    def parse_response(response_text):
+        """Raw detection output -> thought trace + findings JSON string (validated boxes)."""
+        # Parse Thinking vs JSON
+        # If <thought> tags exist, separate them
+        thought_content = ""
+        json_content = response_text
+        
+        if "<unused94>" in response_text: # <thought> start
+             parts = response_text.split("<unused95>") # <thought> end
+             if len(parts) > 1:
+                  thought_content = parts[0].replace("<unused94>", "").strip()
+                  json_content = parts[1].strip()
+             else:
+                  # Maybe thought didn't close?
+                  json_content = response_text
+        
+        # Clean JSON string (remove markdown code blocks if any)
+        # Optimized extraction: Try to find the first valid markdown JSON block first
+        # This prevents issues where the model repeats the JSON block multiple times
+        json_block_match = re.search(r"```(?:json)?\s*(\[[\s\S]*?\])\s*```", json_content)
+        
+        if json_block_match:
+            json_content = json_block_match.group(1)
+        else:
+            # Fallback: Clean manually
+            json_content = json_content.replace("```json", "").replace("```", "")
+            # Also strip common special tokens that might persist
+            for token in ["<end_of_turn>", "<eos>", "</s>"]:
+                json_content = json_content.replace(token, "")
+            
+            json_content = json_content.strip()
+            
+            # Robust extraction: find outer brackets of the FIRST valid structure
+            start_idx = json_content.find('[')
+            if start_idx != -1:
+                balance = 0
+                end_idx = -1
+                for i in range(start_idx, len(json_content)):
+                    if json_content[i] == '[':
+                        balance += 1
+                    elif json_content[i] == ']':
+                        balance -= 1
+                        if balance == 0:
+                            end_idx = i
+                            break
+                
+                if end_idx != -1:
+                    json_content = json_content[start_idx:end_idx+1]
+                else:
+                     # Fallback to last bracket if structure is broken
+                     end_idx = json_content.rfind(']')
+                     if end_idx > start_idx:
+                         json_content = json_content[start_idx:end_idx+1]
+        
+        # Post-process validation logic
+        parsed_findings = []
+        try:
+            temp_findings = json.loads(json_content)
+            if isinstance(temp_findings, list):
+                for item in temp_findings:
+                    box = item.get("box_2d", [])
+                    if len(box) == 4:
+                        # Parse coordinates (Model outputs 0-1000 integers or float strings)
+                        try:
+                            ymin, xmin, ymax, xmax = [float(c) for c in box]
+                        except (ValueError, TypeError):
+                            continue
+
+                        # Fix Geometry (Zero width/height) and Clamp to 0-1000
+                        if ymax <= ymin: ymax = min(ymin + 10, 1000)
+                        if xmax <= xmin: xmax = min(xmin + 10, 1000)
+                        ymin = max(0, min(ymin, 1000))
+                        xmin = max(0, min(xmin, 1000))
+                        ymax = max(0, min(ymax, 1000))
+                        xmax = max(0, min(xmax, 1000))
+
+                        item["box_2d"] = [ymin, xmin, ymax, xmax]
+                        parsed_findings.append(item)
+            
+            # Re-serialize to strict JSON string for frontend to parse safely
+            json_content = json.dumps(parsed_findings, ensure_ascii=False)
+            
+        except json.JSONDecodeError:
+            pass # Let the caller handle the error or return raw
+
+        return {
+             "raw_response": response_text,
+             "thought_trace": thought_content,
+             "findings": json_content, # Caller will attempt json.loads
+        }
@@ -0,0 +1,449 @@
+"""
+Engine replica pool (推理引擎副本池).
+
+Hosts N MedGemmaEngine replicas, each pinned to its own device (GPU) or CPU set,
+and routes chat / detection / CT-chat requests to the least-loaded healthy replica.
+Replicas can be drained (no new work, in-flight work finishes) and are
+periodically health-checked.
+
+Configuration (MEDGEMMA_REPLICAS, comma separated):
+    unset              -> single replica wrapping the model_engine.engine singleton
+    "cuda:0,cuda:1"    -> one replica per GPU
+    "cpu[0-3],cpu[4-7]" -> CPU replicas pinned to cores 0-3 and 4-7
+
+A CPU set pins the replica's generation threads only; torch's intra-op thread
+pool is process-wide and shared by all replicas of the process, so in-process
+CPU replicas do not scale like separate sockets. For that, run one model server
+per CPU set instead (python model_server.py --cpus 0-15), each with its own API
+workers.
+
+MEDGEMMA_ENGINE="module:callable" swaps in another engine class/factory taking the
+MedGemmaEngine constructor arguments (e.g. benchmarks.stub_engine:StubEngine).
+
+Every replica holds the same set of model variants (model_registry.py); requests
+name one with model_variant.
+
+After a CT upload, prefill_ct_context() prefills the CT prompt prefix on one
+replica in its idle time (prefix_cache.py); CT questions are routed to it.
+"""
+import os
+import re
+import importlib
+import time
+import threading
+import logging
+from typing import List, Optional
+
+import torch
+
+import cancellation
+import ct_service
+import prefix_cache
+from cancellation import Cancelled
+from model_engine import MedGemmaEngine, engine as default_engine
+from detection_service import DetectionService
+from memory_planner import MemoryBudgetExceeded
+from model_registry import ModelRegistry, VariantLoadError
+
+LOGGER = logging.getLogger("MedGemma")
+
+# Consecutive request failures before a replica is taken out of rotation.
+MAX_CONSECUTIVE_FAILURES = 3
+
+
+class NoReplicaAvailable(RuntimeError):
+    pass
+
+
+def parse_cpu_set(spec: str) -> set:
+    """'0-3,8' -> {0, 1, 2, 3, 8}"""
+    cpus = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            lo, hi = part.split("-", 1)
+            cpus.update(range(int(lo), int(hi) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+
+def parse_replica_specs(spec: str) -> List[dict]:
+    """Parse MEDGEMMA_REPLICAS into [{"device": ..., "cpu_affinity": ...}, ...]."""
+    specs = []
+    # Split on commas that are not inside a [...] CPU set
+    for token in re.findall(r"[^,\[]+(?:\[[^\]]*\])?", spec):
+        token = token.strip()
+        if not token:
+            continue
+        match = re.fullmatch(r"(cpu|cuda(?::\d+)?)(?:\[([^\]]*)\])?", token)
+        if not match:
+            raise ValueError(f"Invalid replica spec: {token!r}")
+        device, cpus = match.group(1), match.group(2)
+        specs.append({"device": device, "cpu_affinity": parse_cpu_set(cpus) if cpus else None})
+    return specs
+
+
+def resolve_engine_factory():
+    """Engine class/factory named by MEDGEMMA_ENGINE, or MedGemmaEngine."""
+    spec = os.environ.get("MEDGEMMA_ENGINE", "").strip()
+    if not spec:
+        return MedGemmaEngine
+    module_name, _, attr = spec.partition(":")
+    factory = getattr(importlib.import_module(module_name), attr or "Engine")
+    LOGGER.info(f"Using engine factory: {spec}")
+    return factory
+
+
+class Replica:
+    def __init__(self, name: str, registry: ModelRegistry):
+        self.name = name
+        self.registry = registry
+        # Detection is a blocking full-length generation; one at a time per replica.
+        self.detect_lock = threading.Lock()
+        self.inflight = 0
+        self.served = 0
+        self.failures = 0
+        self.healthy = False
+        self.draining = False
+        self.last_error: Optional[str] = None
+
+    @property
+    def engine(self) -> MedGemmaEngine:
+        """The startup variant's engine (placement, lifecycle)."""
+        return self.registry.engine
+
+    @property
+    def available(self):
+        return self.healthy and not self.draining
+
+    def status(self):
+        return {
+            "name": self.name,
+            "device": self.engine.device or "auto",
+            "cpu_affinity": sorted(self.engine.cpu_affinity) if self.engine.cpu_affinity else None,
+            "healthy": self.healthy,
+            "draining": self.draining,
+            "inflight": self.inflight,
+            "served": self.served,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "memory": self.engine.memory.status() if getattr(self.engine, "memory", None) else None,
+            "static_decode": self.engine.static_decode.status() if getattr(self.engine, "static_decode", None) else None,
+            "prefix_cache": self.engine.prefix_cache.status(),
+            "variants": self.registry.status(),
+        }
+
+
+class EnginePool:
+    """
+    Exposes the MedGemmaEngine surface app.py uses (generate / load_model / model)
+    plus detect_findings, routing each call to the least-loaded replica.
+    """
+    def __init__(self, replicas: List[Replica]):
+        if not replicas:
+            raise ValueError("EnginePool needs at least one replica.")
+        self.replicas = replicas
+        self._lock = threading.Lock()
+        self._monitor = None
+
+    @classmethod
+    def from_env(cls):
+        spec = os.environ.get("MEDGEMMA_REPLICAS", "").strip()
+        factory = resolve_engine_factory()
+        if not spec:
+            engine = default_engine if factory is MedGemmaEngine else factory()
+            return cls([Replica("default", ModelRegistry.for_replica(engine, factory))])
+        replicas = []
+        for i, s in enumerate(parse_replica_specs(spec)):
+            # CPU replicas run unquantized; bitsandbytes 4-bit targets CUDA.
+            engine = factory(
+                use_quantization=False if s["device"] == "cpu" else None,
+                device=s["device"],
+                cpu_affinity=s["cpu_affinity"],
+            )
+            registry = ModelRegistry.for_replica(engine, factory, device=s["device"], cpu_affinity=s["cpu_affinity"])
+            replicas.append(Replica(f"replica-{i}", registry))
+        LOGGER.info(f"Engine pool configured with {len(replicas)} replicas: {spec}")
+        if sum(1 for s in parse_replica_specs(spec) if s["device"] == "cpu") > 1:
+            LOGGER.warning("CPU replicas in one process share torch's intra-op threads; "
+                           "use one model server per CPU set (--cpus) to isolate them.")
+        return cls(replicas)
+
+    # --- Lifecycle ---
+
+    @property
+    def model(self):
+        """Model of the first healthy replica (None if nothing is loaded)."""
+        for replica in self.replicas:
+            engine = replica.registry.loaded_engine()
+            if replica.healthy and engine is not None:
+                return engine.model
+        return None
+
+    def variants(self) -> dict:
+        """Variant names (same on every replica) and the default one."""
+        registry = self.replicas[0].registry
+        return {"default": registry.default, "variants": registry.names()}
+
+    def load_model(self):
+        errors = []
+        for replica in self.replicas:
+            try:
+                replica.registry.load(replica.registry.get())
+                replica.healthy = True
+                replica.failures = 0
+            except Exception as e:
+                replica.healthy = False
+                replica.last_error = str(e)
+                errors.append(e)
+                LOGGER.error(f"Replica {replica.name} failed to load: {e}")
+        if len(errors) == len(self.replicas):
+            raise errors[0]
+        self.start_health_monitor()
+
+    # --- Routing ---
+
+    def _acquire(self, messages=None) -> Replica:
+        with self._lock:
+            candidates = [r for r in self.replicas if r.available]
+            if not candidates:
+                raise NoReplicaAvailable("No healthy engine replica available.")
+            if messages is not None:
+                # CT questions go to the replica holding their prefilled prefix
+                holders = [r for r in candidates if r.engine.prefix_cache.matches(messages)]
+                candidates = holders or candidates
+            # Least loaded first, then the one that has served least (round-robin on ties)
+            replica = min(candidates, key=lambda r: (r.inflight, r.served))
+            replica.inflight += 1
+            replica.served += 1
+            return replica
+
+    def _release(self, replica: Replica, error=None):
+        with self._lock:
+            replica.inflight -= 1
+            if isinstance(error, (MemoryBudgetExceeded, VariantLoadError, Cancelled)):
+                # turned away by the memory planner / a misconfigured variant, or given up by the
+                # client; says nothing about the replica's health
+                return
+            if error is None:
+                replica.failures = 0
+            else:
+                replica.failures += 1
+                replica.last_error = str(error)
+                if replica.failures >= MAX_CONSECUTIVE_FAILURES and replica.healthy:
+                    replica.healthy = False
+                    LOGGER.warning(f"Replica {replica.name} marked unhealthy after {replica.failures} failures.")
+
+    def generate(self, messages, model_variant: Optional[str] = None, **kwargs):
+        registry = self.replicas[0].registry
+        # Unknown names fail before taking a replica; prefixes are prefilled on the startup variant
+        prefixed = registry.get(model_variant).name == registry.default
+        replica = self._acquire(messages if prefixed else None)
+        variant = None
+
+        def done(error):
+            if variant is not None:
+                replica.registry.release(variant)
+            self._release(replica, error)
+
+        try:
+            # May load the variant (evicting an idle one) before generation starts
+            variant = replica.registry.acquire(model_variant)
+            return variant.engine.generate(messages, on_complete=done, **kwargs)
+        except Exception as e:
+            done(e)
+            raise
+
+    def detect_findings(self, messages, model_variant: Optional[str] = None, cancel_token=None,
+                        prepared=None, custom_system_prompt=None, **kwargs):
+        """
+        Detection on the least-loaded replica, one at a time per replica. The prompt is tokenized and
+        its image processed before the replica's detect lock is taken (prepared: made ahead by
+        prepare_detection() on the preprocessing stage).
+        """
+        self.replicas[0].registry.get(model_variant)
+        if prepared is None:
+            prepared = self.prepare_detection(messages, model_variant, custom_system_prompt)
+        replica = self._acquire()
+        error = None
+        variant = None
+        try:
+            # A request waiting behind another detection gives up here once cancelled
+            with cancellation.acquire(replica.detect_lock, cancel_token):
+                variant = replica.registry.acquire(model_variant)
+                with variant.engine.pinned():
+                    return DetectionService(variant.engine).detect_findings(
+                        messages, cancel_token=cancel_token, prepared=prepared,
+                        custom_system_prompt=custom_system_prompt, **kwargs)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if variant is not None:
+                replica.registry.release(variant)
+            self._release(replica, error)
+
+    def prepare_inputs(self, messages, model_variant: Optional[str] = None):
+        """
+        Processor output for `messages` (MedGemmaEngine.prepare_inputs) from a replica holding
+        the variant, for generate(prepared=...); None while it is not loaded anywhere.
+        """
+        name = self.replicas[0].registry.get(model_variant).name
+        for replica in self.replicas:
+            variant = replica.registry.get(name)
+            if replica.available and variant.loaded:
+                return variant.engine.prepare_inputs(messages)
+        return None
+
+    def prepare_detection(self, messages, model_variant: Optional[str] = None, custom_system_prompt=None):
+        """Detection prompt inputs (DetectionService.prepare_inputs) for detect_findings(prepared=...), like prepare_inputs."""
+        name = self.replicas[0].registry.get(model_variant).name
+        for replica in self.replicas:
+            variant = replica.registry.get(name)
+            if replica.available and variant.loaded:
+                return DetectionService(variant.engine).prepare_inputs(messages, custom_system_prompt)
+        return None
+
+    def generate_batch(self, conversations, model_variant: Optional[str] = None, **kwargs):
+        """Blocking batched generation (MedGemmaEngine.generate_batch) on the least-loaded replica."""
+        self.replicas[0].registry.get(model_variant)
+        replica = self._acquire()
+        error = None
+        variant = None
+        try:
+            variant = replica.registry.acquire(model_variant)
+            return variant.engine.generate_batch(conversations, **kwargs)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if variant is not None:
+                replica.registry.release(variant)
+            self._release(replica, error)
+
+    def prefill_ct_context(self, context_id: str, system_prompt: str) -> Optional[str]:
+        """
+        Prefill the prompt prefix of questions on the cached CT context (as app.py builds
+        them) on the least-loaded replica, in its idle time. Returns the replica name.
+        """
+        if not prefix_cache.ENABLED:
+            return None
+        active_id, images = ct_service.get_context()
+        if context_id != active_id or not images:
+            return None
+        messages = [{"role": "system", "content": system_prompt},
+                    {"role": "user", "content": ct_service.build_context_content(images, "")}]
+        with self._lock:
+            candidates = [r for r in self.replicas if r.available and r.engine.model is not None]
+            if not candidates:
+                return None
+            replica = min(candidates, key=lambda r: (r.inflight, r.served))
+        for other in self.replicas:
+            if other is not replica:
+                other.engine.prefix_cache.clear()
+        replica.engine.prefix_cache.schedule(messages, is_busy=lambda: replica.inflight > 0)
+        LOGGER.info(f"CT prefix prefill of context {context_id} scheduled on {replica.name}.")
+        return replica.name
+
+    # --- Administration ---
+
+    def get_replica(self, name: str) -> Replica:
+        for replica in self.replicas:
+            if replica.name == name:
+                return replica
+        raise KeyError(f"Unknown replica: {name}")
+
+    def drain(self, name: str, timeout: Optional[float] = None, unload: bool = False):
+        """Stop routing new work to a replica; optionally wait for in-flight work and unload it."""
+        replica = self.get_replica(name)
+        replica.draining = True
+        LOGGER.info(f"Draining replica {name} ({replica.inflight} in flight).")
+        if timeout is None:
+            return replica.status()
+        deadline = time.time() + timeout
+        while replica.inflight > 0 and time.time() < deadline:
+            time.sleep(0.1)
+        if unload and replica.inflight == 0:
+            replica.registry.unload_all()
+            replica.healthy = False
+        return replica.status()
+
+    def undrain(self, name: str):
+        replica = self.get_replica(name)
+        if replica.registry.loaded_engine() is None:
+            replica.registry.load(replica.registry.get())
+            replica.healthy = True
+            replica.failures = 0
+        replica.draining = False
+        LOGGER.info(f"Replica {name} back in rotation.")
+        return replica.status()
+
+    def status(self):
+        return {"replicas": [r.status() for r in self.replicas]}
+
+    # --- Health checks ---
+
+    def check_replica(self, replica: Replica) -> bool:
+        """Cheap liveness probe: model present, device reachable, one-token forward pass succeeds."""
+        # Probes whichever variant is resident (the startup one may have been evicted)
+        engine = replica.registry.loaded_engine()
+        if engine is None:
+            return False
+        try:
+            device = engine.model.device
+            if device.type == "cuda":
+                torch.cuda.mem_get_info(device)
+            # The forward pass runs only on an idle replica, holding a lease so the router
+            # sends new work elsewhere meanwhile
+            with self._lock:
+                idle = replica.inflight == 0
+                if idle:
+                    replica.inflight += 1
+            if idle:
+                try:
+                    with torch.no_grad(), engine.pinned():
+                        bos = engine.processor.tokenizer.bos_token_id or 0
+                        engine.model(input_ids=torch.tensor([[bos]], device=device))
+                finally:
+                    with self._lock:
+                        replica.inflight -= 1
+            return True
+        except Exception as e:
+            replica.last_error = f"health check: {e}"
+            return False
+
+    def health_check(self):
+        for replica in self.replicas:
+            if replica.draining and replica.registry.loaded_engine() is None:
+                continue
+            ok = self.check_replica(replica)
+            if ok and not replica.healthy:
+                LOGGER.info(f"Replica {replica.name} passed health check; back in rotation.")
+                replica.failures = 0
+            elif not ok and replica.healthy:
+                LOGGER.warning(f"Replica {replica.name} failed health check: {replica.last_error}")
+            replica.healthy = ok
+        return self.status()
+
+    def start_health_monitor(self, interval: Optional[float] = None):
+        interval = interval or float(os.environ.get("MEDGEMMA_HEALTH_INTERVAL", "30"))
+        if self._monitor is not None or interval <= 0:
+            return
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.health_check()
+                except Exception as e:
+                    LOGGER.error(f"Pool health check failed: {e}")
+
+        self._monitor = threading.Thread(target=loop, name="engine-pool-health", daemon=True)
+        self._monitor.start()
+
+
+# Singleton instance
+pool = EnginePool.from_env()
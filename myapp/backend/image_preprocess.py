@@ -0,0 +1,163 @@
+"""
+Batched image preprocessing for the Gemma 3 processor (批量图像预处理).
+
+The processor is loaded with use_fast=False, so every image in a prompt goes
+through the per-image PIL resize / rescale / normalize loop of the slow image
+processor; an 85-slice CT question pays that on every request. BatchedImageProcessor
+replaces processor.image_processor and does the same work for a whole stack at once:
+
+    uint8 HWC images -> (N, 3, H, W) uint8 tensor per input size
+    -> one antialiased bilinear F.interpolate to size["height"] x size["width"]
+    -> one fused rescale + normalize into float32 pixel_values
+
+The resize kernel is torch's uint8 path, which follows PIL's BILINEAR filter; PIL
+rounds to 8 bits between its horizontal and vertical passes, so single pixels can
+differ by up to MAX_LEVEL_DIFF grey levels (compare_with_slow() measures it).
+Pan-and-scan, non-bilinear resampling and unknown options are delegated to the
+slow processor unchanged.
+
+    MEDGEMMA_FAST_PREPROCESS   0 keeps the slow processor (default 1)
+"""
+import os
+import time
+import logging
+from typing import List
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from transformers import BatchFeature
+
+LOGGER = logging.getLogger("MedGemma")
+
+FAST_PREPROCESS = os.environ.get("MEDGEMMA_FAST_PREPROCESS", "1") != "0"
+PIL_BILINEAR = 2
+MAX_LEVEL_DIFF = 2
+
+# Options that do not change the result of the fast path
+PASSTHROUGH_KWARGS = {"return_tensors", "do_convert_rgb", "data_format", "input_data_format"}
+# Options the fast path implements, as long as they equal the processor's own settings
+CONFIG_KWARGS = ("do_resize", "size", "resample", "do_rescale", "rescale_factor",
+                 "do_normalize", "image_mean", "image_std")
+
+
+def _flatten(images) -> list:
+    if isinstance(images, (list, tuple)):
+        return [img for item in images for img in _flatten(item)]
+    return [images]
+
+
+def _to_uint8_rgb(image):
+    """PIL image / HWC uint8 array -> HWC uint8 RGB array; None if the fast path cannot take it."""
+    if isinstance(image, Image.Image):
+        return np.asarray(image if image.mode == "RGB" else image.convert("RGB"))
+    if isinstance(image, np.ndarray) and image.dtype == np.uint8:
+        if image.ndim == 2:
+            return np.repeat(image[:, :, None], 3, axis=2)
+        if image.ndim == 3 and image.shape[2] == 3:
+            return image
+    return None
+
+
+class BatchedImageProcessor:
+    """Drop-in for processor.image_processor; anything it does not implement goes to the slow one."""
+    def __init__(self, slow):
+        self.slow = slow
+
+    def __getattr__(self, name):
+        if name == "slow":
+            raise AttributeError(name)
+        return getattr(self.slow, name)
+
+    def __call__(self, images, **kwargs):
+        return self.preprocess(images, **kwargs)
+
+    def _slow_reason(self, kwargs):
+        """Why these options need the slow processor (None: the fast path applies)."""
+        if kwargs.get("do_pan_and_scan", getattr(self.slow, "do_pan_and_scan", None)):
+            return "pan-and-scan"
+        if int(getattr(self.slow, "resample", PIL_BILINEAR)) != PIL_BILINEAR:
+            return f"resample={self.slow.resample}"
+        for key, value in kwargs.items():
+            if value is None or key in PASSTHROUGH_KWARGS or key.startswith("pan_and_scan_"):
+                continue
+            if key in CONFIG_KWARGS and value == getattr(self.slow, key, None):
+                continue
+            return f"{key}={value!r}"
+        return None
+
+    def preprocess(self, images, **kwargs) -> BatchFeature:
+        flat = _flatten(images)
+        reason = self._slow_reason(kwargs)
+        arrays = [_to_uint8_rgb(img) for img in flat] if reason is None else []
+        if reason is None and any(a is None for a in arrays):
+            reason = "unsupported image type"
+        if reason is not None or not flat:
+            if reason:
+                LOGGER.debug(f"Slow image preprocessing: {reason}")
+            return self.slow(images, **kwargs)
+        pixel_values = self.pixel_values(arrays)
+        return_tensors = kwargs.get("return_tensors")
+        if return_tensors == "np":
+            pixel_values = pixel_values.numpy()
+        return BatchFeature(data={"pixel_values": pixel_values, "num_crops": [0] * len(arrays)},
+                            tensor_type=return_tensors)
+
+    def pixel_values(self, arrays: List[np.ndarray]) -> torch.Tensor:
+        slow = self.slow
+        height, width = slow.size["height"], slow.size["width"]
+        out = torch.empty((len(arrays), 3, height, width), dtype=torch.float32)
+
+        # rescale then normalize, folded into one multiply-add per channel
+        scale = torch.full((1, 3, 1, 1), slow.rescale_factor if slow.do_rescale else 1.0, dtype=torch.float32)
+        shift = torch.zeros((1, 3, 1, 1), dtype=torch.float32)
+        if slow.do_normalize:
+            mean = torch.tensor(slow.image_mean, dtype=torch.float32).view(1, -1, 1, 1)
+            std = torch.tensor(slow.image_std, dtype=torch.float32).view(1, -1, 1, 1)
+            scale, shift = scale / std, -mean / std
+
+        # One interpolate call per distinct input size (CT stacks share one size)
+        groups = {}
+        for i, arr in enumerate(arrays):
+            groups.setdefault(arr.shape[:2], []).append(i)
+        for shape, indices in groups.items():
+            batch = torch.from_numpy(np.stack([arrays[i] for i in indices])).permute(0, 3, 1, 2).contiguous()
+            if slow.do_resize and shape != (height, width):
+                batch = F.interpolate(batch, size=(height, width), mode="bilinear", antialias=True, align_corners=False)
+            if indices == list(range(indices[0], indices[-1] + 1)):
+                out[indices[0]:indices[-1] + 1].copy_(batch)  # uint8 -> float32 straight into the output
+            else:
+                out.index_copy_(0, torch.tensor(indices), batch.to(torch.float32))
+        return out.mul_(scale).add_(shift)
+
+
+def install(processor):
+    """Swap the processor's image processor for the batched one (no-op if disabled / already done)."""
+    image_processor = getattr(processor, "image_processor", None)
+    if not FAST_PREPROCESS or image_processor is None or isinstance(image_processor, BatchedImageProcessor):
+        return processor
+    processor.image_processor = BatchedImageProcessor(image_processor)
+    LOGGER.info(f"Batched image preprocessing enabled ({type(image_processor).__name__}).")
+    return processor
+
+
+def compare_with_slow(batched: BatchedImageProcessor, images) -> dict:
+    """Run both paths on the same images; max_abs_diff is in pixel_values units."""
+    t0 = time.perf_counter()
+    fast = batched(images, return_tensors="pt")["pixel_values"]
+    t1 = time.perf_counter()
+    slow = batched.slow(images, return_tensors="pt")["pixel_values"]
+    t2 = time.perf_counter()
+    diff = (fast - slow).abs()
+    # One grey level in pixel_values units
+    level = batched.slow.rescale_factor / min(batched.slow.image_std) if batched.slow.do_normalize else batched.slow.rescale_factor
+    return {
+        "images": len(_flatten(images)),
+        "fast_ms": round((t1 - t0) * 1000, 1),
+        "slow_ms": round((t2 - t1) * 1000, 1),
+        "max_abs_diff": float(diff.max()),
+        "mean_abs_diff": float(diff.mean()),
+        "max_level_diff": round(float(diff.max()) / level, 3),
+        "equivalent": float(diff.max()) <= MAX_LEVEL_DIFF * level + 1e-6,
+    }
@@ -0,0 +1,340 @@
+"""
+Per-request memory planner (显存/内存预算规划).
+
+Estimates what one generation will hold on the model's device from the model
+config and commits it against a fixed budget before generation starts:
+
+    kv cache      2 * kv_heads * head_dim * dtype bytes per token and layer;
+                  sliding-window layers hold at most sliding_window tokens
+    prefill       hidden / MLP activations of the prompt, plus fp32 logits
+    vision tower  SigLIP activations for every image in the prompt (one batch,
+                  before the prefill, so the larger of the two is counted)
+
+A request that can never fit has its max_new_tokens clamped (or is rejected when
+even MIN_NEW_TOKENS do not fit); one that fits but not next to the generations
+already running waits up to MEDGEMMA_MEMORY_QUEUE_S, then is rejected with
+MemoryBudgetExceeded (HTTP 503). Accounting is plain arithmetic, so it works the
+same for CPU replicas.
+
+The budget belongs to the device, not to a model: every replica and model
+variant on one GPU (or all CPU replicas, which share host memory) commits
+against the same DeviceBudget. It is measured when the first model on the
+device is loaded; each further model loaded there takes its weights out of it,
+and gives them back when it is unloaded.
+
+    MEDGEMMA_MEMORY_BUDGET_MB  budget per device (default: free device memory after
+                               the first load, or available host memory for CPU, times
+                               the fraction)
+    MEDGEMMA_MEMORY_FRACTION   share of free memory to plan with (default 0.9)
+    MEDGEMMA_MEMORY_OVERHEAD   safety factor on every estimate (default 1.2)
+    MEDGEMMA_MEMORY_QUEUE_S    max seconds a request waits for memory (default 30)
+"""
+import os
+import time
+import logging
+import threading
+from typing import Optional
+
+from cancellation import CANCEL_POLL_S
+from metrics import metrics
+
+LOGGER = logging.getLogger("MedGemma")
+
+MB = 1024 ** 2
+MEMORY_FRACTION = float(os.environ.get("MEDGEMMA_MEMORY_FRACTION", "0.9"))
+MEMORY_OVERHEAD = float(os.environ.get("MEDGEMMA_MEMORY_OVERHEAD", "1.2"))
+QUEUE_TIMEOUT = float(os.environ.get("MEDGEMMA_MEMORY_QUEUE_S", "30"))
+MIN_NEW_TOKENS = 64
+
+# medgemma-1.5-4b-it, used only when the model has no config of that kind at all
+DEFAULT_TEXT_CONFIG = {
+    "num_hidden_layers": 34, "num_key_value_heads": 4, "head_dim": 256, "hidden_size": 2560,
+    "intermediate_size": 10240, "vocab_size": 262208, "sliding_window": 1024, "sliding_window_pattern": 6,
+}
+DEFAULT_VISION_CONFIG = {"hidden_size": 1152, "intermediate_size": 4304, "image_size": 896, "patch_size": 14}
+
+
+class MemoryBudgetExceeded(RuntimeError):
+    """The request does not fit the memory budget (now or at all)."""
+    def __init__(self, message: str, retry_after: Optional[int] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _field(config, name, defaults):
+    """The config's own value; MedGemma's only for a model without such a config."""
+    if config is None:
+        return defaults.get(name)
+    return getattr(config, name, None)
+
+
+class ModelShape:
+    """The config numbers the estimates need, in the model's own dtype."""
+    def __init__(self, config=None, dtype_bytes: int = 2):
+        text = getattr(config, "text_config", None) or config
+        vision = getattr(config, "vision_config", None)
+        t = lambda name: _field(text, name, DEFAULT_TEXT_CONFIG)
+        v = lambda name: _field(vision, name, DEFAULT_VISION_CONFIG)
+        self.dtype_bytes = dtype_bytes
+        self.layers = t("num_hidden_layers")
+        self.hidden_size = t("hidden_size")
+        self.intermediate_size = t("intermediate_size")
+        self.vocab_size = t("vocab_size")
+        # None: every layer attends to the whole sequence
+        self.sliding_window = t("sliding_window")
+        layer_types = getattr(text, "layer_types", None)
+        if not self.sliding_window:
+            self.sliding_layers = 0
+        elif layer_types:
+            self.sliding_layers = sum(1 for kind in layer_types if kind == "sliding_attention")
+        else:
+            pattern = t("sliding_window_pattern")
+            self.sliding_layers = self.layers - self.layers // pattern if pattern else 0
+        head_dim = t("head_dim") or self.hidden_size // t("num_attention_heads")
+        self.kv_bytes_per_token = 2 * (t("num_key_value_heads") or t("num_attention_heads")) * head_dim * dtype_bytes
+        # A text-only model has no vision tower to account for
+        self.vision_hidden = v("hidden_size") if vision is not None or text is None else 0
+        self.vision_intermediate = v("intermediate_size") if self.vision_hidden else 0
+        self.patches_per_image = (v("image_size") // v("patch_size")) ** 2 if self.vision_hidden else 0
+
+    def kv_cache(self, tokens: int) -> int:
+        full_layers = self.layers - self.sliding_layers
+        windowed = min(tokens, self.sliding_window) if self.sliding_window else tokens
+        return self.kv_bytes_per_token * (full_layers * tokens + self.sliding_layers * windowed)
+
+    def activations(self, prompt_tokens: int, images: int) -> int:
+        # Peak of one layer (residual, norms, attention output, MLP). The vision tower runs on all
+        # images at once before the text prefill, so only the larger of the two counts.
+        text = prompt_tokens * (4 * self.hidden_size + 2 * self.intermediate_size) * self.dtype_bytes
+        vision = images * self.patches_per_image * (4 * self.vision_hidden + self.vision_intermediate) * self.dtype_bytes
+        logits = 2 * self.vocab_size * 4  # fp32 scores + probabilities for sampling
+        return max(text, vision) + logits
+
+
+class Reservation:
+    def __init__(self, nbytes: int, max_new_tokens: int, requested_tokens: int):
+        self.nbytes = nbytes
+        self.max_new_tokens = max_new_tokens
+        self.requested_tokens = requested_tokens
+        self.released = False
+
+    @property
+    def clamped(self) -> bool:
+        return self.max_new_tokens < self.requested_tokens
+
+
+class DeviceBudget:
+    """Memory committed to running generations on one device, by every planner placed there."""
+    def __init__(self, key: str, budget_bytes: Optional[int]):
+        self.key = key
+        self.budget = budget_bytes
+        self.committed = 0
+        self.active = 0
+        self.waiting = 0
+        self.peak = 0
+        self.models = 0
+        self.cond = threading.Condition()
+
+
+class MemoryPlanner:
+    """Sizes one model's requests and commits them against its device's shared budget."""
+    def __init__(self, shape: ModelShape, device: DeviceBudget, overhead: float = MEMORY_OVERHEAD,
+                 queue_timeout: float = QUEUE_TIMEOUT, weight_bytes: int = 0):
+        self.shape = shape
+        self.device = device
+        self.overhead = overhead
+        self.queue_timeout = queue_timeout
+        # Taken out of a budget measured before this model was loaded (see for_model)
+        self.weight_bytes = weight_bytes
+        self._cond = device.cond
+
+    @property
+    def budget(self) -> Optional[int]:
+        return self.device.budget
+
+    @property
+    def committed(self) -> int:
+        return self.device.committed
+
+    def estimate(self, prompt_tokens: int, images: int, max_new_tokens: int, preallocated_kv: bool = False) -> int:
+        """preallocated_kv: the generation uses a cache allocated before the budget was measured (compiled_decode.py)."""
+        shape = self.shape
+        need = shape.activations(prompt_tokens, images)
+        if not preallocated_kv:
+            need += shape.kv_cache(prompt_tokens + max_new_tokens)
+        return int(need * self.overhead)
+
+    def _fit_new_tokens(self, prompt_tokens: int, images: int, max_new_tokens: int, preallocated_kv: bool) -> int:
+        """Largest max_new_tokens <= the requested one whose estimate fits the whole budget (0: none)."""
+        lo, hi = 0, max_new_tokens
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self.estimate(prompt_tokens, images, mid, preallocated_kv) <= self.budget:
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+    def reserve(self, prompt_tokens: int, images: int, max_new_tokens: int, timeout: Optional[float] = None,
+                preallocated_kv: bool = False, cancel_token=None) -> Reservation:
+        """
+        Commit memory for one generation; clamps, waits or raises MemoryBudgetExceeded.
+        A cancelled cancel_token (cancellation.py) ends the wait with Cancelled.
+        """
+        if cancel_token is not None:
+            cancel_token.check("queue")
+        need = self.estimate(prompt_tokens, images, max_new_tokens, preallocated_kv)
+        tokens = max_new_tokens
+        if self.budget is not None and need > self.budget:
+            tokens = self._fit_new_tokens(prompt_tokens, images, max_new_tokens, preallocated_kv)
+            if tokens < min(MIN_NEW_TOKENS, max_new_tokens):
+                metrics.incr("memory_planner", outcome="rejected")
+                raise MemoryBudgetExceeded(
+                    f"Request needs {need / MB:.0f} MB ({prompt_tokens} prompt tokens, {images} images), "
+                    f"budget is {self.budget / MB:.0f} MB.")
+            need = self.estimate(prompt_tokens, images, tokens, preallocated_kv)
+            LOGGER.warning(f"max_new_tokens clamped {max_new_tokens} -> {tokens} to fit the memory budget.")
+            metrics.incr("memory_planner", outcome="clamped")
+
+        timeout = self.queue_timeout if timeout is None else timeout
+        device = self.device
+        with self._cond:
+            if self.budget is not None and device.committed + need > self.budget:
+                metrics.incr("memory_planner", outcome="queued")
+                LOGGER.info(f"Waiting for {need / MB:.0f} MB ({device.committed / MB:.0f} of {self.budget / MB:.0f} MB "
+                            f"committed on {device.key}).")
+                deadline = time.monotonic() + timeout
+                device.waiting += 1
+                try:
+                    while device.committed + need > self.budget:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            metrics.incr("memory_planner", outcome="timeout")
+                            raise MemoryBudgetExceeded(
+                                f"Memory budget busy: {need / MB:.0f} MB needed, "
+                                f"{(self.budget - device.committed) / MB:.0f} MB free after {timeout:.0f}s.",
+                                retry_after=max(1, int(timeout)))
+                        if cancel_token is not None:
+                            cancel_token.check("queue")
+                            remaining = min(remaining, CANCEL_POLL_S)
+                        self._cond.wait(remaining)
+                finally:
+                    device.waiting -= 1
+            device.committed += need
+            device.active += 1
+            device.peak = max(device.peak, device.committed)
+        metrics.incr("memory_planner", outcome="granted")
+        return Reservation(need, tokens, max_new_tokens)
+
+    def release(self, reservation: Optional[Reservation]):
+        if reservation is None or reservation.released:
+            return
+        reservation.released = True
+        with self._cond:
+            self.device.committed -= reservation.nbytes
+            self.device.active -= 1
+            self._cond.notify_all()
+
+    def shrink_to_kv(self, reservation: Reservation, tokens: int):
+        """Keep only the KV cache of `tokens` from a reservation whose activations are freed (prefix_cache.py)."""
+        if reservation.released:
+            return
+        keep = min(reservation.nbytes, int(self.shape.kv_cache(tokens) * self.overhead))
+        with self._cond:
+            self.device.committed -= reservation.nbytes - keep
+            reservation.nbytes = keep
+            self._cond.notify_all()
+
+    def close(self):
+        """The model was unloaded: its weights go back to the device budget."""
+        with _DEVICES_LOCK, self._cond:
+            device = self.device
+            device.models -= 1
+            if device.budget is not None:
+                device.budget += self.weight_bytes
+            self.weight_bytes = 0
+            self._cond.notify_all()
+
+    def status(self) -> dict:
+        device = self.device
+        with self._cond:
+            return {
+                "device": device.key,
+                "budget_mb": round(device.budget / MB, 1) if device.budget is not None else None,
+                "committed_mb": round(device.committed / MB, 1),
+                "peak_mb": round(device.peak / MB, 1),
+                "active": device.active,
+                "waiting": device.waiting,
+                "models": device.models,
+            }
+
+
+# One budget per device, shared by the replicas / variants placed on it
+_DEVICES = {}
+_DEVICES_LOCK = threading.Lock()
+
+
+def available_memory(device) -> Optional[int]:
+    """Free bytes on a CUDA device, or available host memory for CPU (None if unknown)."""
+    import torch
+    if device is not None and device.type == "cuda":
+        free, _total = torch.cuda.mem_get_info(device)
+        return free
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _weight_bytes(model) -> int:
+    try:
+        return int(model.get_memory_footprint())
+    except Exception:
+        return 0
+
+
+def for_model(model) -> MemoryPlanner:
+    """
+    Planner for a loaded model; call right after loading. The first model on a device measures
+    the device's budget (its own weights already resident); every later one takes its weights out.
+    """
+    # KV cache and activations are held in the compute dtype (float32 on a CPU run in full precision)
+    dtype = getattr(model, "dtype", None)
+    shape = ModelShape(getattr(model, "config", None), getattr(dtype, "itemsize", 2))
+    device = getattr(model, "device", None)
+    key = str(device) if device is not None else "cpu"
+    fixed = bool(os.environ.get("MEDGEMMA_MEMORY_BUDGET_MB"))
+    weights = 0
+    with _DEVICES_LOCK:
+        budget = _DEVICES.get(key)
+        if budget is None or budget.models == 0:
+            if fixed:
+                total = int(float(os.environ["MEDGEMMA_MEMORY_BUDGET_MB"]) * MB)
+            else:
+                free = available_memory(device)
+                total = int(free * MEMORY_FRACTION) if free is not None else None
+            if budget is None:
+                budget = _DEVICES[key] = DeviceBudget(key, total)
+            else:
+                with budget.cond:
+                    budget.budget = total
+        elif not fixed and budget.budget is not None:
+            # Measured before this model's weights were loaded (fixed budgets are the operator's call)
+            weights = _weight_bytes(model)
+            with budget.cond:
+                budget.budget = max(0, budget.budget - weights)
+        budget.models += 1
+    LOGGER.info(f"Memory planner budget on {key}: "
+                f"{f'{budget.budget / MB:.0f} MB' if budget.budget is not None else 'unlimited'}, "
+                f"shared by {budget.models} model(s) "
+                f"(KV cache {shape.kv_bytes_per_token * shape.layers / 1024:.0f} KB/token, {dtype}).")
+    return MemoryPlanner(shape, budget, weight_bytes=weights)
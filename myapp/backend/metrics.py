@@ -0,0 +1,35 @@
+"""
+In-process counters (运行指标), served at GET /api/metrics.
+
+    metrics.incr("generation_stops", kind="chat", reason="repetition_loop")
+
+snapshot() groups by counter name, one entry per label combination
+("kind=chat,reason=repetition_loop"). Counters are per API process.
+"""
+import time
+import threading
+from collections import defaultdict
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+        self.started_at = time.time()
+
+    def incr(self, name: str, value: int = 1, **labels):
+        key = (name, ",".join(f"{k}={v}" for k, v in sorted(labels.items())))
+        with self._lock:
+            self._counters[key] += value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+        grouped = defaultdict(dict)
+        for (name, labels), value in sorted(counters.items()):
+            grouped[name][labels] = value
+        return {"uptime_s": round(time.time() - self.started_at, 1), "counters": dict(grouped)}
+
+
+# Singleton instance
+metrics = Metrics()
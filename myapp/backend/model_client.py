@@ -0,0 +1,457 @@
+"""
+Client side of the dedicated model-server process (see model_server.py).
+
+API worker processes (app.py with MEDGEMMA_MODEL_SERVER set) never import torch
+or load the model. They decode images locally, park the raw RGB pixels in
+shared memory and talk to the single model-server process over a local socket.
+Token streams come back over the same connection.
+
+(API 工作进程不加载模型；图像经共享内存传递，Token 流经本地 Socket 返回。)
+"""
+import os
+import io
+import base64
+import queue
+import time
+import logging
+from multiprocessing import shared_memory, resource_tracker
+from multiprocessing.connection import Client
+import numpy as np
+from PIL import Image
+
+from cancellation import CANCEL_POLL_S, Cancelled
+from memory_planner import MemoryBudgetExceeded
+from model_registry import UnknownVariant
+
+LOGGER = logging.getLogger("MedGemma")
+
+DEFAULT_ADDRESS = "127.0.0.1:8765"
+DEFAULT_AUTHKEY = b"medgemma-model-server"
+
+# Seconds without a token before the stream is considered dead.
+# Mirrors the TextIteratorStreamer timeout used by MedGemmaEngine.generate.
+STREAM_TIMEOUT = 300.0
+
+
+def parse_address(address):
+    """'host:port' -> (host, port) tuple; anything else is used as-is (e.g. a pipe path)."""
+    if isinstance(address, str) and ":" in address and not address.startswith("\\\\"):
+        host, port = address.rsplit(":", 1)
+        return (host, int(port))
+    return address
+
+
+def get_authkey():
+    key = os.environ.get("MEDGEMMA_MODEL_SERVER_KEY")
+    return key.encode("utf-8") if key else DEFAULT_AUTHKEY
+
+
+# --- Shared-memory image transport ---
+
+def decode_image(image_data):
+    """Decode a base64 / data-URL / raw-bytes image into an RGB PIL image (arrays pass through)."""
+    if isinstance(image_data, np.ndarray):
+        return image_data
+    if isinstance(image_data, Image.Image):
+        return image_data.convert("RGB") if image_data.mode != "RGB" else image_data
+    if isinstance(image_data, str):
+        if image_data.startswith('data:image'):
+            image_data = image_data.split(",", 1)[1]
+        image_data = base64.b64decode(image_data)
+    return Image.open(io.BytesIO(image_data)).convert("RGB")
+
+
+def export_image(img):
+    """Copy an RGB image (PIL or uint8 array) into a new shared-memory block. Returns (handle, block)."""
+    raw = img.tobytes()
+    block = shared_memory.SharedMemory(create=True, size=max(len(raw), 1))
+    block.buf[:len(raw)] = raw
+    if isinstance(img, np.ndarray):
+        handle = {"shm": block.name, "nbytes": len(raw), "shape": img.shape, "dtype": img.dtype.str}
+    else:
+        handle = {"shm": block.name, "nbytes": len(raw), "size": img.size, "mode": img.mode}
+    return handle, block
+
+
+def import_image(handle):
+    """Materialize an image from a shared-memory handle (copies, then detaches)."""
+    block = shared_memory.SharedMemory(name=handle["shm"])
+    try:
+        # Attaching registers the block with this process' resource tracker on POSIX,
+        # which would unlink it behind the owner's back at exit. The owner unlinks.
+        if os.name == "posix":
+            try:
+                resource_tracker.unregister(block._name, "shared_memory")
+            except Exception:
+                pass
+        if "shape" in handle:
+            return np.frombuffer(block.buf[:handle["nbytes"]], dtype=handle["dtype"]).reshape(handle["shape"]).copy()
+        return Image.frombytes(handle["mode"], tuple(handle["size"]), bytes(block.buf[:handle["nbytes"]]))
+    finally:
+        block.close()
+
+
+def release_blocks(blocks):
+    for block in blocks:
+        try:
+            block.close()
+            block.unlink()
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            LOGGER.warning(f"Failed to release shared memory block {block.name}: {e}")
+    blocks.clear()
+
+
+def pack_messages(messages):
+    """
+    Replace image payloads in chat messages with shared-memory handles.
+    Decoding happens here, in the API worker, so it scales with the worker count.
+    Returns (packed_messages, blocks); the caller owns and must release the blocks.
+    """
+    blocks = []
+    packed = []
+    try:
+        for msg in messages:
+            content = msg.get("content")
+            if isinstance(content, list):
+                new_content = []
+                for item in content:
+                    # CT context references ({"ct_ref": ...}) are resolved by the server itself
+                    if item.get("type") == "image" and item.get("image") is not None and not is_ct_ref(item["image"]):
+                        handle, block = export_image(decode_image(item["image"]))
+                        blocks.append(block)
+                        item = {**item, "image": handle}
+                    new_content.append(item)
+                content = new_content
+            packed.append({**msg, "content": content})
+    except Exception:
+        release_blocks(blocks)
+        raise
+    return packed, blocks
+
+
+def remote_error(payload, cancel_token=None):
+    """Exception for an ("error", type, message) reply from the model server."""
+    name, message = payload[0], payload[1]
+    if name == "KeyError":
+        return KeyError(message)
+    if name == "MemoryBudgetExceeded":
+        return MemoryBudgetExceeded(message)
+    if name == "UnknownVariant":
+        return UnknownVariant(message)
+    if name == "Cancelled":
+        return Cancelled(cancel_token.reason if cancel_token is not None and cancel_token.reason else "deadline")
+    return RuntimeError(message)
+
+
+def wait_reply(conn, cancel_token=None):
+    """
+    Block until the server answers. A cancelled cancel_token sends ("abort",) once; the
+    server stops the work at its next step and answers with a Cancelled error.
+    """
+    if cancel_token is not None:
+        aborted = False
+        while not conn.poll(CANCEL_POLL_S):
+            if not aborted and cancel_token.cancelled:
+                aborted = True
+                conn.send(("abort",))
+    return conn.recv()
+
+
+def is_ct_ref(image):
+    return isinstance(image, dict) and "ct_ref" in image
+
+
+def unpack_messages(messages, resolve_ct_ref=None):
+    """
+    Server side: turn shared-memory handles back into images (PIL or uint8 arrays)
+    and CT context references into the cached slice pixels via resolve_ct_ref(context_id, index).
+    """
+    unpacked = []
+    for msg in messages:
+        content = msg.get("content")
+        if isinstance(content, list):
+            new_content = []
+            for item in content:
+                image = item.get("image") if item.get("type") == "image" else None
+                if isinstance(image, dict) and "shm" in image:
+                    item = {**item, "image": import_image(image)}
+                elif is_ct_ref(image) and resolve_ct_ref is not None:
+                    item = {**item, "image": resolve_ct_ref(*image["ct_ref"])}
+                new_content.append(item)
+            content = new_content
+        unpacked.append({**msg, "content": content})
+    return unpacked
+
+
+def pack_ct_result(processed_result):
+    """Move the pixels of a processed CT result into shared memory. Returns (packed, blocks)."""
+    blocks = []
+    packed = []
+    try:
+        for img_data in processed_result:
+            handle, block = export_image(img_data["pixels"])
+            blocks.append(block)
+            packed.append({**img_data, "pixels": handle})
+    except Exception:
+        release_blocks(blocks)
+        raise
+    return packed, blocks
+
+
+def unpack_ct_result(packed):
+    return [{**img_data, "pixels": import_image(img_data["pixels"])} for img_data in packed]
+
+
+# --- Remote proxies ---
+
+class RemoteStopper:
+    """Stand-in for AbortStoppingCriteria on the API-worker side."""
+    def __init__(self, conn, cancel_token=None):
+        self._conn = conn
+        self.cancel_token = cancel_token
+        self.aborted = False
+        self.info = {}
+
+    def abort(self):
+        if self.aborted:
+            return
+        self.aborted = True
+        if self.cancel_token is not None:
+            self.cancel_token.cancel("client_disconnected")
+        try:
+            self._conn.send(("abort",))
+        except (OSError, EOFError):
+            pass
+
+
+class RemoteStream:
+    """Iterates text chunks streamed back from the model server."""
+    def __init__(self, conn, stopper, blocks, timeout=STREAM_TIMEOUT):
+        self._conn = conn
+        self._stopper = stopper
+        self._blocks = blocks
+        self._timeout = timeout
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._closed:
+            raise StopIteration
+        try:
+            while True:
+                if not self._poll():
+                    raise queue.Empty()
+                msg = self._conn.recv()
+                kind = msg[0]
+                if kind == "chunk":
+                    return msg[1]
+                if kind == "end":
+                    self._stopper.info = msg[1] or {}
+                    self._stopper.aborted = self._stopper.aborted or self._stopper.info.get("aborted", False)
+                    self.close()
+                    raise StopIteration
+                if kind == "error":
+                    self.close()
+                    if msg[1] == "Empty":
+                        raise queue.Empty()
+                    raise RuntimeError(msg[2])
+        except (EOFError, OSError) as e:
+            self.close()
+            raise RuntimeError(f"Model server connection lost: {e}")
+
+    def _poll(self) -> bool:
+        """Wait for the next message; a cancelled request token is relayed as an abort meanwhile."""
+        token = self._stopper.cancel_token
+        if token is None:
+            return self._conn.poll(self._timeout)
+        waited = 0.0
+        while not self._conn.poll(CANCEL_POLL_S):
+            if token.cancelled and token.reason == "client_disconnected":
+                self._stopper.abort()
+            waited += CANCEL_POLL_S
+            if waited >= self._timeout:
+                return False
+        return True
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        release_blocks(self._blocks)
+        try:
+            self._conn.close()
+        except OSError:
+            pass
+
+
+class RemoteEngine:
+    """
+    Proxy with the same surface app.py uses on MedGemmaEngine
+    (generate / load_model / model), plus the ct_service context-cache functions
+    so the CT context lives in the one process every API worker shares.
+    """
+    def __init__(self, address=None, authkey=None):
+        self.address = parse_address(address or os.environ.get("MEDGEMMA_MODEL_SERVER", DEFAULT_ADDRESS))
+        self.authkey = authkey or get_authkey()
+
+    def _connect(self):
+        return Client(self.address, authkey=self.authkey)
+
+    def _call(self, request, timeout=None, cancel_token=None):
+        conn = self._connect()
+        try:
+            conn.send(request)
+            if timeout is not None and not conn.poll(timeout):
+                raise TimeoutError(f"Model server did not answer '{request.get('op')}' within {timeout}s")
+            kind, *payload = wait_reply(conn, cancel_token)
+            if kind == "error":
+                raise remote_error(payload, cancel_token)
+            return payload[0]
+        finally:
+            conn.close()
+
+    @property
+    def model(self):
+        """Truthy when the server reports a loaded model (keeps `engine.model is not None` checks working)."""
+        try:
+            return True if self._call({"op": "status"}, timeout=5)["model_loaded"] else None
+        except Exception:
+            return None
+
+    def load_model(self, wait=600.0):
+        """The server loads the model itself; here we only wait until it is reachable and ready."""
+        deadline = time.time() + wait
+        last_error = None
+        while time.time() < deadline:
+            try:
+                if self._call({"op": "status"}, timeout=5)["model_loaded"]:
+                    LOGGER.info(f"Model server at {self.address} is ready.")
+                    return
+            except Exception as e:
+                last_error = e
+            time.sleep(1.0)
+        raise RuntimeError(f"Model server at {self.address} not ready: {last_error}")
+
+    @staticmethod
+    def _with_deadline(kwargs, cancel_token):
+        """The server builds its own token from the (wall-clock) deadline; aborts arrive as messages."""
+        if cancel_token is not None and cancel_token.deadline is not None:
+            kwargs["deadline"] = cancel_token.deadline
+        return kwargs
+
+    def generate(self, messages, cancel_token=None, **kwargs):
+        packed, blocks = pack_messages(messages)
+        try:
+            conn = self._connect()
+            conn.send({"op": "generate", "messages": packed, "kwargs": self._with_deadline(kwargs, cancel_token)})
+        except Exception:
+            release_blocks(blocks)
+            raise
+        try:
+            # Wait for the server to start (or turn down) the generation
+            kind, *payload = wait_reply(conn, cancel_token)
+        except (EOFError, OSError) as e:
+            release_blocks(blocks)
+            raise RuntimeError(f"Model server connection lost: {e}")
+        if kind == "error":
+            conn.close()
+            release_blocks(blocks)
+            raise remote_error(payload, cancel_token)
+        # "accepted": the server has copied the images out of shared memory
+        release_blocks(blocks)
+        stopper = RemoteStopper(conn, cancel_token)
+        return RemoteStream(conn, stopper, []), stopper
+
+    def detect_findings(self, messages, cancel_token=None, **kwargs):
+        packed, blocks = pack_messages(messages)
+        try:
+            return self._call({"op": "detect", "messages": packed, "kwargs": self._with_deadline(kwargs, cancel_token)},
+                              cancel_token=cancel_token)
+        finally:
+            release_blocks(blocks)
+
+    def prepare_inputs(self, messages, model_variant=None):
+        """Tokenization and image processing happen in the model server (its processor, its device)."""
+        return None
+
+    def generate_batch(self, conversations, cancel_token=None, **kwargs):
+        packed, blocks = [], []
+        try:
+            for conv in conversations:
+                conv_packed, conv_blocks = pack_messages(conv)
+                packed.append(conv_packed)
+                blocks.extend(conv_blocks)
+            return self._call({"op": "generate_batch", "conversations": packed,
+                               "kwargs": self._with_deadline(kwargs, cancel_token)}, cancel_token=cancel_token)
+        finally:
+            release_blocks(blocks)
+
+    # EnginePool administration (see engine_pool.py)
+    def status(self):
+        return self._call({"op": "pool", "method": "status", "args": []})
+
+    def drain(self, name, timeout=None, unload=False):
+        return self._call({"op": "pool", "method": "drain", "args": [name, timeout, unload]})
+
+    def undrain(self, name):
+        return self._call({"op": "pool", "method": "undrain", "args": [name]})
+
+    def variants(self):
+        return self._call({"op": "pool", "method": "variants", "args": []})
+
+    def prefill_ct_context(self, context_id, system_prompt):
+        return self._call({"op": "pool", "method": "prefill_ct_context", "args": [context_id, system_prompt]})
+
+    # ct_service cache API (服务端 CT 缓存接口)
+    # Pixels cross the process boundary once, via shared memory, when a series is set.
+    # get_global_context() returns {"ct_ref": ...} placeholders the server resolves
+    # when the prompt comes back in generate(), so chat never ships the pixels.
+    def set_global_context(self, processed_result, context_id=None):
+        packed, blocks = pack_ct_result(processed_result)
+        try:
+            return self._call({"op": "ct_set", "images": packed, "context_id": context_id})
+        finally:
+            release_blocks(blocks)
+
+    def get_global_context(self):
+        return self._call({"op": "ct_get"})
+
+    def begin_context(self):
+        return self._call({"op": "ct_begin"})
+
+    def append_context(self, upload_id, img_data):
+        packed, blocks = pack_ct_result([img_data])
+        try:
+            self._call({"op": "ct_append", "upload_id": upload_id, "image": packed[0]})
+        finally:
+            release_blocks(blocks)
+
+    def commit_context(self, upload_id, context_id=None):
+        return self._call({"op": "ct_commit", "upload_id": upload_id, "context_id": context_id})
+
+    def discard_context(self, upload_id):
+        self._call({"op": "ct_discard", "upload_id": upload_id})
+
+    def get_slice_pixels(self, context_id, index):
+        return self._call({"op": "ct_slice", "context_id": context_id, "index": index})
+
+
+class RemoteDetectionService:
+    """DetectionService counterpart that forwards to the model server."""
+    def __init__(self, engine):
+        self.engine = engine
+
+    def prepare_detection(self, messages, model_variant=None, custom_system_prompt=None):
+        """The model server prepares detection inputs itself, before its per-replica detect lock."""
+        return None
+
+    def detect_findings(self, messages, temperature=0.2, custom_system_prompt=None, thinking_budget=None,
+                        model_variant=None, cancel_token=None, prepared=None):
+        # prepared is always None here (prepare_detection); tensors do not cross the process boundary
+        return self.engine.detect_findings(messages, temperature=temperature, custom_system_prompt=custom_system_prompt,
+                                           thinking_budget=thinking_budget, model_variant=model_variant,
+                                           cancel_token=cancel_token)
@@ -1,30 +1,132 @@
 import torch
-from transformers import AutoModelForImageTextToText, AutoProcessor, BitsAndBytesConfig, TextIteratorStreamer, StoppingCriteria, StoppingCriteriaList
+import numpy as np
+from transformers import AutoModelForImageTextToText, AutoProcessor, BitsAndBytesConfig, TextIteratorStreamer, StoppingCriteria, StoppingCriteriaList, LogitsProcessor, LogitsProcessorList
 from PIL import Image
 import io
 import base64
 import os
+import gc
+import time
 from threading import Thread
 import logging
-from typing import Optional
+from contextlib import contextmanager
+from typing import Optional, Callable, List
+
+from degeneration import DegenerationStoppingCriteria
+import cancellation
+from cancellation import Cancelled, CancelToken
+import image_preprocess
+import memory_planner
+import compiled_decode
+import prefix_cache
+import preprocess_pipeline
+from profiler import profiler
 
 # Setup Logger
 LOGGER = logging.getLogger("MedGemma")
 
+# Gemma thought markers (思考段标记)
+THOUGHT_START_TOKEN = "<unused94>"
+THOUGHT_END_TOKEN = "<unused95>"
+
+
+class ThoughtTracker:
+    """
+    Counts thought / answer tokens of one generation (batch row 0) as it grows.
+    observe() only looks at tokens it has not seen yet, so several hooks may call it.
+    """
+    def __init__(self, prompt_tokens: int, start_id: int, end_id: int):
+        self.start_id = start_id
+        self.end_id = end_id
+        self.seen = prompt_tokens
+        self.in_thought = False
+        self.thought_closed = False
+        self.thought_tokens = 0
+        self.answer_tokens = 0
+        self.budget_forced = False
+
+    def observe(self, input_ids):
+        new_tokens = input_ids[0, self.seen:].tolist()
+        self.seen = input_ids.shape[-1]
+        for token in new_tokens:
+            if token == self.start_id and not self.in_thought:
+                self.in_thought = True
+            elif token == self.end_id and self.in_thought:
+                self.in_thought = False
+                self.thought_closed = True
+            elif self.in_thought:
+                self.thought_tokens += 1
+            else:
+                self.answer_tokens += 1
+
+    def usage(self) -> dict:
+        return {"thought_tokens": self.thought_tokens, "answer_tokens": self.answer_tokens,
+                "thinking_budget_hit": self.budget_forced}
+
+
+class ThinkingBudgetProcessor(LogitsProcessor):
+    """
+    Caps the hidden reasoning: once `budget` thought tokens have been generated the
+    end-of-thought token is forced, and the answer continues normally afterwards.
+    budget=0 disables thinking (the start marker is suppressed); None only counts.
+    """
+    def __init__(self, tracker: ThoughtTracker, budget: Optional[int]):
+        self.tracker = tracker
+        self.budget = budget
+
+    def __call__(self, input_ids, scores):
+        self.tracker.observe(input_ids)
+        if self.budget is None:
+            return scores
+        if self.tracker.in_thought and self.tracker.thought_tokens >= self.budget:
+            self.tracker.budget_forced = True
+            forced = torch.full_like(scores, float("-inf"))
+            forced[:, self.tracker.end_id] = 0
+            return forced
+        if self.budget <= 0 and not self.tracker.in_thought:
+            scores[:, self.tracker.start_id] = float("-inf")
+        return scores
+
+
 class AbortStoppingCriteria(StoppingCriteria):
-    def __init__(self):
-        self.aborted = False
+    def __init__(self, prompt_tokens: int = 0, tracker: Optional[ThoughtTracker] = None,
+                 cancel_token: Optional[CancelToken] = None):
+        self.tracker = tracker
+        # Client disconnect or deadline (cancellation.py); cancelled is True once it ended the generation
+        self.cancel_token = cancel_token or CancelToken("chat")
+        self.cancelled = False
+        # Token counts reported in the SSE usage event (chat_stream.py)
+        self.info = {"prompt_tokens": prompt_tokens, "completion_tokens": 0}
 
     def __call__(self, input_ids, scores, **kwargs):
-        return self.aborted
+        self.info["completion_tokens"] = input_ids.shape[-1] - self.info["prompt_tokens"]
+        if self.tracker is not None:
+            # Runs after every appended token, so the counts include the last one
+            self.tracker.observe(input_ids)
+            self.info.update(self.tracker.usage())
+        if self.cancel_token.cancelled:
+            self.cancelled = True
+            if self.cancel_token.reason == "deadline":
+                self.info["stop_reason"] = "deadline"
+            return True
+        return False
+
+    @property
+    def aborted(self) -> bool:
+        """The client went away (abort(), or the request's disconnect watcher)."""
+        return self.cancel_token.reason == "client_disconnected"
 
     def abort(self):
-        self.aborted = True
+        self.cancel_token.cancel("client_disconnected")
 
 class MedGemmaEngine:
-    def __init__(self, use_quantization=None):
+    def __init__(self, use_quantization=None, device=None, cpu_affinity=None, model_id=None, quantization=None):
         # HARDCODED CONFIGURATION (Removed ConfigLoader)
         self.model_id = None 
+
+        # Replica placement (see engine_pool.py). None keeps the default auto device map.
+        self.device = device
+        self.cpu_affinity = set(cpu_affinity) if cpu_affinity else None
         
         # Determine model path
         # Priority: Local 8-bit > Local 4-bit > HuggingFace
@@ -45,12 +147,28 @@ class MedGemmaEngine:
              self.model_id = "google/medgemma-1.5-4b-it"
              self.quantization_type = "4bit"
 
+        # Explicit / env override (e.g. a tiny test checkpoint for CPU replicas)
+        model_id = model_id or os.environ.get("MEDGEMMA_MODEL_ID")
+        if model_id:
+            self.model_id = model_id
+
         # Legacy override
         if use_quantization is False:
             self.quantization_type = "none"
+        # Explicit mode ("4bit" / "8bit" / "none"), e.g. a model_registry.py variant
+        if quantization:
+            self.quantization_type = quantization
         
         self.processor = None
         self.model = None
+        # Per-request KV cache / activation budget (memory_planner.py), set once the model is loaded
+        self.memory = None
+        # Bucketed static caches + compiled decode step (compiled_decode.py, MEDGEMMA_STATIC_CACHE=1)
+        self.static_decode = None
+        # Dtype the vision tower casts pixel_values to; prepare_inputs() casts on the host instead
+        self.pixel_dtype = None
+        # Speculatively prefilled CT prompt prefix (prefix_cache.py)
+        self.prefix_cache = prefix_cache.PrefixCache(self)
         
     def load_model(self):
         LOGGER.info(f"Loading model: {self.model_id}...")
@@ -68,6 +186,11 @@ class MedGemmaEngine:
              device_map = "cpu"
              LOGGER.info(f"Using device_map: {device_map}")
 
+        # Pool replicas are pinned to a single device
+        if self.device:
+             device_map = "cpu" if self.device == "cpu" else {"": self.device}
+             LOGGER.info(f"Using device_map: {device_map}")
+
         # Determine safe dtype (BF16 if supported, else FP16)
         compute_dtype = torch.float16
         if torch.cuda.is_available() and torch.cuda.is_bf16_supported():
@@ -114,12 +237,15 @@ class MedGemmaEngine:
 
         try:
             self.processor = AutoProcessor.from_pretrained(self.model_id, use_fast=False)
+            # Whole image stacks (CT context) are resized / normalized in one batched call
+            image_preprocess.install(self.processor)
             self.model = AutoModelForImageTextToText.from_pretrained(self.model_id, **model_kwargs)
             LOGGER.info("Model loaded successfully.")
             
             # CLEAR CACHE to free up 'Reserved' memory that isn't 'Allocated'
             if torch.cuda.is_available():
                 torch.cuda.empty_cache()
+            self.prepare_decoding()
 
             # --- VRAM Usage Check ---
             if torch.cuda.is_available():
@@ -138,9 +264,55 @@ class MedGemmaEngine:
                 
                 self.model = AutoModelForImageTextToText.from_pretrained(self.model_id, **model_kwargs)
                 LOGGER.info("Fallback Model loaded successfully.")
+                self.prepare_decoding()
             else:
                  raise e
 
+    def prepare_decoding(self):
+        """Compile the static-cache decode step (if enabled), then size the memory budget around it."""
+        # Layer hooks first, so the compiled graphs are traced with them (a no-op while compiling)
+        cancellation.install_hooks(self.model)
+        if compiled_decode.ENABLED:
+            self.static_decode = compiled_decode.StaticDecoder(self.model)
+            with self.pinned():
+                self.static_decode.warmup(self.processor.tokenizer.bos_token_id)
+        self.memory = memory_planner.for_model(self.model)
+        self.pixel_dtype = next((module.weight.dtype for name, module in self.model.named_modules()
+                                 if name.endswith("patch_embedding") and hasattr(module, "weight")), None)
+
+    def unload(self):
+        """Release model weights (used when a pool replica is drained and retired)."""
+        self.prefix_cache.clear()
+        if self.memory is not None:
+            self.memory.close()
+        self.model = None
+        self.processor = None
+        self.memory = None
+        self.static_decode = None
+        self.pixel_dtype = None
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        LOGGER.info(f"Model unloaded: {self.model_id} ({self.device or 'auto'})")
+
+    @contextmanager
+    def pinned(self):
+        """
+        Pin the calling thread to this replica's CPU set (Linux only), restoring it afterwards.
+        Only this thread moves: torch's intra-op (OpenMP) workers are shared by every replica
+        in the process. For per-socket isolation run one model server per CPU set
+        (model_server.py --cpus).
+        """
+        if not self.cpu_affinity or not hasattr(os, "sched_setaffinity"):
+            yield
+            return
+        previous = os.sched_getaffinity(0)
+        os.sched_setaffinity(0, self.cpu_affinity)
+        try:
+            yield
+        finally:
+            os.sched_setaffinity(0, previous)
+
     def process_image(self, image_data):
         if isinstance(image_data, str):
             # Assumes base64 string
@@ -149,22 +321,16 @@ class MedGemmaEngine:
                 image_data = encoded
             image_bytes = base64.b64decode(image_data)
             return Image.open(io.BytesIO(image_bytes)).convert("RGB")
+        if isinstance(image_data, (bytes, bytearray, memoryview)):
+            # Encoded file bytes (multipart / MessagePack requests)
+            return Image.open(io.BytesIO(image_data)).convert("RGB")
+        if isinstance(image_data, np.ndarray):
+            # Raw uint8 RGB pixels (CT context): no decode needed
+            return Image.fromarray(image_data)
         return image_data
 
-    def generate(self, messages, max_new_tokens: Optional[int]=None, temperature: Optional[float]=None, top_p: Optional[float]=None):
-        if not self.model:
-            self.load_model()
-
-        # Preprocess messages to handle images
-        # The transformers library expects a specific format for apply_chat_template
-        # But MedGemma might need manual processing if using processor directly
-        # Let's look at the notebook:
-        # messages = [ { "role": "user", "content": [ {"type": "text", "text": prompt}, {"type": "image", "image": image} ] } ]
-        
-        # We need to parse incoming messages which might have base64 images
-     
-
-
+    def format_messages(self, messages):
+        """API messages -> processor messages (images decoded to PIL, plain-string content wrapped)."""
         formatted_messages = []
         
         for msg in messages:
@@ -173,7 +339,8 @@ class MedGemmaEngine:
                 for item in msg["content"]:
                     if item["type"] == "image":
                         # Convert base64 to PIL Image
-                        img = self.process_image(item["image"])
+                        with profiler.section("medgemma.decode_image"):
+                            img = self.process_image(item["image"])
                         new_content.append({"type": "image", "image": img})
                         # raw_images.append(img) # The processor handles this in apply_chat_template?
                         # Actually, looking at docs/notebook, the processor.apply_chat_template handles the structure if return_tensors is correct
@@ -186,20 +353,108 @@ class MedGemmaEngine:
                 "role": msg["role"],
                 "content": new_content
             })
+        return formatted_messages
 
-        # Prepare inputs
-        inputs = self.processor.apply_chat_template(
-            formatted_messages,
-            add_generation_prompt=True,
-            tokenize=True,
-            return_dict=True,
-            return_tensors="pt"
-        )
+    def thought_tracker(self, prompt_tokens: int) -> ThoughtTracker:
+        tokenizer = self.processor.tokenizer
+        return ThoughtTracker(prompt_tokens, tokenizer.convert_tokens_to_ids(THOUGHT_START_TOKEN),
+                              tokenizer.convert_tokens_to_ids(THOUGHT_END_TOKEN))
+
+    def prepare_inputs(self, messages) -> Optional[preprocess_pipeline.PreparedInputs]:
+        """
+        CPU side of generate(): decode images, apply the chat template (tokenize + image
+        processing), cast pixel_values to the vision dtype and pin the tensors for an
+        asynchronous copy (preprocess_pipeline.py). None while no model is loaded.
+        """
+        processor = self.processor
+        if processor is None:
+            return None
+        start = time.perf_counter()
+        # Preprocess messages to handle images
+        # The transformers library expects a specific format for apply_chat_template
+        # But MedGemma might need manual processing if using processor directly
+        # Let's look at the notebook:
+        # messages = [ { "role": "user", "content": [ {"type": "text", "text": prompt}, {"type": "image", "image": image} ] } ]
         
-        inputs = inputs.to(self.model.device)
+        # We need to parse incoming messages which might have base64 images
+        formatted_messages = self.format_messages(messages)
+
+        # Prepare inputs
+        with profiler.section("medgemma.apply_chat_template"):
+            inputs = processor.apply_chat_template(
+                formatted_messages,
+                add_generation_prompt=True,
+                tokenize=True,
+                return_dict=True,
+                return_tensors="pt"
+            )
+        images = sum(1 for msg in formatted_messages for item in msg["content"] if item.get("type") == "image")
+
+        pixel_values = inputs.get("pixel_values")
+        if pixel_values is not None and self.pixel_dtype is not None and pixel_values.dtype != self.pixel_dtype:
+            # What the vision tower does on the device; half the bytes to pin and copy
+            inputs["pixel_values"] = pixel_values.to(self.pixel_dtype)
+        pin = preprocess_pipeline.PIN_MEMORY and torch.cuda.is_available() and \
+            (self.device is None or str(self.device).startswith("cuda"))
+        if pin:
+            preprocess_pipeline.pin_inputs(inputs)
+        return preprocess_pipeline.PreparedInputs(self.model_id, inputs, images,
+                                                  round((time.perf_counter() - start) * 1000, 1), pin)
+
+    def generate(self, messages, max_new_tokens: Optional[int]=None, temperature: Optional[float]=None, top_p: Optional[float]=None,
+                 on_complete: Optional[Callable] = None, thinking_budget: Optional[int] = None,
+                 prepared: Optional[preprocess_pipeline.PreparedInputs] = None,
+                 cancel_token: Optional[CancelToken] = None):
+        """
+        Start a streamed generation in a background thread.
+        on_complete(error) is called from that thread once generation ends (error is None on success).
+        thinking_budget caps the thought tokens (None: unlimited, 0: no thinking).
+        prepared: prepare_inputs() output for these messages, made ahead on the preprocessing stage.
+        cancel_token: the request's cancellation (cancellation.py); stops the memory wait, the
+        prefill (at the next layer) and the decode (after the current token). stopper.abort() cancels it.
+        """
+        if not self.model:
+            self.load_model()
+
+        if prepared is None or prepared.model_id != self.model_id:
+            prepared = self.prepare_inputs(messages)
+        inputs = prepared.inputs
         
         # Load params (HARDCODED DEFAULTS) if not provided
         gen_max_tokens = max_new_tokens if max_new_tokens else 1024
+
+        # Commit KV cache + activation memory before anything lands on the device
+        # (may clamp max_new_tokens, wait for running generations or raise MemoryBudgetExceeded)
+        images = prepared.images
+        prompt_tokens = prepared.prompt_tokens
+        # Prompt starting with the prefilled CT prefix: only the text after its last image is prefilled.
+        # Its KV copy is made once the reservation (which covers it) is granted, never while queued.
+        prefixed = self.prefix_cache.lookup(inputs["input_ids"]) is not None
+        static_decode = self.static_decode if not prefixed else None
+        slot = static_decode.acquire(prompt_tokens + gen_max_tokens) if static_decode else None
+        planner = self.memory
+        reservation = prefix = None
+        try:
+            reservation = planner.reserve(prompt_tokens, 0 if prefixed else images, gen_max_tokens,
+                                          preallocated_kv=slot is not None, cancel_token=cancel_token)
+            if prefixed:
+                prefix = self.prefix_cache.take(inputs["input_ids"])
+                if prefix is None:
+                    # Prefix replaced while this request waited: reserve for the images as well
+                    planner.release(reservation)
+                    reservation = planner.reserve(prompt_tokens, images, gen_max_tokens, cancel_token=cancel_token)
+        except Exception:
+            planner.release(reservation)
+            prefix = None
+            if slot is not None:
+                static_decode.release(slot)
+            raise
+        if prefix is not None:
+            inputs.pop("pixel_values", None)
+            inputs.pop("token_type_ids", None)
+            images = 0
+        gen_max_tokens = reservation.max_new_tokens
+
         gen_temp = temperature if temperature else 0.7
         gen_top_p = top_p if top_p else 0.9
 
@@ -216,17 +471,52 @@ class MedGemmaEngine:
         streamer = TextIteratorStreamer(self.processor.tokenizer, skip_prompt=True, skip_special_tokens=False, timeout=300.0)
         generation_args["streamer"] = streamer
         
+        # Thinking budget + thought/answer token accounting
+        tracker = self.thought_tracker(prompt_tokens)
+        generation_args["logits_processor"] = LogitsProcessorList([ThinkingBudgetProcessor(tracker, thinking_budget)])
+
         # Abort Logic
-        stopper = AbortStoppingCriteria()
-        generation_args["stopping_criteria"] = StoppingCriteriaList([stopper])
+        stopper = AbortStoppingCriteria(prompt_tokens=prompt_tokens, tracker=tracker, cancel_token=cancel_token)
+        cancel_token = stopper.cancel_token
+        stopper.info["max_new_tokens"] = gen_max_tokens
+        # Early stop on repetition loops (reason lands in stopper.info["stop_reason"])
+        guard = DegenerationStoppingCriteria(self.processor.tokenizer, prompt_tokens, stopper.info, tracker=tracker)
+        generation_args["stopping_criteria"] = StoppingCriteriaList([stopper, guard])
+
+        if slot is not None:
+            generation_args.update(static_decode.generate_kwargs(slot))
+        if prefix is not None:
+            generation_args["past_key_values"] = prefix[0]
+            LOGGER.info(f"Reusing prefilled CT prefix: {prefix[1]} of {prompt_tokens} prompt tokens.")
+
+        def release_memory():
+            # Drops the prefix KV copy with the reservation that covered it
+            generation_args.pop("past_key_values", None)
+            planner.release(reservation)
+            if slot is not None:
+                static_decode.release(slot)
 
         def thread_target():
+            error = None
             try:
-                self.model.generate(**inputs, **generation_args)
+                with self.pinned(), cancellation.active(cancel_token), profiler.section("medgemma.generate"):
+                    # Moved to the device here so a failed transfer still releases the reservation
+                    # (asynchronous from pinned memory; the copy is ordered before the prefill on the stream)
+                    self.model.generate(**inputs.to(self.model.device, non_blocking=prepared.pinned), **generation_args)
+                if stopper.cancelled:
+                    cancel_token.reclaimed("decode")
+            except Cancelled as e:
+                # Stopped by a layer hook: the client left (or the deadline passed) mid-forward
+                error = e
+                if e.reason == "deadline":
+                    stopper.info["stop_reason"] = "deadline"
+                cancel_token.reclaimed("prefill" if stopper.info["completion_tokens"] == 0 else "decode")
             except Exception as e:
                 # If aborted, this might raise, or just finish
+                error = e
                 LOGGER.error(f"Error during model generation: {e}", exc_info=True)
             finally:
+                release_memory()
                 # Ensure streamer is closed even if generation crashes
                 if not streamer.stop_signal:
                     streamer.end()
@@ -236,11 +526,80 @@ class MedGemmaEngine:
                 if torch.cuda.is_available():
                     torch.cuda.empty_cache()
 
+                if on_complete:
+                    on_complete(error)
+
         thread = Thread(target=thread_target)
-        thread.start()
+        try:
+            thread.start()
+        except Exception:
+            release_memory()
+            raise
 
         # Generator for streaming response
         return streamer, stopper
 
+    def generate_batch(self, conversations, max_new_tokens: int = 1024, cancel_token: Optional[CancelToken] = None,
+                       **generation_args) -> List[dict]:
+        """
+        Blocking generation for several conversations in one left-padded batch (batch_infer.py).
+        Returns [{"text", "prompt_tokens", "completion_tokens"}] in input order; text keeps the
+        special tokens (thought markers). Rows stop at EOS only: the streaming path's abort /
+        thinking-budget / degeneration hooks follow batch row 0 and are not used here.
+        A cancelled cancel_token stops the whole batch with Cancelled.
+        """
+        if not self.model:
+            self.load_model()
+
+        formatted = [self.format_messages(conv) for conv in conversations]
+        inputs = self.processor.apply_chat_template(
+            formatted,
+            add_generation_prompt=True,
+            tokenize=True,
+            return_dict=True,
+            return_tensors="pt",
+            padding=True,
+            padding_side="left",
+        )
+        width = inputs["input_ids"].shape[-1]
+        pad_id = self.processor.tokenizer.pad_token_id
+
+        # Every row holds a KV cache of the padded width. Only the first row may queue: the
+        # later ones would be waiting on this batch's own reservations.
+        planner = self.memory
+        reservations = []
+        try:
+            for conv in formatted:
+                images = sum(1 for msg in conv for item in msg["content"] if item.get("type") == "image")
+                reservations.append(planner.reserve(width, images, max_new_tokens, timeout=0 if reservations else None,
+                                                    cancel_token=cancel_token))
+            max_new_tokens = min(r.max_new_tokens for r in reservations)
+            if cancel_token is not None:
+                stopper = AbortStoppingCriteria(cancel_token=cancel_token)
+                generation_args["stopping_criteria"] = StoppingCriteriaList([stopper])
+            with self.pinned(), torch.no_grad(), cancellation.active(cancel_token):
+                output = self.model.generate(**inputs.to(self.model.device), max_new_tokens=max_new_tokens,
+                                             **generation_args)
+            if cancel_token is not None and stopper.cancelled:
+                raise Cancelled(cancel_token.reason)
+        except Cancelled:
+            cancel_token.reclaimed("generate")
+            raise
+        finally:
+            for reservation in reservations:
+                planner.release(reservation)
+
+        results = []
+        for row, attention in zip(output, inputs["attention_mask"]):
+            # Rows that finished early are padded up to the longest one
+            new_tokens = row[width:]
+            new_tokens = new_tokens[new_tokens != pad_id]
+            results.append({
+                "text": self.processor.decode(new_tokens, skip_special_tokens=False),
+                "prompt_tokens": int(attention.sum()),
+                "completion_tokens": len(new_tokens),
+            })
+        return results
+
 # Singleton instance
 engine = MedGemmaEngine()
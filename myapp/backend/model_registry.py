@@ -0,0 +1,248 @@
+"""
+Model variant registry (模型变体注册表).
+
+Each pool replica can serve several variants of the model: other quantization
+modes of the same checkpoint, or another checkpoint such as a smaller draft
+model. A request picks one with config.model_variant (default: the startup
+variant). Variants are loaded on first use. Before a load would exceed
+MEDGEMMA_MAX_LOADED_VARIANTS or the weight budget, the least recently used idle
+variant is unloaded. A variant that is generating is never evicted: the load
+waits up to MEDGEMMA_MEMORY_QUEUE_S for one to go idle, then the request gets
+MemoryBudgetExceeded (HTTP 503).
+
+Weight sizes are measured after a variant's first load. Before that they are
+estimated from the quantization mode. Variants on one device share its memory
+planner budget (memory_planner.py), which shrinks by the weights of each
+variant loaded and grows back when it is evicted.
+
+    MEDGEMMA_MODEL_VARIANTS       extra variants, comma separated "name=quantization[@model_id]",
+                                  quantization one of 4bit / 8bit / none, e.g.
+                                  "int8=8bit,bf16=none,draft=none@/models/medgemma-draft"
+    MEDGEMMA_DEFAULT_VARIANT      name of the startup variant, the engine's own model and
+                                  quantization (default "default")
+    MEDGEMMA_MAX_LOADED_VARIANTS  variants resident per replica at once (default 1)
+    MEDGEMMA_VARIANT_BUDGET_MB    weight budget per replica (default: no limit, only the count applies)
+"""
+import os
+import time
+import logging
+import threading
+from typing import Dict, List, Optional
+
+from memory_planner import MemoryBudgetExceeded, QUEUE_TIMEOUT, MB
+from metrics import metrics
+
+LOGGER = logging.getLogger("MedGemma")
+
+DEFAULT_VARIANT = os.environ.get("MEDGEMMA_DEFAULT_VARIANT", "default")
+MAX_LOADED = int(os.environ.get("MEDGEMMA_MAX_LOADED_VARIANTS", "1"))
+_budget_mb = os.environ.get("MEDGEMMA_VARIANT_BUDGET_MB")
+BUDGET_BYTES = int(float(_budget_mb) * MB) if _budget_mb else None
+
+QUANTIZATION_MODES = ("4bit", "8bit", "none")
+# Weight bytes per parameter, for the size estimate before a variant's first load
+BYTES_PER_PARAM = {"4bit": 0.5, "8bit": 1.0, "none": 2.0}
+DEFAULT_PARAMS = 4.3e9  # medgemma-1.5-4b-it
+
+
+class UnknownVariant(ValueError):
+    pass
+
+
+class VariantLoadError(RuntimeError):
+    """A variant failed to load (bad checkpoint / quantization); not the replica's fault."""
+
+
+def parse_variant_specs(spec: str) -> Dict[str, dict]:
+    """'int8=8bit,draft=none@/models/x' -> {"int8": {"quantization": "8bit", "model_id": None}, ...}"""
+    variants = {}
+    for token in spec.split(","):
+        token = token.strip()
+        if not token:
+            continue
+        name, sep, rest = token.partition("=")
+        quantization, _, model_id = rest.partition("@")
+        name, quantization = name.strip(), quantization.strip().lower()
+        if not sep or not name or quantization not in QUANTIZATION_MODES:
+            raise ValueError(f"Invalid model variant spec: {token!r} (expected name=4bit|8bit|none[@model_id])")
+        variants[name] = {"quantization": quantization, "model_id": model_id.strip() or None}
+    return variants
+
+
+def weight_footprint(model) -> Optional[int]:
+    try:
+        return int(model.get_memory_footprint())
+    except Exception:
+        return None
+
+
+class Variant:
+    def __init__(self, name: str, engine):
+        self.name = name
+        self.engine = engine
+        self.inflight = 0
+        self.last_used = 0.0
+        self.loads = 0
+        self.load_s = None
+        self.footprint = None  # measured weight bytes
+
+    @property
+    def loaded(self) -> bool:
+        return self.engine.model is not None
+
+    def weight_bytes(self) -> int:
+        if self.footprint is not None:
+            return self.footprint
+        quantization = (self.engine.quantization_type or "none").lower()
+        return int(DEFAULT_PARAMS * BYTES_PER_PARAM.get(quantization, 2.0))
+
+    def status(self) -> dict:
+        return {
+            "name": self.name,
+            "model_id": self.engine.model_id,
+            "quantization": self.engine.quantization_type,
+            "loaded": self.loaded,
+            "inflight": self.inflight,
+            "loads": self.loads,
+            "load_s": self.load_s,
+            "weights_mb": round(self.weight_bytes() / MB, 1),
+            "idle_s": round(time.monotonic() - self.last_used, 1) if self.last_used and not self.inflight else None,
+        }
+
+
+class ModelRegistry:
+    """The variants of one replica (one device / CPU set) and which of them are resident."""
+    def __init__(self, variants: List[Variant], default: str = DEFAULT_VARIANT, max_loaded: int = MAX_LOADED,
+                 budget_bytes: Optional[int] = BUDGET_BYTES, queue_timeout: float = QUEUE_TIMEOUT):
+        self.variants = {v.name: v for v in variants}
+        self.default = default
+        self.max_loaded = max(1, max_loaded)
+        self.budget = budget_bytes
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        # One load at a time per replica (they share the device, and concurrent
+        # first requests for a variant should wait for the same load)
+        self._load_lock = threading.Lock()
+
+    @classmethod
+    def for_replica(cls, default_engine, factory, device=None, cpu_affinity=None, specs: Optional[Dict[str, dict]] = None):
+        """Default engine plus one engine per MEDGEMMA_MODEL_VARIANTS entry, on the replica's placement."""
+        if specs is None:
+            specs = parse_variant_specs(os.environ.get("MEDGEMMA_MODEL_VARIANTS", ""))
+        if DEFAULT_VARIANT in specs:
+            raise ValueError(f"Model variant {DEFAULT_VARIANT!r} is the startup variant; pick another name.")
+        variants = [Variant(DEFAULT_VARIANT, default_engine)]
+        for name, spec in specs.items():
+            engine = factory(device=device, cpu_affinity=cpu_affinity, model_id=spec["model_id"],
+                             quantization=spec["quantization"])
+            variants.append(Variant(name, engine))
+        return cls(variants)
+
+    @property
+    def engine(self):
+        """The startup variant's engine."""
+        return self.variants[self.default].engine
+
+    def names(self) -> List[str]:
+        return list(self.variants)
+
+    def get(self, name: Optional[str] = None) -> Variant:
+        variant = self.variants.get(name or self.default)
+        if variant is None:
+            raise UnknownVariant(f"Unknown model variant: {name!r} (available: {', '.join(self.variants)})")
+        return variant
+
+    def loaded_engine(self):
+        """Most recently used resident engine (health checks), or None."""
+        with self._cond:
+            loaded = [v for v in self.variants.values() if v.loaded]
+        return max(loaded, key=lambda v: v.last_used).engine if loaded else None
+
+    # --- Leases ---
+
+    def acquire(self, name: Optional[str] = None) -> Variant:
+        """Mark a variant in use (so it cannot be evicted), loading it first if needed."""
+        variant = self.get(name)
+        with self._cond:
+            variant.inflight += 1
+            variant.last_used = time.monotonic()
+        try:
+            if not variant.loaded:
+                self.load(variant)
+        except BaseException:
+            self.release(variant)
+            raise
+        return variant
+
+    def release(self, variant: Variant):
+        with self._cond:
+            variant.inflight -= 1
+            variant.last_used = time.monotonic()
+            self._cond.notify_all()
+
+    # --- Loading / eviction ---
+
+    def load(self, variant: Variant):
+        with self._load_lock:
+            if variant.loaded:
+                return
+            self._make_room(variant)
+            start = time.perf_counter()
+            try:
+                with variant.engine.pinned():
+                    variant.engine.load_model()
+            except Exception as e:
+                variant.engine.unload()
+                metrics.incr("model_variant", variant=variant.name, outcome="load_failed")
+                raise VariantLoadError(f"Model variant {variant.name} failed to load: {e}") from e
+            variant.load_s = round(time.perf_counter() - start, 1)
+            variant.loads += 1
+            variant.footprint = weight_footprint(variant.engine.model) or variant.footprint
+            metrics.incr("model_variant", variant=variant.name, outcome="loaded")
+            LOGGER.info(f"Model variant {variant.name} loaded in {variant.load_s}s "
+                        f"({variant.weight_bytes() / MB:.0f} MB weights).")
+
+    def _over_limit(self, variant: Variant) -> bool:
+        resident = [v for v in self.variants.values() if v.loaded and v is not variant]
+        if len(resident) + 1 > self.max_loaded:
+            return True
+        return self.budget is not None and sum(v.weight_bytes() for v in resident) + variant.weight_bytes() > self.budget
+
+    def _make_room(self, variant: Variant):
+        """Evict least recently used idle variants until `variant` fits (waits for busy ones)."""
+        deadline = time.monotonic() + self.queue_timeout
+        with self._cond:
+            while self._over_limit(variant):
+                idle = [v for v in self.variants.values() if v.loaded and v is not variant and v.inflight == 0]
+                if idle:
+                    # Unloaded under the lock, so no request can take a lease on it meanwhile
+                    self._evict(min(idle, key=lambda v: v.last_used))
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    metrics.incr("model_variant", variant=variant.name, outcome="busy")
+                    raise MemoryBudgetExceeded(
+                        f"Cannot load model variant {variant.name}: the resident variants are busy.",
+                        retry_after=max(1, int(self.queue_timeout)))
+                self._cond.wait(remaining)
+
+    def _evict(self, victim: Variant):
+        idle_s = time.monotonic() - victim.last_used
+        victim.engine.unload()
+        metrics.incr("model_variant", variant=victim.name, outcome="evicted")
+        LOGGER.info(f"Model variant {victim.name} evicted (idle {idle_s:.0f}s).")
+
+    def unload_all(self):
+        with self._load_lock, self._cond:
+            for variant in self.variants.values():
+                if variant.loaded:
+                    variant.engine.unload()
+
+    def status(self) -> dict:
+        with self._cond:
+            return {
+                "default": self.default,
+                "max_loaded": self.max_loaded,
+                "budget_mb": round(self.budget / MB, 1) if self.budget is not None else None,
+                "variants": [v.status() for v in self.variants.values()],
+            }
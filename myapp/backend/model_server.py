@@ -0,0 +1,188 @@
+"""
+Dedicated model-server process (独立模型服务进程).
+
+A single process owns MedGemmaEngine and DetectionService. Any number of
+lightweight API workers (uvicorn workers running app.py with
+MEDGEMMA_MODEL_SERVER=<address>) connect over a local socket; each request is one
+connection. Images arrive as shared-memory handles (see model_client.py),
+generated text is streamed back as ("chunk", text) messages.
+
+Generation and detection requests get a CancelToken (cancellation.py) with the
+worker's deadline; an ("abort",) message or a closed connection cancels it, so
+the work stops at its next step even before the first token.
+
+Usage:
+    python model_server.py [--address 127.0.0.1:8765] [--cpus 0-15]
+
+--cpus pins the whole process (and so torch's intra-op threads) to a CPU set and
+sizes torch's thread pool to it: one server per socket isolates CPU replicas,
+which in-process replicas (engine_pool.py) cannot.
+"""
+import os
+import argparse
+import logging
+import threading
+from multiprocessing.connection import Listener
+
+from cancellation import CancelToken
+from model_client import DEFAULT_ADDRESS, parse_address, get_authkey, unpack_messages, unpack_ct_result
+
+LOGGER = logging.getLogger("MedGemma")
+
+
+class ModelServer:
+    # EnginePool methods API workers may invoke through the "pool" op
+    POOL_METHODS = ("status", "drain", "undrain", "variants", "prefill_ct_context")
+
+    def __init__(self, engine, detection_service, ct_store):
+        # engine is normally the EnginePool, which serializes detection per replica
+        self.engine = engine
+        self.detection_service = detection_service
+        self.ct_store = ct_store
+
+    def serve_forever(self, address, authkey):
+        with Listener(address, authkey=authkey) as listener:
+            LOGGER.info(f"Model server listening on {address}")
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    LOGGER.warning(f"Rejected model-server connection: {e}")
+                    continue
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn):
+        try:
+            request = conn.recv()
+            op = request.get("op")
+            if op == "generate":
+                self._handle_generate(conn, request)
+            elif op == "detect":
+                messages = unpack_messages(request["messages"], self.ct_store.get_slice_pixels)
+                kwargs = self._cancellable(conn, "detect", request.get("kwargs", {}))
+                result = self.detection_service.detect_findings(messages, **kwargs)
+                conn.send(("result", result))
+            elif op == "generate_batch":
+                conversations = [unpack_messages(conv, self.ct_store.get_slice_pixels) for conv in request["conversations"]]
+                kwargs = self._cancellable(conn, "chat", request.get("kwargs", {}))
+                conn.send(("result", self.engine.generate_batch(conversations, **kwargs)))
+            elif op == "status":
+                conn.send(("result", {"model_loaded": self.engine.model is not None}))
+            elif op == "pool" and request.get("method") in self.POOL_METHODS:
+                conn.send(("result", getattr(self.engine, request["method"])(*request.get("args", []))))
+            elif op == "ct_set":
+                conn.send(("result", self.ct_store.set_global_context(unpack_ct_result(request["images"]),
+                                                                          request.get("context_id"))))
+            elif op == "ct_begin":
+                conn.send(("result", self.ct_store.begin_context()))
+            elif op == "ct_append":
+                self.ct_store.append_context(request["upload_id"], unpack_ct_result([request["image"]])[0])
+                conn.send(("result", None))
+            elif op == "ct_commit":
+                conn.send(("result", self.ct_store.commit_context(request["upload_id"], request.get("context_id"))))
+            elif op == "ct_discard":
+                self.ct_store.discard_context(request["upload_id"])
+                conn.send(("result", None))
+            elif op == "ct_get":
+                conn.send(("result", self._ct_refs()))
+            elif op == "ct_slice":
+                conn.send(("result", self.ct_store.get_slice_pixels(request["context_id"], request["index"])))
+            else:
+                conn.send(("error", "ValueError", f"Unknown op: {op}"))
+        except (EOFError, OSError):
+            pass
+        except Exception as e:
+            LOGGER.error(f"Model server request failed: {e}", exc_info=True)
+            try:
+                conn.send(("error", type(e).__name__, str(e)))
+            except (EOFError, OSError):
+                pass
+        finally:
+            conn.close()
+
+    def _ct_refs(self):
+        """Cached CT context with pixels replaced by references the server resolves on generate."""
+        context_id, images = self.ct_store.get_context()
+        return [
+            {**{k: v for k, v in img_data.items() if k != "pixels"}, "pixels": {"ct_ref": (context_id, img_data["index"])}}
+            for img_data in images
+        ]
+
+    @staticmethod
+    def _cancellable(conn, kind, kwargs):
+        """kwargs with a cancel_token that the worker's deadline, ("abort",) or a closed connection cancel."""
+        kwargs = dict(kwargs)
+        token = CancelToken(kind, kwargs.pop("deadline", None))
+
+        def watch():
+            # The only reader of the connection once the request is in
+            try:
+                while conn.recv()[0] != "abort":
+                    pass
+            except (EOFError, OSError):
+                pass
+            token.cancel("client_disconnected")
+
+        threading.Thread(target=watch, name="cancel-watch", daemon=True).start()
+        kwargs["cancel_token"] = token
+        return kwargs
+
+    def _handle_generate(self, conn, request):
+        messages = unpack_messages(request["messages"], self.ct_store.get_slice_pixels)
+        kwargs = self._cancellable(conn, "chat", request.get("kwargs", {}))
+        token = kwargs["cancel_token"]
+        # Sent once generation has started, so the worker sees memory-budget rejections up front
+        streamer, stopper = self.engine.generate(messages, **kwargs)
+        conn.send(("accepted",))
+        try:
+            for new_text in streamer:
+                if token.cancelled and token.reason == "client_disconnected":
+                    stopper.abort()
+                    break
+                conn.send(("chunk", new_text))
+        except (EOFError, OSError):
+            # API worker went away (client disconnect / worker restart).
+            stopper.abort()
+            return
+        except Exception as e:
+            stopper.abort()
+            conn.send(("error", type(e).__name__, str(e)))
+            return
+        conn.send(("end", {**getattr(stopper, "info", {}), "aborted": stopper.aborted}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MedGemma model server")
+    parser.add_argument("--address", default=os.environ.get("MEDGEMMA_MODEL_SERVER", DEFAULT_ADDRESS))
+    parser.add_argument("--cpus", default=None, help="CPU set for the whole process, e.g. 0-15")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler("model_server.log", encoding='utf-8'),
+            logging.StreamHandler()
+        ]
+    )
+
+    from engine_pool import pool, parse_cpu_set
+    import ct_service
+
+    if args.cpus:
+        import torch
+        cpus = parse_cpu_set(args.cpus)
+        # Before the first forward pass, so torch's worker threads start on the set
+        os.sched_setaffinity(0, cpus)
+        torch.set_num_threads(len(cpus))
+        LOGGER.info(f"Model server pinned to {len(cpus)} CPUs: {args.cpus}")
+
+    LOGGER.info("Model server: loading model...")
+    pool.load_model()
+
+    server = ModelServer(pool, pool, ct_service)
+    server.serve_forever(parse_address(args.address), get_authkey())
+
+
+if __name__ == "__main__":
+    main()
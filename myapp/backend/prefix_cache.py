@@ -0,0 +1,275 @@
+"""
+Speculative CT prefix prefill (CT 前缀预填充).
+
+Once a CT series is cached (/api/ct/process), every CT question's prompt is the
+same up to the user's text: system prompt, instruction and all slices, tens of
+thousands of tokens. The pool prefills that prefix in the background on one
+replica and keeps its KV cache. A prompt whose token ids start with the cached
+prefix gets a copy of it, so generate() only prefills what follows the last
+image (slice label, question, turn markers).
+
+The prefill runs in chunks of whole images (about MEDGEMMA_PREFILL_CHUNK tokens)
+and checks before each chunk whether the replica has requests in flight, pausing
+until it is idle. A chunk that has started is not interrupted: a request arriving
+mid-chunk runs alongside it and shares the device for the rest of that forward
+pass, so smaller chunks bound this contention more tightly.
+Memory is committed against the replica's memory planner without queueing (no
+room: no prefill): the largest chunk's activations plus the KV of the whole
+prefix while prefilling, then only the KV, which stays committed until the next
+CT context replaces it or the model is unloaded.
+
+    MEDGEMMA_PREFIX_PREFILL  0 disables the speculative prefill (default 1)
+    MEDGEMMA_PREFILL_CHUNK   target tokens per prefill chunk (default 2048)
+"""
+import os
+import copy
+import time
+import logging
+import threading
+from typing import Callable, List, Optional
+
+import torch
+
+from memory_planner import MemoryBudgetExceeded
+from metrics import metrics
+from profiler import profiler
+
+LOGGER = logging.getLogger("MedGemma")
+
+ENABLED = os.environ.get("MEDGEMMA_PREFIX_PREFILL", "1") != "0"
+CHUNK_TOKENS = int(os.environ.get("MEDGEMMA_PREFILL_CHUNK", "2048"))
+# How often a paused prefill checks whether the replica went idle
+IDLE_POLL_S = 0.05
+
+
+def first_image(messages):
+    for msg in messages:
+        if isinstance(msg.get("content"), list):
+            for item in msg["content"]:
+                if item.get("type") == "image":
+                    return item.get("image")
+    return None
+
+
+def chunk_bounds(image_ends: List[int], chunk_tokens: int = CHUNK_TOKENS) -> List[tuple]:
+    """
+    Split a prefix ending after its last image into (start, end, first_image, end_image)
+    chunks of whole images, each closed once it reaches chunk_tokens.
+    image_ends are the (exclusive) token positions where the images end.
+    """
+    chunks, start, first = [], 0, 0
+    for i, end in enumerate(image_ends, 1):
+        if end - start >= chunk_tokens or i == len(image_ends):
+            chunks.append((start, end, first, i))
+            start, first = end, i
+    return chunks
+
+
+class PrefixEntry:
+    def __init__(self, anchor):
+        # First image of the prefix messages (the CT context's own pixel array), for routing
+        self.anchor = anchor
+        self.state = "pending"  # pending -> running -> ready | cancelled | skipped | unsupported | failed
+        self.input_ids = None
+        self.cache = None
+        self.reservation = None
+        self.tokens = 0
+        self.chunks = 0
+        self.pauses = 0
+        self.hits = 0
+        self.prefill_s = None
+        self.created = time.time()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.state == "cancelled"
+
+    def status(self) -> dict:
+        return {"state": self.state, "tokens": self.tokens, "chunks": self.chunks, "pauses": self.pauses,
+                "hits": self.hits, "prefill_s": self.prefill_s}
+
+
+class PrefixCache:
+    """One engine's speculatively prefilled prompt prefix (the active CT context)."""
+    def __init__(self, engine):
+        self.engine = engine
+        self.entry: Optional[PrefixEntry] = None
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def schedule(self, messages, is_busy: Callable[[], bool]):
+        """Replace the cached prefix with that of `messages`, prefilled in the background when idle."""
+        entry = PrefixEntry(first_image(messages))
+        with self._lock:
+            self._drop(self.entry)
+            self.entry = entry
+            previous = self._thread
+            self._thread = threading.Thread(target=self._run, args=(entry, messages, is_busy, previous),
+                                            name="prefix-prefill", daemon=True)
+            self._thread.start()
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._drop(self.entry)
+            self.entry = None
+
+    def _drop(self, entry: Optional[PrefixEntry]):
+        if entry is None:
+            return
+        if entry.state in ("pending", "running"):
+            entry.state = "cancelled"
+        self._free(entry)
+
+    def _free(self, entry: PrefixEntry):
+        entry.cache = None
+        planner = self.engine.memory
+        if planner is not None:
+            planner.release(entry.reservation)
+        entry.reservation = None
+
+    def matches(self, messages) -> bool:
+        """Cheap routing hint: `messages` carry the prefilled context (the prompt tokens decide in take())."""
+        entry = self.entry
+        return entry is not None and entry.state == "ready" and entry.anchor is not None \
+            and first_image(messages) is entry.anchor
+
+    def _match(self, input_ids) -> Optional[PrefixEntry]:
+        """The ready entry the single prompt row starts with (call under the lock)."""
+        entry = self.entry
+        if entry is None or entry.state != "ready" or input_ids.shape[0] != 1:
+            return None
+        n = entry.tokens
+        if input_ids.shape[-1] <= n or not torch.equal(input_ids[0, :n].cpu(), entry.input_ids[0]):
+            return None
+        return entry
+
+    def lookup(self, input_ids) -> Optional[int]:
+        """Prefix length if the prompt starts with the prefix, else None; copies nothing."""
+        with self._lock:
+            entry = self._match(input_ids)
+            return entry.tokens if entry is not None else None
+
+    def take(self, input_ids) -> Optional[tuple]:
+        """
+        (copy of the cached KV, prefix length) if the single prompt row starts with the prefix, else None.
+        The copy is a full KV cache on the device: call only once the request's memory is reserved.
+        """
+        with self._lock:
+            entry = self._match(input_ids)
+            if entry is None:
+                return None
+            n = entry.tokens
+            entry.hits += 1
+            cache = copy.deepcopy(entry.cache)
+        metrics.incr("prefix_cache", outcome="hit")
+        metrics.incr("prefix_cache_tokens", value=n)
+        return cache, n
+
+    # --- Background prefill ---
+
+    def _wait_idle(self, entry: PrefixEntry, is_busy: Callable[[], bool]) -> bool:
+        """Wait until the replica has nothing in flight; False once the entry was superseded."""
+        paused = False
+        while not entry.cancelled and is_busy():
+            paused = True
+            time.sleep(IDLE_POLL_S)
+        if paused:
+            entry.pauses += 1
+        return not entry.cancelled
+
+    def _run(self, entry: PrefixEntry, messages, is_busy, previous: Optional[threading.Thread]):
+        if previous is not None:
+            previous.join()  # one prefill on the device at a time; the old one stops at its next chunk
+        try:
+            outcome = self._prefill(entry, messages, is_busy)
+        except Exception as e:
+            LOGGER.error(f"CT prefix prefill failed: {e}", exc_info=True)
+            outcome = "failed"
+        with self._lock:
+            if entry.state in ("pending", "running") and outcome != "ready":
+                entry.state = outcome
+            if entry.state != "ready":
+                self._free(entry)
+        metrics.incr("prefix_prefill", outcome=entry.state)
+
+    def _prefill(self, entry: PrefixEntry, messages, is_busy) -> str:
+        from transformers import DynamicCache
+
+        engine = self.engine
+        model, processor, planner = engine.model, engine.processor, engine.memory
+        config = getattr(model, "config", None)
+        eoi = getattr(config, "eoi_token_index", None)  # Gemma 3 <end_of_image>
+        if model is None or eoi is None:
+            return "unsupported"
+        if not self._wait_idle(entry, is_busy):
+            return "cancelled"
+        with self._lock:
+            if entry.cancelled:
+                return "cancelled"
+            entry.state = "running"
+
+        start_time = time.perf_counter()
+        with engine.pinned():
+            inputs = processor.apply_chat_template(engine.format_messages(messages), add_generation_prompt=True,
+                                                   tokenize=True, return_dict=True, return_tensors="pt")
+        input_ids = inputs["input_ids"]
+        # The prefix ends with the last image: the text after it (slice label, question)
+        # may tokenize differently once the question is appended
+        image_ends = [int(i) + 1 for i in (input_ids[0] == eoi).nonzero().flatten()]
+        if not image_ends:
+            return "unsupported"
+        chunks = chunk_bounds(image_ends, CHUNK_TOKENS)
+        prefix_len = image_ends[-1]
+
+        if planner is not None:
+            # Largest chunk's activations plus the KV of the whole prefix
+            chunk_tokens = max(end - start for start, end, _, _ in chunks)
+            chunk_images = max(last - first for _, _, first, last in chunks)
+            try:
+                reservation = planner.reserve(chunk_tokens, chunk_images, prefix_len - chunk_tokens, timeout=0)
+            except MemoryBudgetExceeded as e:
+                LOGGER.info(f"CT prefix prefill skipped: {e}")
+                return "skipped"
+            entry.reservation = reservation
+            if reservation.clamped:
+                return "skipped"
+
+        device = model.device
+        ids = input_ids.to(device)
+        pixel_values = inputs.get("pixel_values")
+        token_type_ids = inputs.get("token_type_ids")
+        cache = DynamicCache(config=model.config)
+        for start, end, first, last in chunks:
+            if not self._wait_idle(entry, is_busy):
+                return "cancelled"
+            kwargs = {}
+            if pixel_values is not None:
+                kwargs["pixel_values"] = pixel_values[first:last].to(device)
+            if token_type_ids is not None:
+                # Whole prefix so far: the bidirectional image mask indexes cache positions
+                kwargs["token_type_ids"] = token_type_ids[:, :end].to(device)
+            with engine.pinned(), torch.no_grad(), profiler.section("medgemma.prefix_prefill"):
+                model(input_ids=ids[:, start:end], attention_mask=torch.ones(1, end, dtype=torch.long, device=device),
+                      past_key_values=cache, cache_position=torch.arange(start, end, device=device),
+                      use_cache=True, logits_to_keep=1, **kwargs)
+            entry.chunks += 1
+
+        with self._lock:
+            if entry.cancelled:
+                return "cancelled"
+            if entry.reservation is not None:
+                # The chunk activations are gone; only the prefix KV stays resident
+                planner.shrink_to_kv(entry.reservation, prefix_len)
+            entry.input_ids = input_ids[:, :prefix_len].cpu()
+            entry.cache = cache
+            entry.tokens = prefix_len
+            entry.prefill_s = round(time.perf_counter() - start_time, 2)
+            entry.state = "ready"
+        LOGGER.info(f"CT prefix prefilled: {prefix_len} tokens in {len(chunks)} chunks, {entry.prefill_s}s "
+                    f"({entry.pauses} pauses for requests).")
+        return "ready"
+
+    def status(self) -> Optional[dict]:
+        entry = self.entry
+        return entry.status() if entry is not None else None
@@ -0,0 +1,113 @@
+"""
+Request preprocessing stage (请求预处理流水线).
+
+Everything a chat or detection request needs before the model can start runs on
+this stage's own worker pool, not on the event loop or the shared request
+threadpool:
+
+    history image resolution, role            (app.py)
+    sanitization and manage_context
+    detection prompt                          (DetectionService.prepare_inputs)
+    image decoding, apply_chat_template with  (MedGemmaEngine.prepare_inputs)
+    image processing, pixel dtype cast and
+    pinning of the host tensors
+
+A request that then waits for memory (memory_planner.py), a replica or the
+replica's detection lock already holds ready-to-run tensors. When it starts, the
+copy to the device is a non_blocking transfer from pinned memory, and the model
+never waits on CPU-side preparation between requests.
+
+    MEDGEMMA_PREPROCESS_WORKERS  worker threads (default min(4, CPU count))
+    MEDGEMMA_PIN_MEMORY          0 keeps pageable host tensors (default 1; CUDA only)
+"""
+import os
+import time
+import asyncio
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+LOGGER = logging.getLogger("MedGemma")
+
+WORKERS = int(os.environ.get("MEDGEMMA_PREPROCESS_WORKERS", str(min(4, os.cpu_count() or 1))))
+PIN_MEMORY = os.environ.get("MEDGEMMA_PIN_MEMORY", "1") != "0"
+
+
+def pin_inputs(inputs):
+    """Move the tensors of a BatchFeature into page-locked memory (in place)."""
+    # Not at module level: the API worker imports this module without loading torch (model_server.py)
+    import torch
+    for key, value in list(inputs.items()):
+        if isinstance(value, torch.Tensor) and not value.is_pinned():
+            inputs[key] = value.pin_memory()
+    return inputs
+
+
+class PreparedInputs:
+    """Processor output for one prompt, ready for MedGemmaEngine.generate(prepared=...)."""
+    def __init__(self, model_id: str, inputs, images: int, prepare_ms: float, pinned: bool):
+        # Only valid for engines of the same checkpoint (same processor and vocabulary)
+        self.model_id = model_id
+        self.inputs = inputs
+        self.images = images
+        self.prepare_ms = prepare_ms
+        self.pinned = pinned
+
+    @property
+    def prompt_tokens(self) -> int:
+        return self.inputs["input_ids"].shape[-1]
+
+
+class PreprocessPipeline:
+    def __init__(self, workers: int = WORKERS):
+        self.workers = max(1, workers)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="preprocess")
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.busy_s = 0.0
+
+    def _call(self, fn, args, kwargs):
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+        start = time.perf_counter()
+        ok = False
+        try:
+            result = fn(*args, **kwargs)
+            ok = True
+            return result
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.busy_s += time.perf_counter() - start
+                if ok:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+
+    def submit(self, fn, *args, **kwargs):
+        """Run fn on the preprocessing workers; returns a concurrent.futures.Future."""
+        with self._lock:
+            self.queued += 1
+        return self._executor.submit(self._call, fn, args, kwargs)
+
+    async def run(self, fn, *args, **kwargs):
+        """Await fn(*args, **kwargs) on the preprocessing workers."""
+        with self._lock:
+            self.queued += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(self._call, fn, args, kwargs))
+
+    def status(self) -> dict:
+        with self._lock:
+            return {"workers": self.workers, "queued": self.queued, "running": self.running,
+                    "completed": self.completed, "failed": self.failed, "busy_s": round(self.busy_s, 2)}
+
+
+# Singleton instance
+pipeline = PreprocessPipeline()
@@ -0,0 +1,300 @@
+"""
+On-demand request profiling (按需性能采样).
+
+An admin arms the profiler for one route prefix, for the next N requests or for
+a time window. Each matching request is then captured from the first byte in to
+the last byte out (so streamed generations are covered to the end):
+
+    python stacks  every thread's stack sampled with sys._current_frames every
+                   interval_ms; written as collapsed stacks ("thread;outer;...;inner count",
+                   open in speedscope or flamegraph.pl). This shows base64 decoding,
+                   apply_chat_template, pydicom pixel_array, JPEG encoding, ...
+    torch ops      torch.profiler over all threads (CPU + CUDA when available); written
+                   as a Chrome trace (chrome://tracing or ui.perfetto.dev), with the
+                   engine's section() ranges (image decode, chat template, generate)
+
+One capture runs at a time; matching requests that arrive meanwhile are not
+captured. While disarmed the middleware only reads a flag, and section() returns
+a shared no-op context.
+
+With MEDGEMMA_MODEL_SERVER the model runs in another process, so the captures of
+an API worker show its own work (decoding, preprocessing, streaming) only.
+
+    MEDGEMMA_PROFILE_DIR   where captures are written (default ./profiles next to this file)
+    MEDGEMMA_PROFILE_KEEP  captures kept on disk, oldest deleted first (default 20)
+"""
+import os
+import re
+import sys
+import time
+import asyncio
+import logging
+import threading
+from collections import Counter
+from contextlib import nullcontext
+from typing import Optional
+
+LOGGER = logging.getLogger("MedGemma")
+
+PROFILE_DIR = os.environ.get("MEDGEMMA_PROFILE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles"))
+PROFILE_KEEP = int(os.environ.get("MEDGEMMA_PROFILE_KEEP", "20"))
+DEFAULT_INTERVAL_MS = 5
+MAX_STACK_DEPTH = 128
+TOP_FRAMES = 15
+
+_NULL_SECTION = nullcontext()
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """Background thread counting the stacks of all other threads."""
+    def __init__(self, interval_ms: float = DEFAULT_INTERVAL_MS):
+        self.interval = max(interval_ms, 1) / 1000.0
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                labels = []
+                while frame is not None and len(labels) < MAX_STACK_DEPTH:
+                    labels.append(_frame_label(frame))
+                    frame = frame.f_back
+                labels.append(names.get(ident, f"thread-{ident}"))
+                self.stacks[";".join(reversed(labels))] += 1
+            self.samples += 1
+
+    def top_frames(self, n: int = TOP_FRAMES):
+        """Innermost frames by sample count (where threads spent their time, waiting included)."""
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        return leaves.most_common(n)
+
+    def write_folded(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def _torch_profiler(all_threads: bool = True):
+    """torch.profiler session over all threads, or None when torch is unavailable."""
+    try:
+        import torch
+        from torch.profiler import profile, ProfilerActivity
+    except ImportError:
+        return None
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+    if all_threads:
+        try:
+            # Generation runs in its own thread; by default only the starting thread is recorded.
+            # Private torch API: its location and arguments change between releases
+            from torch._C._profiler import _ExperimentalConfig
+            return profile(activities=activities, experimental_config=_ExperimentalConfig(profile_all_threads=True))
+        except (ImportError, AttributeError, TypeError):
+            pass
+    LOGGER.warning("torch.profiler cannot record all threads here; operator timings will be incomplete.")
+    return profile(activities=activities)
+
+
+class Capture:
+    def __init__(self, capture_id: str, method: str, path: str, interval_ms: float, torch_ops: bool):
+        self.id = capture_id
+        self.method = method
+        self.path = path
+        self.started = time.time()
+        self.duration_s = None
+        self.files = []
+        self.top_frames = []
+        self.error = None
+        self.sampler = StackSampler(interval_ms)
+        self.torch = _torch_profiler() if torch_ops else None
+
+    def start(self):
+        if self.torch is not None:
+            try:
+                self.torch.start()
+            except (AttributeError, TypeError, RuntimeError):
+                # Older builds accept the experimental config but reject profile_all_threads on start
+                self.torch = _torch_profiler(all_threads=False)
+                self.torch.start()
+        self.sampler.start()
+
+    def stop(self, out_dir: str):
+        self.duration_s = round(time.time() - self.started, 3)
+        self.sampler.stop()
+        os.makedirs(out_dir, exist_ok=True)
+        folded = f"{self.id}.folded.txt"
+        self.sampler.write_folded(os.path.join(out_dir, folded))
+        self.files.append(folded)
+        self.top_frames = [{"frame": frame, "samples": count} for frame, count in self.sampler.top_frames()]
+        if self.torch is not None:
+            self.torch.stop()
+            trace = f"{self.id}.torch.json"
+            self.torch.export_chrome_trace(os.path.join(out_dir, trace))
+            self.files.append(trace)
+            self.torch = None
+
+    def summary(self) -> dict:
+        return {"id": self.id, "method": self.method, "path": self.path,
+                "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+                "duration_s": self.duration_s, "samples": self.sampler.samples, "files": self.files,
+                "top_frames": self.top_frames, "error": self.error}
+
+
+class Profiler:
+    def __init__(self, out_dir: str = PROFILE_DIR, keep: int = PROFILE_KEEP):
+        self.out_dir = out_dir
+        self.keep = keep
+        # Read without the lock on every request: the only cost while disarmed
+        self.armed = False
+        self.capturing = False
+        self.config = None
+        self.current: Optional[Capture] = None
+        self.captures = []
+        self._lock = threading.Lock()
+        self._count = 0
+
+    def arm(self, route: str, requests: Optional[int] = None, seconds: Optional[float] = None,
+            torch_ops: bool = True, interval_ms: float = DEFAULT_INTERVAL_MS) -> dict:
+        """Capture the next `requests` requests under `route` (default 1), or all of them for `seconds`."""
+        if requests is None and seconds is None:
+            requests = 1
+        if (requests is not None and requests < 1) or (seconds is not None and seconds <= 0):
+            raise ValueError("requests / seconds must be positive.")
+        with self._lock:
+            self.config = {"route": route, "remaining": requests, "seconds": seconds,
+                           "until": time.time() + seconds if seconds else None,
+                           "torch": torch_ops, "interval_ms": interval_ms}
+            self.armed = True
+        LOGGER.info(f"Profiler armed for {route} (requests: {requests or 'any'}, window: {seconds or '-'}s).")
+        return self.status()
+
+    def disarm(self) -> dict:
+        with self._lock:
+            self.armed = False
+            self.config = None
+        return self.status()
+
+    def begin(self, method: str, path: str) -> Optional[Capture]:
+        """Capture for this request, or None (other route, window over, or a capture is running)."""
+        with self._lock:
+            config = self.config
+            if not self.armed or config is None:
+                return None
+            if config["until"] is not None and time.time() > config["until"]:
+                self.armed = False
+                self.config = None
+                return None
+            if not path.startswith(config["route"]) or self.current is not None:
+                return None
+            if config["remaining"] is not None:
+                config["remaining"] -= 1
+                if config["remaining"] <= 0:
+                    self.armed = False
+                    self.config = None
+            self._count += 1
+            slug = re.sub(r"[^A-Za-z0-9]+", "-", path).strip("-") or "root"
+            capture = Capture(f"{time.strftime('%Y%m%d-%H%M%S')}-{self._count}-{slug}", method, path,
+                              config["interval_ms"], config["torch"])
+            self.current = capture
+        try:
+            capture.start()
+        except Exception as e:
+            with self._lock:
+                self.current = None
+            LOGGER.error(f"Profiler failed to start: {e}")
+            return None
+        self.capturing = True
+        return capture
+
+    def finish(self, capture: Capture):
+        try:
+            capture.stop(self.out_dir)
+        except Exception as e:
+            capture.error = str(e)
+            LOGGER.error(f"Profiler capture {capture.id} failed: {e}")
+        finally:
+            self.capturing = False
+            with self._lock:
+                self.current = None
+                self.captures.append(capture.summary())
+                expired = self.captures[:-self.keep] if self.keep > 0 else []
+                self.captures = self.captures[len(expired):]
+        for old in expired:
+            for name in old["files"]:
+                try:
+                    os.remove(os.path.join(self.out_dir, name))
+                except OSError:
+                    pass
+        LOGGER.info(f"Profiler capture {capture.id} ({capture.duration_s}s) written: {capture.files}")
+
+    def section(self, name: str):
+        """torch.profiler range for a step of the request (a no-op unless a capture is running)."""
+        if not self.capturing:
+            return _NULL_SECTION
+        from torch.profiler import record_function
+        return record_function(name)
+
+    def file_path(self, name: str) -> Optional[str]:
+        """Path of a capture file listed in status(), or None."""
+        with self._lock:
+            known = {f for c in self.captures for f in c["files"]}
+        if name not in known:
+            return None
+        return os.path.join(self.out_dir, name)
+
+    def status(self) -> dict:
+        with self._lock:
+            if self.config and self.config["until"] is not None and time.time() > self.config["until"]:
+                self.armed = False
+                self.config = None
+            config = dict(self.config) if self.config else None
+            return {
+                "armed": self.armed,
+                "config": config,
+                "capturing": self.current.id if self.current else None,
+                "captures": list(reversed(self.captures)),
+            }
+
+
+class ProfilingMiddleware:
+    """ASGI middleware wrapping armed requests in a capture (passes straight through otherwise)."""
+    def __init__(self, app, profiler: "Profiler" = None):
+        self.app = app
+        self.profiler = profiler or globals()["profiler"]
+
+    async def __call__(self, scope, receive, send):
+        if not self.profiler.armed or scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        capture = self.profiler.begin(scope.get("method", ""), scope["path"])
+        if capture is None:
+            return await self.app(scope, receive, send)
+        try:
+            # Returns once the (possibly streamed) response body has been sent
+            await self.app(scope, receive, send)
+        finally:
+            await asyncio.get_running_loop().run_in_executor(None, self.profiler.finish, capture)
+
+
+# Singleton instance
+profiler = Profiler()
@@ -0,0 +1,84 @@
+"""
+Request body decoding for /api/chat and /api/detect (请求体编码).
+
+Besides JSON with base64 / data-URL images, both endpoints accept two binary
+encodings in which images are raw file bytes (PNG / JPEG / ...), so they reach
+the image decoder without base64, a JSON parse of megabyte strings, or string
+validation:
+
+    multipart/form-data   a "payload" field holding the JSON request, in which image
+                          items name a file part instead of carrying data:
+                              {"type": "image", "part": "img0"}
+                          plus one file part per image ("img0", ...; send them with a
+                          filename so they are spooled rather than read as text fields)
+    application/msgpack   the request as a MessagePack map; an image item's "image" is
+                          a bin field (needs the optional msgpack package)
+
+The bytes end up in ContentItem.image and are decoded by MedGemmaEngine.process_image
+(or model_client.decode_image for the model-server path).
+"""
+import json
+from typing import Type
+
+from fastapi import Request, HTTPException
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, ValidationError
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_TYPES = ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack")
+
+
+async def _from_multipart(request: Request) -> dict:
+    form = await request.form()
+    payload = form.get("payload")
+    if payload is None:
+        raise HTTPException(status_code=400, detail="Multipart request needs a 'payload' field with the JSON request.")
+    if not isinstance(payload, str):
+        payload = (await payload.read()).decode("utf-8")
+    try:
+        data = json.loads(payload)
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON in 'payload': {e}")
+    for msg in data.get("messages") or []:
+        content = msg.get("content") if isinstance(msg, dict) else None
+        if not isinstance(content, list):
+            continue
+        for item in content:
+            if not isinstance(item, dict) or item.get("type") != "image" or "part" not in item:
+                continue
+            part = form.get(item.pop("part"))
+            if part is None or isinstance(part, str):
+                raise HTTPException(status_code=400, detail="Image part missing (or sent without a filename).")
+            item["image"] = await part.read()
+    return data
+
+
+def _from_msgpack(body: bytes) -> dict:
+    if msgpack is None:
+        raise HTTPException(status_code=415, detail="MessagePack requests need the msgpack package on the server.")
+    try:
+        return msgpack.unpackb(body, raw=False)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid MessagePack body: {e}")
+
+
+def body(model: Type[BaseModel]):
+    """FastAPI dependency parsing the request body as `model` from JSON, multipart or MessagePack."""
+    async def parse(request: Request) -> BaseModel:
+        content_type = request.headers.get("content-type", "").split(";", 1)[0].strip().lower()
+        binary = content_type == "multipart/form-data" or content_type in MSGPACK_TYPES
+        try:
+            if content_type == "multipart/form-data":
+                return model.model_validate(await _from_multipart(request))
+            if content_type in MSGPACK_TYPES:
+                return model.model_validate(_from_msgpack(await request.body()))
+            # JSON (default): pydantic parses the raw bytes itself
+            return model.model_validate_json(await request.body())
+        except ValidationError as e:
+            # Binary inputs (image bytes) are left out of the 422 body
+            raise RequestValidationError(e.errors(include_url=False, include_input=not binary))
+    return parse
@@ -0,0 +1,268 @@
+"""
+Server-side chat history (会话历史存储).
+
+Sessions and messages live in SQLite; images are written once to a
+content-addressed blob directory (sha256 of the bytes) and messages only keep
+their URL (/api/blobs/<sha>). The frontend lists sessions and loads messages a
+page at a time, so neither the sidebar nor a long conversation has to be read
+in full.
+
+    MEDGEMMA_DATA_DIR   sessions.db and blobs/ (default: ./data next to this file)
+
+app.py opens the store in its lifespan; importing this module touches no files.
+"""
+import os
+import re
+import io
+import json
+import time
+import base64
+import sqlite3
+import hashlib
+import threading
+import logging
+from typing import Optional, List, Tuple
+
+from PIL import Image
+
+LOGGER = logging.getLogger("MedGemma")
+
+DATA_DIR = os.environ.get("MEDGEMMA_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+BLOB_URL_PREFIX = "/api/blobs/"
+BLOB_URL_RE = re.compile(r"/api/blobs/([0-9a-f]{64})$")
+DATA_URL_RE = re.compile(r"^data:([\w/+.-]+);base64,", re.IGNORECASE)
+# Blobs are served from the app's own origin: anything but a raster image type (HTML, SVG with
+# script, ...) is stored and served as an opaque download
+UNSAFE_IMAGE_MIMES = ("image/svg+xml",)
+OPAQUE_MIME = "application/octet-stream"
+
+# Message fields (besides role/content) the frontend keeps on a message
+EXTRA_FIELDS = ("isDetectionResult", "relatedImage", "relatedFindings", "actions", "usage")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    title TEXT NOT NULL DEFAULT '',
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions(updated_at DESC, id DESC);
+CREATE TABLE IF NOT EXISTS messages (
+    session_id TEXT NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    extra TEXT,
+    PRIMARY KEY (session_id, seq)
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    sha TEXT PRIMARY KEY,
+    mime TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+"""
+
+
+def safe_mime(mime: str) -> str:
+    """`mime` if it is a raster image type, else application/octet-stream."""
+    mime = mime.lower()
+    return mime if mime.startswith("image/") and mime not in UNSAFE_IMAGE_MIMES else OPAQUE_MIME
+
+
+class SessionStore:
+    def __init__(self, data_dir: str = DATA_DIR):
+        self.data_dir = data_dir
+        self.blob_dir = os.path.join(data_dir, "blobs")
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(data_dir, "sessions.db"), check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA foreign_keys=ON")
+            self._conn.executescript(SCHEMA)
+
+    # --- Blobs ---
+
+    def _blob_path(self, sha: str) -> str:
+        return os.path.join(self.blob_dir, sha[:2], sha)
+
+    def put_blob(self, data: bytes, mime: str) -> str:
+        """Store bytes under their sha256 (idempotent). Returns the sha."""
+        sha = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(sha)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR IGNORE INTO blobs (sha, mime, size, created_at) VALUES (?, ?, ?, ?)",
+                               (sha, mime, len(data), time.time()))
+        return sha
+
+    def get_blob(self, sha: str) -> Tuple[str, str]:
+        """(path, mime) of a stored blob; KeyError if unknown."""
+        with self._lock:
+            row = self._conn.execute("SELECT mime FROM blobs WHERE sha = ?", (sha,)).fetchone()
+        path = self._blob_path(sha)
+        if row is None or not os.path.exists(path):
+            raise KeyError(f"Unknown blob: {sha}")
+        return path, safe_mime(row["mime"])
+
+    def externalize_image(self, image):
+        """data: URL -> blob URL. Anything else (already a URL, None) is returned unchanged."""
+        if not isinstance(image, str):
+            return image
+        match = DATA_URL_RE.match(image)
+        if not match:
+            return image
+        sha = self.put_blob(base64.b64decode(image[match.end():]), safe_mime(match.group(1)))
+        return BLOB_URL_PREFIX + sha
+
+    def load_image(self, url: str) -> Optional[Image.Image]:
+        """Blob URL -> RGB PIL image for the model; None if the string is not a blob URL."""
+        match = BLOB_URL_RE.search(url) if isinstance(url, str) else None
+        if not match:
+            return None
+        path, _ = self.get_blob(match.group(1))
+        with open(path, "rb") as f:
+            return Image.open(io.BytesIO(f.read())).convert("RGB")
+
+    def resolve_images(self, messages: List[dict]) -> List[dict]:
+        """Replace blob URLs in chat messages with the images they reference (in place)."""
+        for msg in messages:
+            content = msg.get("content")
+            if not isinstance(content, list):
+                continue
+            for item in content:
+                if item.get("type") == "image":
+                    image = self.load_image(item.get("image"))
+                    if image is not None:
+                        item["image"] = image
+        return messages
+
+    # --- Sessions ---
+
+    def _session_row(self, row) -> dict:
+        return {"id": row["id"], "title": row["title"], "createdAt": row["created_at"] * 1000,
+                "lastModified": row["updated_at"] * 1000, "messageCount": row["message_count"]}
+
+    def list_sessions(self, limit: int = 50, before: Optional[str] = None) -> dict:
+        """
+        Most recently modified first. `before` is the opaque cursor returned by the
+        previous page ("<updated_at>:<id>"), so paging stays stable while sessions change.
+        """
+        query = "SELECT * FROM sessions"
+        args = []
+        if before:
+            updated_at, _, session_id = before.partition(":")
+            try:
+                updated_at = float(updated_at)
+            except ValueError:
+                raise ValueError(f"Invalid session cursor: {before!r}")
+            query += " WHERE (updated_at, id) < (?, ?)"
+            args += [updated_at, session_id]
+        query += " ORDER BY updated_at DESC, id DESC LIMIT ?"
+        args.append(limit + 1)
+        with self._lock:
+            rows = self._conn.execute(query, args).fetchall()
+        page = rows[:limit]
+        next_cursor = f"{page[-1]['updated_at']!r}:{page[-1]['id']}" if len(rows) > limit else None
+        return {"sessions": [self._session_row(r) for r in page], "next_cursor": next_cursor}
+
+    def upsert_session(self, session_id: str, title: Optional[str] = None) -> dict:
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO sessions (id, title, created_at, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET title = COALESCE(?, title), updated_at = ?",
+                (session_id, title or "", now, now, title, now))
+            row = self._conn.execute("SELECT * FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        return self._session_row(row)
+
+    def delete_session(self, session_id: str):
+        # Blobs are content-addressed and may be shared between sessions; they are kept.
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            self._conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    # --- Messages ---
+
+    def _encode_message(self, message: dict) -> Tuple[str, str, Optional[str]]:
+        content = message.get("content", [])
+        if isinstance(content, list):
+            content = [
+                {**item, "image": self.externalize_image(item.get("image"))} if item.get("type") == "image" else item
+                for item in content
+            ]
+        extra = {k: message[k] for k in EXTRA_FIELDS if message.get(k) is not None}
+        if "relatedImage" in extra:
+            extra["relatedImage"] = self.externalize_image(extra["relatedImage"])
+        return message.get("role", "user"), json.dumps(content, ensure_ascii=False), \
+            json.dumps(extra, ensure_ascii=False) if extra else None
+
+    def _decode_message(self, row) -> dict:
+        message = {"seq": row["seq"], "role": row["role"], "content": json.loads(row["content"])}
+        if row["extra"]:
+            message.update(json.loads(row["extra"]))
+        return message
+
+    def _touch(self, session_id: str):
+        self._conn.execute(
+            "UPDATE sessions SET updated_at = ?, "
+            "message_count = (SELECT COUNT(*) FROM messages WHERE session_id = ?) WHERE id = ?",
+            (time.time(), session_id, session_id))
+
+    def put_message(self, session_id: str, seq: int, message: dict, title: Optional[str] = None) -> dict:
+        """Insert or replace message `seq` of a session. Images are moved to blobs; returns the stored form."""
+        role, content, extra = self._encode_message(message)
+        self.upsert_session(session_id, title)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO messages (session_id, seq, role, content, extra) VALUES (?, ?, ?, ?, ?)",
+                (session_id, seq, role, content, extra))
+            self._touch(session_id)
+            row = self._conn.execute("SELECT * FROM messages WHERE session_id = ? AND seq = ?",
+                                     (session_id, seq)).fetchone()
+        return self._decode_message(row)
+
+    def replace_messages(self, session_id: str, messages: List[dict], title: Optional[str] = None) -> int:
+        """Replace the whole history of a session (bulk import)."""
+        encoded = [self._encode_message(m) for m in messages]
+        self.upsert_session(session_id, title)
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            self._conn.executemany(
+                "INSERT INTO messages (session_id, seq, role, content, extra) VALUES (?, ?, ?, ?, ?)",
+                [(session_id, seq, *enc) for seq, enc in enumerate(encoded)])
+            self._touch(session_id)
+        return len(encoded)
+
+    def truncate_messages(self, session_id: str, keep: int):
+        """Drop every message with seq >= keep (deleted / regenerated tail)."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM messages WHERE session_id = ? AND seq >= ?", (session_id, keep))
+            self._touch(session_id)
+
+    def get_messages(self, session_id: str, limit: int = 20, before: Optional[int] = None) -> dict:
+        """The `limit` messages preceding seq `before` (default: the latest ones), oldest first."""
+        query = "SELECT * FROM messages WHERE session_id = ?"
+        args = [session_id]
+        if before is not None:
+            query += " AND seq < ?"
+            args.append(before)
+        query += " ORDER BY seq DESC LIMIT ?"
+        args.append(limit + 1)
+        with self._lock:
+            rows = self._conn.execute(query, args).fetchall()
+        page = [self._decode_message(r) for r in reversed(rows[:limit])]
+        return {"messages": page, "has_more": len(rows) > limit,
+                "first_seq": page[0]["seq"] if page else before or 0}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,22 @@
+"""
+Why a generation ended (生成终止原因).
+
+Shared by the model side (degeneration.py, detection_service.py) and the API
+side (app.py, chat_stream.py). Imports neither torch nor transformers, so API
+workers in model-server mode stay lightweight (see model_client.py).
+"""
+
+DEGENERATION_REASONS = ("repetition_loop", "repeated_json")
+DEGENERATION_NOTICE = "[系统提示: 检测到重复输出，生成已提前终止。]"
+
+
+def stop_reason(info: dict, aborted: bool = False) -> str:
+    """Why a generation ended: a degeneration reason, "aborted", "max_tokens" or "eos"."""
+    if info.get("stop_reason"):
+        return info["stop_reason"]
+    if aborted:
+        return "aborted"
+    max_new_tokens = info.get("max_new_tokens")
+    if max_new_tokens and info.get("completion_tokens", 0) >= max_new_tokens:
+        return "max_tokens"
+    return "eos"
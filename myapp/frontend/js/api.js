@@ -1,6 +1,68 @@
 // API layer — fetch wrappers for all backend endpoints
 
-export async function chatStream(messages, settings, { onChunk, signal }) {
+// Reads a chat response. The server answers with typed SSE events
+// (thought / answer / notice / usage); a plain-text body is passed through as "raw".
+async function readChatStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder("utf-8");
+    const isSSE = (response.headers.get('content-type') || '').includes('text/event-stream');
+    let buffer = '';
+    const handleFrame = (frame) => {
+        let type = 'message';
+        const data = [];
+        frame.split('\n').forEach(line => {
+            if (line.startsWith('event:')) type = line.slice(6).trim();
+            else if (line.startsWith('data:')) data.push(line.slice(5).replace(/^ /, ''));
+        });
+        if (data.length) onEvent(type, JSON.parse(data.join('\n')));
+    };
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        const text = decoder.decode(value, { stream: true });
+        if (!isSSE) {
+            onEvent('raw', { text });
+            continue;
+        }
+        buffer += text;
+        const frames = buffer.split('\n\n');
+        buffer = frames.pop();
+        frames.forEach(handleFrame);
+    }
+    if (isSSE && buffer.trim()) handleFrame(buffer);
+}
+
+// Images in data URLs go to the server as raw multipart file parts instead of
+// base64 inside JSON (see backend request_codec.py); other payloads stay JSON.
+function dataUrlToBlob(url) {
+    const [header, data] = url.split(',', 2);
+    const bytes = Uint8Array.from(atob(data), c => c.charCodeAt(0));
+    return new Blob([bytes], { type: header.slice(5).split(';')[0] });
+}
+
+function encodeRequest(payload) {
+    const form = new FormData();
+    let parts = 0;
+    const messages = payload.messages.map(msg => !Array.isArray(msg.content) ? msg : {
+        ...msg,
+        content: msg.content.map(item => {
+            if (item.type !== 'image' || typeof item.image !== 'string' || !item.image.startsWith('data:')) return item;
+            const name = `img${parts++}`;
+            form.append(name, dataUrlToBlob(item.image), name);
+            return { type: 'image', part: name };
+        }),
+    });
+    if (!parts) return { body: JSON.stringify(payload), headers: { 'Content-Type': 'application/json' } };
+    form.append('payload', JSON.stringify({ ...payload, messages }));
+    return { body: form, headers: {} };
+}
+
+// Empty number inputs mean "no limit"
+function thinkingBudget(value) {
+    return (value === '' || value === null || value === undefined) ? null : Number(value);
+}
+
+export async function chatStream(messages, settings, { onEvent, signal }) {
     const payload = {
         messages: messages.map(msg => {
             const cleanContent = msg.content.map(c => {
@@ -19,29 +81,25 @@ export async function chatStream(messages, settings, { onChunk, signal }) {
             temperature: settings.temperature,
             top_p: settings.topP,
             max_tokens: settings.maxTokens,
-            context_window: settings.contextWindow
+            context_window: settings.contextWindow,
+            thinking_budget: thinkingBudget(settings.thinkingBudget),
+            model_variant: settings.modelVariant || null
         }
     };
 
+    const { body, headers } = encodeRequest(payload);
     const response = await fetch(settings.apiEndpoint, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify(payload),
+        headers: { ...headers, 'Accept': 'text/event-stream' },
+        body,
         signal,
     });
 
-    if (!response.ok) throw new Error(`API Error: ${response.statusText}`);
-
-    const reader = response.body.getReader();
-    const decoder = new TextDecoder("utf-8");
-    while (true) {
-        const { done, value } = await reader.read();
-        if (done) break;
-        onChunk(decoder.decode(value, { stream: true }));
-    }
+    if (!response.ok) throw await apiError(response);
+    await readChatStream(response, onEvent);
 }
 
-export async function ctUpload(files) {
+export async function ctUpload(files, { onSlice } = {}) {
     const formData = new FormData();
     for (let i = 0; i < files.length; i++) {
         formData.append('files', files[i]);
@@ -51,38 +109,70 @@ export async function ctUpload(files) {
         const errText = await response.text();
         throw new Error(errText || "Upload failed");
     }
-    return response.json();
+
+    // NDJSON: one "slice" line per processed slice, then "done" (or "error")
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder("utf-8");
+    const images = [];
+    let buffer = '';
+    let done = null;
+    const handleLine = (line) => {
+        if (!line.trim()) return;
+        const event = JSON.parse(line);
+        if (event.type === 'slice') {
+            images.push(event);
+            if (onSlice) onSlice(event);
+        } else if (event.type === 'done') {
+            done = event;
+        } else if (event.type === 'error') {
+            throw new Error(event.detail || "Processing failed");
+        }
+    };
+    while (true) {
+        const { done: finished, value } = await reader.read();
+        if (finished) break;
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split('\n');
+        buffer = lines.pop();
+        lines.forEach(handleLine);
+    }
+    handleLine(buffer);
+    if (!done) throw new Error("Upload stream ended unexpectedly");
+    return { images, count: done.count, context_id: done.context_id };
 }
 
-export async function ctChatStream(text, settings, apiEndpoint, { onChunk }) {
+export async function ctChatStream(text, settings, apiEndpoint, { onEvent }) {
     const payload = {
         messages: [{ role: 'user', content: [{ type: 'text', text }] }],
         config: {
             ...settings,
             max_tokens: 8092,
             temperature: 0.2,
+            thinking_budget: thinkingBudget(settings.thinkingBudget),
+            model_variant: settings.modelVariant || null,
+            ct_mode: settings.ctMode || 'single',
             use_ct_context: true
         }
     };
 
     const response = await fetch(apiEndpoint, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: { 'Content-Type': 'application/json', 'Accept': 'text/event-stream' },
         body: JSON.stringify(payload)
     });
 
-    if (!response.ok) throw new Error(response.statusText);
+    if (!response.ok) throw await apiError(response);
+    await readChatStream(response, onEvent);
+}
 
-    const reader = response.body.getReader();
-    const decoder = new TextDecoder();
-    while (true) {
-        const { done, value } = await reader.read();
-        if (done) break;
-        onChunk(decoder.decode(value, { stream: true }));
-    }
+// Model variants the server can load ({ default, variants: [...] })
+export async function fetchModelVariants(apiEndpoint) {
+    const response = await fetch(apiEndpoint.replace("/chat", "/models"));
+    if (!response.ok) throw await apiError(response);
+    return response.json();
 }
 
-export async function detectRequest(imageUrl, detectionPrompt, apiEndpoint) {
+export async function detectRequest(imageUrl, detectionPrompt, apiEndpoint, detectionThinkingBudget = null, modelVariant = null) {
     const payload = {
         messages: [{
             role: "user",
@@ -91,14 +181,65 @@ export async function detectRequest(imageUrl, detectionPrompt, apiEndpoint) {
                 { type: "text", text: "Analyze this image for lesions." }
             ]
         }],
-        config: { system_prompt: detectionPrompt }
+        config: {
+            system_prompt: detectionPrompt,
+            thinking_budget: thinkingBudget(detectionThinkingBudget),
+            model_variant: modelVariant || null
+        }
     };
 
-    const response = await fetch(apiEndpoint.replace("/chat", "/detect"), {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify(payload)
-    });
+    const { body, headers } = encodeRequest(payload);
+    const response = await fetch(apiEndpoint.replace("/chat", "/detect"), { method: 'POST', headers, body });
+
+    return response.json();
+}
 
+// ── Session history (server-side store) ──
+
+// FastAPI errors carry a JSON "detail" (e.g. 503 when the server is out of memory budget)
+async function apiError(response) {
+    let detail = '';
+    try { detail = (await response.json()).detail || ''; } catch (e) { /* not JSON */ }
+    return new Error(`API Error: ${response.status} ${detail || response.statusText}`);
+}
+
+async function jsonOrThrow(response) {
+    if (!response.ok) throw new Error(`API Error: ${response.status} ${response.statusText}`);
     return response.json();
 }
+
+export async function fetchSessions(limit = 50, before = null) {
+    const params = new URLSearchParams({ limit });
+    if (before) params.set('before', before);
+    return jsonOrThrow(await fetch(`/api/sessions?${params}`));
+}
+
+export async function fetchSessionMessages(sessionId, limit = 20, before = null) {
+    const params = new URLSearchParams({ limit });
+    if (before !== null && before !== undefined) params.set('before', before);
+    return jsonOrThrow(await fetch(`/api/sessions/${encodeURIComponent(sessionId)}/messages?${params}`));
+}
+
+export async function putSessionMessage(sessionId, seq, message, title = null) {
+    return jsonOrThrow(await fetch(`/api/sessions/${encodeURIComponent(sessionId)}/messages/${seq}`, {
+        method: 'PUT',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ message, title }),
+    }));
+}
+
+export async function truncateSessionMessages(sessionId, keep) {
+    return jsonOrThrow(await fetch(`/api/sessions/${encodeURIComponent(sessionId)}/messages?keep=${keep}`, { method: 'DELETE' }));
+}
+
+export async function updateSession(sessionId, body) {
+    return jsonOrThrow(await fetch(`/api/sessions/${encodeURIComponent(sessionId)}`, {
+        method: 'PUT',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify(body),
+    }));
+}
+
+export async function deleteSessionRemote(sessionId) {
+    return jsonOrThrow(await fetch(`/api/sessions/${encodeURIComponent(sessionId)}`, { method: 'DELETE' }));
+}
@@ -14,6 +14,14 @@ export default {
                     <p class="text-sm text-gray-500 mt-1">支持 X 光、CT、MRI、病理切片等多种医学影像</p>
                 </div>
 
+                <!-- Earlier messages are loaded page by page -->
+                <div v-if="store.hasEarlierMessages.value" class="flex justify-center">
+                    <button @click="store.loadEarlierMessages()" :disabled="store.isLoadingEarlier.value"
+                        class="text-xs text-gray-400 hover:text-gray-200 bg-gray-800 border border-gray-700 rounded-full px-3 py-1 transition disabled:opacity-50">
+                        <i :class="store.isLoadingEarlier.value ? 'fa-solid fa-spinner fa-spin' : 'fa-solid fa-clock-rotate-left'" class="mr-1"></i> 加载更早的消息
+                    </button>
+                </div>
+
                 <!-- Messages -->
                 <div v-for="(msg, index) in store.messages.value" :key="index"
                     :class="['flex', msg.role === 'user' ? 'justify-end' : 'justify-start']">
@@ -56,6 +64,11 @@ export default {
                                 <div v-else-if="item.type === 'text'" v-html="store.renderMarkdown(item.text)" class="prose prose-invert max-w-none prose-p:my-1 prose-pre:my-2"></div>
                             </div>
 
+                            <!-- Stream Usage -->
+                            <div v-if="msg.usage && msg.usage.ttft_ms != null" class="mt-2 text-[10px] text-gray-500 font-mono select-none">
+                                首字 {{ msg.usage.ttft_ms }} ms · {{ msg.usage.completion_tokens }} tokens<span v-if="msg.usage.thought_tokens"> (思考 {{ msg.usage.thought_tokens }}<span v-if="msg.usage.thinking_budget_hit">，已达预算</span>)</span><span v-if="msg.usage.tokens_per_s"> · {{ msg.usage.tokens_per_s }} tok/s</span>
+                            </div>
+
                             <!-- Detection Result Restore -->
                             <button v-if="msg.isDetectionResult"
                                 @click="store.restoreDetectionView(msg)"
@@ -12,6 +12,7 @@ export default {
                         <i class="fa-solid fa-x-ray text-emerald-500"></i>
                         <span>影像工作站</span>
                         <span v-if="store.ctImages.value.length" class="text-xs text-gray-500 bg-gray-800 px-2 py-0.5 rounded-full">{{ store.ctImages.value.length }} 切片</span>
+                        <i v-if="store.isProcessingCT.value && store.ctImages.value.length" class="fa-solid fa-spinner fa-spin text-emerald-500 text-xs"></i>
                     </div>
                     <label :class="['px-2 py-0.5 bg-emerald-600 hover:bg-emerald-500 text-white rounded text-xs transition cursor-pointer shadow-sm',
                         store.isProcessingCT.value ? 'opacity-50 cursor-not-allowed' : '']">
@@ -20,8 +21,8 @@ export default {
                     </label>
                 </div>
                 <div class="flex-1 overflow-y-auto scrollbar-hide relative">
-                    <!-- Loading Overlay -->
-                    <div v-if="store.isProcessingCT.value" class="absolute inset-0 bg-black/80 flex flex-col items-center justify-center z-10 gap-4">
+                    <!-- Loading Overlay (until the first slice arrives) -->
+                    <div v-if="store.isProcessingCT.value && !store.ctImages.value.length" class="absolute inset-0 bg-black/80 flex flex-col items-center justify-center z-10 gap-4">
                         <div class="animate-spin rounded-full h-10 w-10 border-b-2 border-emerald-500"></div>
                         <p class="text-emerald-400 text-sm animate-pulse">正在进行3D窗位重构与采样...</p>
                     </div>
@@ -38,7 +39,7 @@ export default {
                         <div v-for="img in store.ctImages.value" :key="img.index"
                             @click="store.previewImage(img.image)"
                             class="aspect-square bg-black group relative cursor-pointer border border-transparent hover:border-emerald-500/50 transition">
-                            <img :src="img.image" class="w-full h-full object-cover" loading="lazy">
+                            <img :src="img.image" class="w-full h-full object-cover" loading="lazy" decoding="async">
                             <div class="absolute top-0 right-0 bg-black/60 text-gray-300 text-[10px] px-1 font-mono">{{ img.index }}</div>
                         </div>
                     </div>
@@ -36,6 +36,10 @@ export default {
                     </div>
                 </div>
                 <div v-if="!store.sessions.value.length" class="text-center text-gray-500 text-xs py-8">暂无对话历史</div>
+                <button v-if="store.sessionsCursor.value" @click="store.loadMoreSessions()"
+                    class="w-full text-center text-gray-500 hover:text-gray-300 text-xs py-2 transition">
+                    加载更多
+                </button>
             </div>
         </aside>
     `,
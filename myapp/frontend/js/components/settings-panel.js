@@ -1,5 +1,8 @@
 // SettingsPanel — slide-out settings drawer
 import { useStore } from '../store.js';
+import { fetchModelVariants } from '../api.js';
+
+const { ref, onMounted } = Vue;
 
 export default {
     name: 'SettingsPanel',
@@ -37,6 +40,36 @@ export default {
                         <input type="number" v-model.number="store.settings.maxTokens" min="256" max="16384" class="w-full bg-gray-900/50 border border-gray-600 rounded p-2 text-sm focus:border-emerald-500 outline-none">
                     </div>
 
+                    <!-- Thinking Budget -->
+                    <div class="space-y-2">
+                        <label class="text-sm font-medium text-gray-300">思考预算 (Thinking Budget)</label>
+                        <input type="number" v-model.number="store.settings.thinkingBudget" min="0" max="8192" placeholder="不限"
+                            class="w-full bg-gray-900/50 border border-gray-600 rounded p-2 text-sm focus:border-emerald-500 outline-none">
+                        <p class="text-[10px] text-gray-500">思考 token 上限，达到后直接开始作答；0 为关闭思考，留空不限。</p>
+                    </div>
+
+                    <!-- Model Variant -->
+                    <div class="space-y-2" v-if="variants.length > 1">
+                        <label class="text-sm font-medium text-gray-300">模型变体 (Model Variant)</label>
+                        <select v-model="store.settings.modelVariant"
+                            class="w-full bg-gray-900/50 border border-gray-600 rounded p-2 text-sm focus:border-emerald-500 outline-none">
+                            <option :value="null">默认 ({{ defaultVariant }})</option>
+                            <option v-for="name in variants" :key="name" :value="name">{{ name }}</option>
+                        </select>
+                        <p class="text-[10px] text-gray-500">首次使用某个变体时需加载模型，可能需要等待。</p>
+                    </div>
+
+                    <!-- CT Analysis Mode -->
+                    <div class="space-y-2">
+                        <label class="text-sm font-medium text-gray-300">CT 分析模式 (CT Analysis Mode)</label>
+                        <select v-model="store.settings.ctMode"
+                            class="w-full bg-gray-900/50 border border-gray-600 rounded p-2 text-sm focus:border-emerald-500 outline-none">
+                            <option value="single">单次 (Single Prompt)</option>
+                            <option value="map_reduce">分块汇总 (Map-Reduce)</option>
+                        </select>
+                        <p class="text-[10px] text-gray-500">分块汇总：逐块分析切片后合并结论，适合长序列，显存占用与切片数无关。</p>
+                    </div>
+
                     <!-- Context Window -->
                     <div class="space-y-2">
                         <label class="text-sm font-medium text-gray-300">上下文窗口 (Context Window)</label>
@@ -51,6 +84,9 @@ export default {
                         <div class="space-y-2 mt-2 animate-fadeIn">
                             <label class="text-xs text-gray-500">检测提示词 (Detection Prompt)</label>
                             <textarea v-model="store.settings.detectionPrompt" class="w-full bg-gray-900/50 border border-gray-600 rounded p-3 text-sm text-white h-32 resize-y font-mono focus:border-emerald-500 outline-none"></textarea>
+                            <label class="text-xs text-gray-500">检测思考预算 (Thinking Budget)</label>
+                            <input type="number" v-model.number="store.settings.detectionThinkingBudget" min="0" max="8192" placeholder="不限"
+                                class="w-full bg-gray-900/50 border border-gray-600 rounded p-2 text-sm focus:border-emerald-500 outline-none">
                         </div>
                     </details>
 
@@ -80,6 +116,17 @@ export default {
     `,
     setup() {
         const store = useStore();
-        return { store, close() { store.showSettings.value = false; } };
+        const variants = ref([]);
+        const defaultVariant = ref('');
+        onMounted(async () => {
+            try {
+                const data = await fetchModelVariants(store.settings.apiEndpoint);
+                variants.value = data.variants;
+                defaultVariant.value = data.default;
+            } catch (e) {
+                console.warn("Model variants unavailable:", e);
+            }
+        });
+        return { store, variants, defaultVariant, close() { store.showSettings.value = false; } };
     }
 };
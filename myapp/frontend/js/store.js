@@ -1,6 +1,9 @@
 // Central reactive state and actions — singleton store pattern
-import { DEFAULT_SETTINGS, getMessageText, generateTitle, scrollToBottom, renderMarkdown } from './utils.js';
-import { chatStream, ctUpload, ctChatStream, detectRequest } from './api.js';
+import { DEFAULT_SETTINGS, getMessageText, generateTitle, scrollToBottom, renderMarkdown, createStreamAccumulator } from './utils.js';
+import {
+    chatStream, ctUpload, ctChatStream, detectRequest,
+    fetchSessions, fetchSessionMessages, putSessionMessage, truncateSessionMessages, updateSession, deleteSessionRemote,
+} from './api.js';
 
 const { ref, reactive, watch, nextTick } = Vue;
 
@@ -16,6 +19,9 @@ export const previewImageUrl = ref(null);
 export const sessions = ref([]);
 export const currentSessionId = ref(null);
 export const showHistory = ref(false);
+export const sessionsCursor = ref(null);
+export const hasEarlierMessages = ref(false);
+export const isLoadingEarlier = ref(false);
 
 export const currentView = ref('chat');
 export const ctImages = ref([]);
@@ -34,6 +40,15 @@ export const settings = reactive({ ...DEFAULT_SETTINGS });
 
 let abortController = null;
 
+// Session persistence: messages are upserted one by one (debounced) into the
+// server-side store; messages.value[i] is seq messageOffset + i of the session.
+const SAVE_DEBOUNCE_MS = 800;
+const MESSAGE_PAGE_SIZE = 20;
+let messageOffset = 0;
+let savedSignatures = [];
+let saveTimer = null;
+let saveChain = Promise.resolve();
+
 // ── Settings Actions ───────────────────────────────────
 
 export function resetSettings() {
@@ -49,7 +64,7 @@ export function resetSettings() {
 }
 
 export function clearCache() {
-    if (confirm("警告：此操作将删除所有本地存储的数据，包括：\n- 所有历史对话记录\n- 自定义设置\n- 已缓存的状态\n\n您确定要重置应用为全新状态吗？")) {
+    if (confirm("警告：此操作将删除所有本地存储的数据，包括：\n- 自定义设置\n- 已缓存的状态\n\n您确定要重置应用为全新状态吗？")) {
         try {
             localStorage.clear();
             alert("数据已重置。页面将刷新。");
@@ -63,40 +78,113 @@ export function clearCache() {
 
 // ── Session Actions ────────────────────────────────────
 
-export function loadSessions() {
-    const stored = localStorage.getItem('medgemma_sessions');
-    if (stored) sessions.value = JSON.parse(stored);
+export async function loadSessions(more = false) {
+    const data = await fetchSessions(50, more ? sessionsCursor.value : null);
+    sessions.value = more ? sessions.value.concat(data.sessions) : data.sessions;
+    sessionsCursor.value = data.next_cursor;
+}
+
+export function loadMoreSessions() {
+    if (sessionsCursor.value) return loadSessions(true).catch(e => console.error("Error loading sessions:", e));
+}
+
+function touchSessionEntry(sessionId, title) {
+    const idx = sessions.value.findIndex(s => s.id === sessionId);
+    const session = idx !== -1 ? sessions.value.splice(idx, 1)[0] : { id: sessionId, title: "新对话" };
+    session.lastModified = Date.now();
+    if (title) session.title = title;
+    sessions.value.unshift(session);
+}
+
+function stripSeq({ seq, ...message }) {
+    return message;
+}
+
+// Swap embedded data-URL images for the blob URLs the server stored them under
+function adoptStoredImages(msg, stored) {
+    (msg.content || []).forEach((item, ci) => {
+        const storedItem = stored.content && stored.content[ci];
+        if (item.type === 'image' && storedItem && item.image !== storedItem.image) item.image = storedItem.image;
+    });
+    if (stored.relatedImage && msg.relatedImage !== stored.relatedImage) msg.relatedImage = stored.relatedImage;
 }
 
-export function saveSessionList() {
-    localStorage.setItem('medgemma_sessions', JSON.stringify(sessions.value));
+async function flushCurrentSession() {
+    const sessionId = currentSessionId.value;
+    if (!sessionId) return;
+    const current = messages.value;
+    // The title comes from the first user message, only known once the head is loaded
+    const title = messageOffset === 0 ? generateTitle(current) : null;
+    const writes = [];
+    current.forEach((msg, i) => {
+        const signature = JSON.stringify(msg);
+        if (savedSignatures[i] === signature) return;
+        savedSignatures[i] = signature;
+        writes.push(putSessionMessage(sessionId, messageOffset + i, msg, title).then(stored => {
+            if (currentSessionId.value !== sessionId || messages.value[i] !== msg) return;
+            adoptStoredImages(msg, stored);
+            savedSignatures[i] = JSON.stringify(msg);
+        }));
+    });
+    if (savedSignatures.length > current.length) {
+        savedSignatures.length = current.length;
+        writes.push(truncateSessionMessages(sessionId, messageOffset + current.length));
+    }
+    if (!writes.length) return;
+    touchSessionEntry(sessionId, title);
+    await Promise.all(writes);
 }
 
 export function saveCurrentSession() {
-    if (!currentSessionId.value) return;
+    clearTimeout(saveTimer);
+    saveChain = saveChain.then(flushCurrentSession).catch(e => console.error("Error saving session:", e));
+    return saveChain;
+}
+
+function scheduleSave() {
+    clearTimeout(saveTimer);
+    saveTimer = setTimeout(saveCurrentSession, SAVE_DEBOUNCE_MS);
+}
+
+function setLoadedMessages(page) {
+    const loaded = page.messages.map(stripSeq);
+    messages.value = loaded;
+    savedSignatures = loaded.map(m => JSON.stringify(m));
+    messageOffset = page.first_seq;
+    hasEarlierMessages.value = page.has_more;
+}
+
+export async function loadEarlierMessages() {
+    if (!hasEarlierMessages.value || isLoadingEarlier.value) return;
+    const sessionId = currentSessionId.value;
+    isLoadingEarlier.value = true;
     try {
-        localStorage.setItem(`medgemma_session_${currentSessionId.value}`, JSON.stringify(messages.value));
+        // Pending writes still use the current offset
+        await saveCurrentSession();
+        const page = await fetchSessionMessages(sessionId, MESSAGE_PAGE_SIZE, messageOffset);
+        if (currentSessionId.value !== sessionId) return;
+        const older = page.messages.map(stripSeq);
+        messages.value = older.concat(messages.value);
+        savedSignatures = older.map(m => JSON.stringify(m)).concat(savedSignatures);
+        messageOffset = page.first_seq;
+        hasEarlierMessages.value = page.has_more;
     } catch (e) {
-        if (e.name === 'QuotaExceededError' || e.code === 22) {
-            console.warn("LocalStorage Quota Exceeded.");
-        } else {
-            console.error("Error saving session:", e);
-        }
-        return;
+        console.error("Error loading messages:", e);
+    } finally {
+        isLoadingEarlier.value = false;
     }
-    const idx = sessions.value.findIndex(s => s.id === currentSessionId.value);
-    if (idx !== -1) {
-        sessions.value[idx].lastModified = Date.now();
-        sessions.value[idx].title = generateTitle(messages.value);
-        const session = sessions.value.splice(idx, 1)[0];
-        sessions.value.unshift(session);
-    } else {
-        sessions.value.unshift({ id: currentSessionId.value, title: generateTitle(messages.value), lastModified: Date.now() });
+}
+
+// The model needs the whole conversation, not just the loaded page
+async function ensureFullHistory() {
+    while (hasEarlierMessages.value) {
+        const before = messageOffset;
+        await loadEarlierMessages();
+        if (messageOffset === before) break;
     }
-    saveSessionList();
 }
 
-export function createNewSession() {
+export async function createNewSession() {
     if (messages.value.length === 0 && currentSessionId.value) {
         userInput.value = "";
         pendingImage.value = null;
@@ -104,39 +192,73 @@ export function createNewSession() {
         currentFindings.value = [];
         return;
     }
+    await saveCurrentSession();
+    // Persisted on the server with its first message
     const newId = Date.now().toString();
     currentSessionId.value = newId;
     messages.value = [];
+    savedSignatures = [];
+    messageOffset = 0;
+    hasEarlierMessages.value = false;
     userInput.value = "";
     pendingImage.value = null;
     activeFloatingImage.value = null;
     currentFindings.value = [];
     sessions.value.unshift({ id: newId, title: "新对话", lastModified: Date.now() });
-    saveSessionList();
 }
 
-export function switchSession(sessionId) {
+export async function switchSession(sessionId) {
     if (currentSessionId.value === sessionId) return;
-    const stored = localStorage.getItem(`medgemma_session_${sessionId}`);
-    messages.value = stored ? JSON.parse(stored) : [];
+    await saveCurrentSession();
     currentSessionId.value = sessionId;
+    messages.value = [];
+    savedSignatures = [];
+    messageOffset = 0;
+    hasEarlierMessages.value = false;
     activeFloatingImage.value = null;
     currentFindings.value = [];
     if (window.innerWidth < 1024) showHistory.value = false;
+    try {
+        const page = await fetchSessionMessages(sessionId, MESSAGE_PAGE_SIZE);
+        if (currentSessionId.value === sessionId) setLoadedMessages(page);
+    } catch (e) {
+        console.error("Error loading session:", e);
+    }
 }
 
-export function deleteSession(sessionId, event) {
+export async function deleteSession(sessionId, event) {
     if (event) event.stopPropagation();
     if (!confirm("确定删除此对话吗？")) return;
     sessions.value = sessions.value.filter(s => s.id !== sessionId);
-    localStorage.removeItem(`medgemma_session_${sessionId}`);
-    saveSessionList();
     if (currentSessionId.value === sessionId) {
-        if (sessions.value.length > 0) switchSession(sessions.value[0].id);
-        else createNewSession();
+        // Nothing of the deleted session may be written back
+        clearTimeout(saveTimer);
+        savedSignatures = messages.value.map(m => JSON.stringify(m));
+        if (sessions.value.length > 0) await switchSession(sessions.value[0].id);
+        else await createNewSession();
+    }
+    try {
+        await deleteSessionRemote(sessionId);
+    } catch (e) {
+        console.error("Error deleting session:", e);
     }
 }
 
+// One-time import of sessions kept in localStorage by earlier versions
+async function migrateLocalSessions() {
+    const stored = localStorage.getItem('medgemma_sessions');
+    if (!stored) return;
+    const legacy = JSON.parse(stored);
+    // Oldest first, so the newest ends up most recently modified
+    for (const session of legacy.slice().reverse()) {
+        const key = `medgemma_session_${session.id}`;
+        const msgs = JSON.parse(localStorage.getItem(key) || '[]');
+        if (msgs.length) await updateSession(session.id, { title: session.title, messages: msgs });
+        localStorage.removeItem(key);
+    }
+    localStorage.removeItem('medgemma_sessions');
+}
+
 // ── Chat Actions ───────────────────────────────────────
 
 export function handleImageUpload(event) {
@@ -180,6 +302,7 @@ export async function sendMessage() {
     userInput.value = "";
     pendingImage.value = null;
     scrollToBottom(chatContainer);
+    await ensureFullHistory();
 
     try {
         await processResponse();
@@ -196,10 +319,17 @@ export async function processResponse() {
     try {
         messages.value.push({ role: 'model', content: [{ type: 'text', text: '' }] });
         const currentIndex = messages.value.length - 1;
+        const stream = createStreamAccumulator();
 
         await chatStream(messages.value.slice(0, -1), settings, {
-            onChunk: (chunk) => {
-                messages.value[currentIndex].content[0].text += chunk;
+            onEvent: (type, data) => {
+                const msg = messages.value[currentIndex];
+                if (type === 'usage') {
+                    msg.usage = data;
+                    return;
+                }
+                if (!stream.push(type, data)) return;
+                msg.content[0].text = stream.text;
                 requestAnimationFrame(() => scrollToBottom(chatContainer));
             },
             signal: abortController.signal,
@@ -229,11 +359,15 @@ export async function regenerate() {
     if (messages.value.length === 0) return;
     const last = messages.value[messages.value.length - 1];
     if (last.role === 'model') messages.value.pop();
+    await ensureFullHistory();
     if (messages.value.length > 0) await processResponse();
 }
 
 export function resetSession() {
     if (confirm("确定要清空当前对话历史吗？")) {
+        // Clears the whole session, including pages not loaded yet
+        messageOffset = 0;
+        hasEarlierMessages.value = false;
         messages.value = [];
     }
 }
@@ -283,7 +417,7 @@ export async function detectLesions() {
     isDetecting.value = true;
 
     try {
-        const data = await detectRequest(activeFloatingImage.value, settings.detectionPrompt, settings.apiEndpoint);
+        const data = await detectRequest(activeFloatingImage.value, settings.detectionPrompt, settings.apiEndpoint, settings.detectionThinkingBudget, settings.modelVariant);
 
         if (data.status === "success" && Array.isArray(data.findings)) {
             currentFindings.value = data.findings;
@@ -329,7 +463,8 @@ export async function processCTUpload(event) {
             content: [{ type: 'text', text: '正在上传并处理医学影像数据的三维重建与窗位映射，请稍候...' }]
         });
 
-        const data = await ctUpload(files);
+        // Slices appear in the viewer as the server finishes them
+        const data = await ctUpload(files, { onSlice: (slice) => ctImages.value.push(slice) });
         ctImages.value = data.images;
 
         ctMessages.value = [{
@@ -343,6 +478,8 @@ export async function processCTUpload(event) {
         }];
     } catch (e) {
         console.error(e);
+        // Partially streamed slices belong to a discarded context
+        ctImages.value = [];
         ctMessages.value.push({
             role: 'assistant',
             content: [{ type: 'text', text: `❌ 处理失败: ${e.message || "无法解析 DICOM 文件"}` }]
@@ -367,10 +504,16 @@ export async function sendCTMessage(overrideText = null) {
     try {
         const aiMsg = reactive({ role: 'assistant', content: [{ type: 'text', text: "" }] });
         ctMessages.value.push(aiMsg);
+        const stream = createStreamAccumulator();
 
         await ctChatStream(text, settings, settings.apiEndpoint, {
-            onChunk: (chunk) => {
-                aiMsg.content[0].text += chunk;
+            onEvent: (type, data) => {
+                if (type === 'usage') {
+                    aiMsg.usage = data;
+                    return;
+                }
+                if (!stream.push(type, data)) return;
+                aiMsg.content[0].text = stream.text;
                 nextTick(() => scrollToBottom(ctChatContainer));
             }
         });
@@ -384,19 +527,28 @@ export async function sendCTMessage(overrideText = null) {
 
 // ── Init ───────────────────────────────────────────────
 
-loadSessions();
-if (sessions.value.length === 0) {
-    createNewSession();
-} else {
-    switchSession(sessions.value[0].id);
+async function initSessions() {
+    try {
+        await migrateLocalSessions();
+    } catch (e) {
+        console.error("Session migration failed:", e);
+    }
+    try {
+        await loadSessions();
+    } catch (e) {
+        console.error("Error loading sessions:", e);
+    }
+    if (sessions.value.length === 0) await createNewSession();
+    else await switchSession(sessions.value[0].id);
 }
+initSessions();
 
 // Load saved settings
 const savedSettings = localStorage.getItem('medgemma_settings');
 if (savedSettings) Object.assign(settings, JSON.parse(savedSettings));
 
 // Auto-save watchers
-watch(messages, () => saveCurrentSession(), { deep: true });
+watch(messages, scheduleSave, { deep: true });
 watch(settings, (s) => localStorage.setItem('medgemma_settings', JSON.stringify(s)));
 
 // ── Public API ─────────────────────────────────────────
@@ -405,11 +557,12 @@ export function useStore() {
     return {
         messages, userInput, pendingImage, isLoading, showSettings, chatContainer,
         previewImageUrl, sessions, currentSessionId, showHistory,
+        sessionsCursor, hasEarlierMessages, isLoadingEarlier,
         currentView, ctImages, ctMessages, ctInput, isProcessingCT, ctChatContainer,
         activeFloatingImage, currentFindings, isDetecting, editingIndex, editText,
         settings,
         resetSettings, clearCache,
-        loadSessions, saveSessionList, saveCurrentSession, createNewSession,
+        loadSessions, loadMoreSessions, loadEarlierMessages, saveCurrentSession, createNewSession,
         switchSession, deleteSession,
         handleImageUpload, clearPendingImage, setActiveFloatingImage, previewImage,
         sendMessage, processResponse, stopGeneration, regenerate, resetSession,
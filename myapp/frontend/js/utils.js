@@ -7,6 +7,10 @@ export const DEFAULT_SETTINGS = {
     topP: 0.9,
     maxTokens: 4096,
     contextWindow: 20000,
+    thinkingBudget: null,            // max thought tokens (null: unlimited, 0: no thinking)
+    detectionThinkingBudget: null,
+    modelVariant: null,              // model_registry.py variant (null: server default)
+    ctMode: 'single',                // CT chat: 'single' prompt or 'map_reduce' over slice chunks
     apiEndpoint: (window.MEDGEMMA_CONFIG && window.MEDGEMMA_CONFIG.apiBaseUrl)
                  ? (window.MEDGEMMA_CONFIG.apiBaseUrl + "/api/chat")
                  : (window.location.origin + "/api/chat")
@@ -40,8 +44,66 @@ export function scrollToBottom(containerRef) {
     }
 }
 
+// ── Streaming / rendering ──────────────────────────────
+
+// Accumulates typed chat stream events (see api.js) into a message text.
+// The text keeps the model's thought markers, so stored sessions and the
+// history sent back to the model look exactly like before.
+export function createStreamAccumulator() {
+    let thought = '', answer = '', raw = '';
+    return {
+        push(type, data) {
+            if (type === 'thought') thought += data.text;
+            else if (type === 'answer') answer += data.text;
+            else if (type === 'notice') answer += `\n\n${data.text}`;
+            else if (type === 'raw') raw += data.text;  // text/plain server
+            else return false;
+            return true;
+        },
+        get text() {
+            if (raw) return raw;
+            return thought ? `<unused94>${thought}<unused95>${answer}` : answer;
+        },
+    };
+}
+
+// Every message is re-rendered whenever the list changes, so rendered HTML is
+// kept in a small LRU keyed by source text.
+const RENDER_CACHE_SIZE = 300;
+const renderCache = new Map();
+
+function cacheGet(src) {
+    const html = renderCache.get(src);
+    if (html !== undefined) {
+        renderCache.delete(src);
+        renderCache.set(src, html);
+    }
+    return html;
+}
+
+function cacheSet(src, html) {
+    renderCache.set(src, html);
+    if (renderCache.size > RENDER_CACHE_SIZE) renderCache.delete(renderCache.keys().next().value);
+    return html;
+}
+
+// Blocks before the last blank line outside a code fence no longer change while
+// the text grows, so they come from the cache and only the trailing block is parsed.
+// An indented trailing block may continue a list item, so that case is parsed whole.
+function parseIncremental(src) {
+    const cut = src.lastIndexOf('\n\n');
+    if (cut <= 0 || /^[ \t]/.test(src.slice(cut + 2))) return marked.parse(src);
+    const fences = (src.slice(0, cut).match(/^\s*(```|~~~)/gm) || []).length;
+    if (fences % 2 !== 0) return marked.parse(src);
+    const head = src.slice(0, cut);
+    const headHtml = cacheGet(head) ?? cacheSet(head, marked.parse(head));
+    return headHtml + marked.parse(src.slice(cut));
+}
+
 export function renderMarkdown(text) {
     if (!text) return "";
+    const cached = cacheGet(text);
+    if (cached !== undefined) return cached;
 
     let cleanText = text.replace(/<\/s>|<eos>|<pad>|<bos>/gi, "").trim();
 
@@ -63,13 +125,13 @@ export function renderMarkdown(text) {
                     <span class="ml-auto text-[10px] opacity-50 block group-open:hidden">点击展开</span>
                 </summary>
                 <div class="p-3 text-gray-400 text-sm border-t border-gray-700/50 bg-gray-900/30 prose prose-invert max-w-none prose-p:my-1 prose-pre:my-2 animate-fadeIn">
-                    ${marked.parse(thoughtContent)}
+                    ${parseIncremental(thoughtContent)}
                 </div>
             </details>
         `;
 
-        return thoughtHtml + (finalAnswer ? marked.parse(finalAnswer) : '<span class="animate-pulse inline-block w-2 h-4 bg-gray-600 align-middle ml-1"></span>');
+        return cacheSet(text, thoughtHtml + (finalAnswer ? parseIncremental(finalAnswer) : '<span class="animate-pulse inline-block w-2 h-4 bg-gray-600 align-middle ml-1"></span>'));
     }
 
-    return marked.parse(cleanText);
+    return cacheSet(text, parseIncremental(cleanText));
 }